@@ -0,0 +1,106 @@
+"""Script containing the shared dictionary of interned addresses"""
+import numpy as np
+import pandas as pd
+from route_cache import normalize_address
+
+
+class AddressBook:
+    """Interns addresses into dense int32 ids shared by the datastore, the
+    route table and the weight engine.
+
+    Addresses are compared after normalizing whitespace and case, each id
+    decodes to the first spelling it was interned with. Missing addresses
+    get the id -1.
+    """
+
+    def __init__(self):
+        """
+        Initialize an empty address book.
+        """
+        self.addresses = []
+        self.ids = {}
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def _map_unique(self, values, add):
+        """
+        Map the distinct values of an array to ids, normalizing each
+        distinct value once.
+        :param values: array of address strings or NaN
+        :param add: if True, unknown addresses are added to the book
+        :return: int32 array of the shape of values
+        """
+        values = np.asarray(values, dtype=object)
+        codes, uniques = pd.factorize(values.ravel())
+        unique_ids = np.empty(len(uniques), dtype=np.int32)
+        for i, address in enumerate(uniques):
+            key = normalize_address(address)
+            if key not in self.ids and add:
+                self.ids[key] = len(self.addresses)
+                self.addresses.append(address)
+            unique_ids[i] = self.ids.get(key, -1)
+        ids = np.where(codes >= 0, unique_ids[codes], -1).astype(np.int32)
+        return ids.reshape(values.shape)
+
+    def intern(self, values):
+        """
+        Get the ids of addresses, adding the unknown ones to the book.
+        :param values: array of address strings or NaN
+        :return: int32 array of the shape of values
+        """
+        return self._map_unique(values, add=True)
+
+    def lookup(self, values):
+        """
+        Get the ids of addresses without adding to the book.
+        :param values: array of address strings or NaN
+        :return: int32 array of the shape of values, -1 for unknown
+        addresses
+        """
+        return self._map_unique(values, add=False)
+
+    def intern_categorical(self, values):
+        """
+        Get the ids of a categorical series, interning only its categories.
+        :param values: categorical series of addresses
+        :return: int32 array
+        """
+        category_ids = np.append(self.intern(values.cat.categories), -1)
+        return category_ids[values.cat.codes.to_numpy()].astype(np.int32)
+
+    def decode(self, ids):
+        """
+        Get the addresses of ids.
+        :param ids: int array
+        :return: object array of the shape of ids, NaN for -1
+        """
+        ids = np.asarray(ids)
+        return np.append(np.array(self.addresses, dtype=object),
+                         np.nan)[np.where(ids >= 0, ids, len(self))]
+
+    def code_table(self, ids):
+        """
+        Make a table translating ids into positions along an axis holding
+        the given ids, the first position wins for repeated ids.
+        :param ids: int array of the ids along the axis
+        :return: int array indexed by id, -1 for ids not on the axis
+        """
+        table = np.full(len(self) + 1, -1)
+        ids = np.asarray(ids)
+        table[ids[::-1]] = np.arange(len(ids))[::-1]
+        table[-1] = -1
+        return table
+
+    @staticmethod
+    def translate(table, ids):
+        """
+        Translate ids with a code table, including ids added to the book
+        after the table was made.
+        :param table: code table
+        :param ids: int array
+        :return: int array of positions, -1 where the id is not on the axis
+        """
+        ids = np.asarray(ids)
+        known = (ids >= 0) & (ids < len(table) - 1)
+        return np.where(known, table[np.where(known, ids, -1)], -1)
@@ -0,0 +1,98 @@
+"""Script containing the capacity aware optimal assignment of students"""
+import math
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+import weight_combination
+from instrumentation import get_instrumentation
+
+
+def get_practice_capacities(df_practices, n_students):
+    """
+    Get the number of students every practice can take.
+
+    Capacities are read from the optional capacity column of the practices
+    file. Practices without a capacity get an equal share of the students,
+    so every student can be assigned when no capacities are given.
+    :param df_practices: practices df
+    :param n_students: number of students
+    :return: int array of shape (P,)
+    """
+    default = math.ceil(n_students / max(len(df_practices), 1))
+    if 'capacity' not in df_practices.columns:
+        return np.full(len(df_practices), default, dtype=int)
+    return df_practices['capacity'].fillna(default).to_numpy(dtype=int)
+
+
+def assign_optimal(weights, capacities):
+    """
+    Assign every student to a practice maximizing the total weight while no
+    practice takes more students than its capacity.
+
+    Each practice is expanded into as many slots as its capacity, at most one
+    per student, and the students x slots problem is solved with the
+    Hungarian algorithm.
+    :param weights: float array of shape (S, P), NaN for forbidden pairs
+    :param capacities: int array of shape (P,)
+    :return: int array of shape (S,) with the practice position of each
+    student, -1 for students left without a practice
+    """
+    n_students = weights.shape[0]
+    slots = np.repeat(np.arange(weights.shape[1]),
+                      np.clip(capacities, 0, n_students))
+
+    # forbidden pairs get a weight so low that assigning one more student
+    # to a scored pair always outweighs any gain elsewhere, so as many
+    # students as possible are assigned first and the weight comes second
+    scored = np.isfinite(weights)
+    low, high = (weights[scored].min(), weights[scored].max()) \
+        if scored.any() else (0, 0)
+    penalty = low - n_students * (high - low) - 1
+    slot_weights = np.where(scored, weights, penalty)[:, slots]
+
+    rows, cols = linear_sum_assignment(slot_weights, maximize=True)
+
+    assigned = np.full(n_students, -1)
+    assigned[rows] = slots[cols]
+    assigned[rows[~scored[rows, slots[cols]]]] = -1
+    return assigned
+
+
+def create_optimal_assignment(data_store, weight_df,
+                              output_path='data/optimal_pairs.csv'):
+    """
+    Assign students to practices optimally and save the pairs in the format
+    of best_pairs.csv.
+
+    The total weight of the optimal assignment is reported next to the total
+    of the greedy selection, where every student takes their best practice
+    regardless of capacity.
+    :param data_store:
+    :param weight_df: df of all_possible_pairs.csv
+    :param output_path: file path for the assigned pairs
+    :return: dict with the greedy and optimal objective and the number of
+    unassigned students
+    """
+    print("Computing optimal assignment..")
+    weights, _ = weight_combination.pivot_weights(data_store, weight_df)
+    capacities = get_practice_capacities(data_store.df_practices,
+                                         len(weights))
+    assigned = assign_optimal(weights, capacities)
+
+    students = np.flatnonzero(assigned >= 0)
+    practices = assigned[students]
+    chosen = weight_df.set_index(['s_id', 'p_id']).loc[
+        list(zip(data_store.df_students.index[students],
+                 data_store.df_practices.index[practices]))].reset_index()
+    weight_combination.to_pair_format(chosen).to_csv(
+        output_path, index=False, sep="\t")
+    get_instrumentation().incr("rows_written", len(chosen))
+
+    report = {
+        "greedy": float(np.nansum(np.nanmax(weights, axis=1))),
+        "optimal": float(weights[students, practices].sum()),
+        "unassigned": int(len(assigned) - len(students)),
+    }
+    print("Total weight greedy: {greedy:.3f}, optimal: {optimal:.3f}, "
+          "unassigned students: {unassigned}".format(**report))
+    print("Optimal assignment can be found at " + output_path)
+    return report
@@ -0,0 +1,195 @@
+"""Benchmark of every pipeline stage on synthetic rosters"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from data_store import DataStore
+from route_table import RouteTable
+from specialties import load_specialty_vocabulary
+import weight_combination
+
+DEFAULT_SCALES = [(50, 50), (500, 50), (500, 500), (5000, 500)]
+
+
+def _synthetic_addresses(rng, prefix, count):
+    streets = ["Hauptstraße", "Bahnhofstraße", "Schillerstraße",
+               "Goethestraße", "Bergstraße", "Lindenweg", "Am Waldacker"]
+    postal_codes = rng.integers(60306, 65936, size=count)
+    return ["{} {}{}, {} Frankfurt am Main".format(
+        streets[i % len(streets)], prefix, i, postal_codes[i])
+        for i in range(count)]
+
+
+def _synthetic_specialties(rng, vocabulary, count, empty_share=0.0):
+    specialties = []
+    for _ in range(count):
+        if rng.random() < empty_share:
+            specialties.append(np.nan)
+            continue
+        names = rng.choice(vocabulary, size=rng.integers(1, 4),
+                           replace=False)
+        specialties.append(", ".join(names))
+    return specialties
+
+
+def generate_roster(n_students, n_practices, out_dir, seed=0):
+    """
+    Write synthetic students.csv, practices.csv and addresses.csv files with
+    the column schema of the real input files.
+    :param n_students: number of students
+    :param n_practices: number of practices
+    :param out_dir: directory the files are written to
+    :param seed: seed of the random generator
+    :return: dict with the file paths
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary = load_specialty_vocabulary() or ["Notfallmedizin"]
+    paths = {name: os.path.join(out_dir, name + ".csv")
+             for name in ["students", "practices", "addresses"]}
+
+    alternative1 = np.array(_synthetic_addresses(rng, "1", n_students),
+                            dtype=object)
+    alternative2 = np.array(_synthetic_addresses(rng, "2", n_students),
+                            dtype=object)
+    alternative1[rng.random(n_students) < 0.6] = np.nan
+    alternative2[rng.random(n_students) < 0.8] = np.nan
+    pd.DataFrame({
+        "id": ["S{:05d}".format(i + 1) for i in range(n_students)],
+        "address": _synthetic_addresses(rng, "", n_students),
+        "alternativeAddress1": alternative1,
+        "alternativeAddress2": alternative2,
+        "hasCar": (rng.random(n_students) < 0.3).astype(int),
+        "hasChildren": (rng.random(n_students) < 0.15).astype(int),
+        "favoriteSpecialties": _synthetic_specialties(rng, vocabulary,
+                                                      n_students),
+    }).to_csv(paths["students"], sep="\t", index=False)
+
+    pd.DataFrame({
+        "id": ["P{:04d}".format(i + 1) for i in range(n_practices)],
+        "address": _synthetic_addresses(rng, "9", n_practices),
+        "specialties": _synthetic_specialties(rng, vocabulary, n_practices,
+                                              empty_share=0.3),
+    }).to_csv(paths["practices"], sep="\t", index=False)
+
+    ds = DataStore()
+    ds.read_students_from_csv_file(paths["students"])
+    ds.read_practices_from_csv_file(paths["practices"])
+    addr_df = ds.build_address_frame()
+    addr_df['distance'] = rng.integers(100, 30000, size=len(addr_df))
+    addr_df['duration'] = (addr_df['distance'] /
+                           np.where(addr_df['is_car'], 9.0, 4.5)).astype(int)
+    addr_df.to_csv(paths["addresses"], sep="\t", index=False)
+    return paths
+
+
+class StageTimer:
+    """Records wall time and peak traced memory of named stages.
+
+    Tracing allocations slows numpy and pandas code down considerably, so
+    each stage is timed untraced first and then run a second time under
+    tracemalloc to measure its peak memory.
+    """
+
+    def __init__(self, trace_memory=True):
+        """
+        Initialize the timer.
+        :param trace_memory: if False, stages run once and no peak memory
+        is reported
+        """
+        self.trace_memory = trace_memory
+        self.stages = {}
+
+    def run(self, name, func, *args, **kwargs):
+        """
+        Run a stage and record its wall time and peak memory.
+        :param name: stage name
+        :param func: stage function
+        :return: the result of the stage
+        """
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.stages[name] = {
+            "wall_time_s": round(time.perf_counter() - start, 4)}
+
+        if self.trace_memory:
+            del result
+            tracemalloc.start()
+            result = func(*args, **kwargs)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.stages[name]["peak_memory_mb"] = round(peak / 2 ** 20, 2)
+        return result
+
+
+def benchmark_scale(n_students, n_practices, seed=0, trace_memory=True):
+    """
+    Time DataStore loading, address extraction, weight computation and best
+    pair extraction on a synthetic roster.
+    :param n_students: number of students
+    :param n_practices: number of practices
+    :param seed: seed of the roster generator
+    :param trace_memory: if True, also measure the peak memory per stage
+    :return: dict with the results of every stage
+    """
+    with tempfile.TemporaryDirectory() as work_dir:
+        paths = generate_roster(n_students, n_practices, work_dir, seed)
+        timer = StageTimer(trace_memory)
+
+        def load():
+            ds = DataStore()
+            ds.read_practices_from_csv_file(paths["practices"])
+            ds.read_students_from_csv_file(paths["students"])
+            return ds
+
+        ds = timer.run("load", load)
+        timer.run("extract_addresses", ds.build_address_frame)
+        route_table = timer.run("load_route_table", RouteTable.from_csv,
+                                paths["addresses"])
+        weight_df = timer.run(
+            "create_all_weight_combinations",
+            weight_combination.create_all_weight_combinations, ds,
+            route_table,
+            output_path=os.path.join(work_dir, "all_possible_pairs.csv"))
+        timer.run("extract_best_weights_students",
+                  weight_combination.extract_best_weights_students, ds,
+                  weight_df,
+                  output_path=os.path.join(work_dir, "best_pairs.csv"))
+
+    return {"students": n_students, "practices": n_practices,
+            "pairs": n_students * n_practices, "stages": timer.stages}
+
+
+def _parse_scale(scale):
+    n_students, n_practices = scale.lower().split("x")
+    return int(n_students), int(n_practices)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline stages on synthetic rosters")
+    parser.add_argument("--scales", nargs="+", type=_parse_scale,
+                        default=DEFAULT_SCALES,
+                        help="students x practices, e.g. 500x50")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip the traced run measuring peak memory")
+    parser.add_argument("--output", help="write the JSON report to a file")
+    args = parser.parse_args(argv)
+
+    report = [benchmark_scale(n_students, n_practices, args.seed,
+                              not args.no_memory)
+              for n_students, n_practices in args.scales]
+    report_json = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as report_file:
+            report_file.write(report_json)
+    print(report_json)
+    return report
+
+
+if __name__ == "__main__":
+    main()
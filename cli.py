@@ -0,0 +1,111 @@
+"""Command line entry point with the geocode, fetch, score, assign and
+query subcommands
+
+Only argparse and the configuration are imported at startup, every
+subcommand imports the modules it needs when it runs.
+"""
+import argparse
+from config import get_config
+
+# settings of config.json and the environment used as option defaults, so
+# every subcommand fingerprints the stages with the same options
+PIPELINE_SETTINGS = ["workers", "chunk_size", "binary", "incremental",
+                     "offline", "prune_minutes", "prune_nearest",
+                     "shard_prefix", "shard_border", "api_workers",
+                     "requests_per_second", "top_k"]
+
+# last stage run by each pipeline subcommand
+SUBCOMMAND_STAGES = {"fetch": "fetch_distances",
+                     "score": "extract_best_weights",
+                     "assign": "optimal_assignment"}
+
+
+def run_stages(args):
+    import main
+    assignment = "optimal" if args.subcommand == "assign" else "greedy"
+    return main.run_pipeline(args, assignment,
+                             until=SUBCOMMAND_STAGES[args.subcommand])
+
+
+def run_query(args):
+    import query_service
+    return query_service.main((["--binary"] if args.binary else []) +
+                              args.command)
+
+
+def run_geocode(args, client=None):
+    """
+    Geocode the student and practice addresses missing from the geocode
+    table, which the offline estimates and the pruning are computed from.
+    :param args: parsed arguments
+    :param client: object with a googlemaps compatible geocode method, a
+    googlemaps.Client is created from the api key if None
+    :return: number of addresses added
+    """
+    import pandas as pd
+    from data_store import DataStore, ADDRESS_SLOTS
+    from distance_estimator import update_geocodes
+    ds = DataStore()
+    ds.read_practices_from_csv_file("data/practices.csv")
+    ds.read_students_from_csv_file("data/students.csv")
+    addresses = [address for address in
+                 ds.df_students[ADDRESS_SLOTS].to_numpy().ravel().tolist() +
+                 ds.df_practices['address'].tolist() if pd.notna(address)]
+    if client is None:
+        import googlemaps
+        client = googlemaps.Client(key=get_config()['api_key'])
+    return update_geocodes(client, addresses, args.output)
+
+
+def build_parser(config):
+    """
+    Build the parser of all subcommands.
+    :param config: dict of settings
+    :return: argparse.ArgumentParser
+    """
+    import main
+    defaults = {name: config[name] for name in PIPELINE_SETTINGS
+                if name in config}
+
+    parser = argparse.ArgumentParser(
+        description="Assign medical students to practices")
+    subparsers = parser.add_subparsers(dest="subcommand", required=True)
+    descriptions = {
+        "fetch": "fetch the routes of all student practice addresses",
+        "score": "score all pairs and extract the best practice of every "
+                 "student",
+        "assign": "assign students to practices optimally",
+    }
+    for name, description in descriptions.items():
+        subparser = subparsers.add_parser(name, help=description,
+                                          description=description)
+        main.add_pipeline_arguments(subparser)
+        subparser.set_defaults(func=run_stages, **defaults)
+
+    geocode_parser = subparsers.add_parser(
+        "geocode", help="geocode the addresses for the offline estimates")
+    geocode_parser.add_argument("--output", default="data/geocodes.csv",
+                                help="tab separated geocode table, only "
+                                "missing addresses are added")
+    geocode_parser.set_defaults(func=run_geocode)
+
+    query_parser = subparsers.add_parser(
+        "query", help="answer queries about single students and practices")
+    query_parser.add_argument("--binary", action="store_true",
+                              help="open the routes from the binary route "
+                              "matrix")
+    query_parser.add_argument("command", nargs=argparse.REMAINDER,
+                              help="single command, e.g. top S017 5, the "
+                              "shell is opened if missing")
+    query_parser.set_defaults(func=run_query,
+                              binary=defaults.get("binary", False))
+    return parser
+
+
+def main(argv=None):
+    args = build_parser(get_config()).parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    main()
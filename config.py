@@ -0,0 +1,56 @@
+"""Script containing the configuration shared by the entry points"""
+import json
+import os
+
+# coefficients of the duration, matching specialities and children terms
+# of the pair weight, which is divided by 100
+WEIGHT_COEFFICIENTS = (0.2, 99, 0.8)
+
+# prefix of the environment variables overriding config.json, e.g.
+# MSPS_API_KEY overrides api_key
+ENV_PREFIX = "MSPS_"
+
+
+def _parse_value(value):
+    """
+    Parse an environment variable as JSON, e.g. numbers and booleans, and
+    keep it as string otherwise.
+    :param value: string
+    :return: parsed value
+    """
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def load_config(path='config.json', environ=os.environ):
+    """
+    Load the settings of config.json, overridden by the MSPS_ environment
+    variables.
+    :param path: file path of config.json, skipped if it does not exist
+    :param environ: environment mapping
+    :return: dict of settings
+    """
+    settings = {}
+    if os.path.isfile(path):
+        with open(path) as json_data_file:
+            settings = json.load(json_data_file)
+    for name, value in environ.items():
+        if name.startswith(ENV_PREFIX):
+            settings[name[len(ENV_PREFIX):].lower()] = _parse_value(value)
+    return settings
+
+
+_loaded = None
+
+
+def get_config():
+    """
+    Get the settings of the current run, loaded on first use.
+    :return: dict of settings
+    """
+    global _loaded
+    if _loaded is None:
+        _loaded = load_config()
+    return _loaded
@@ -1,17 +1,34 @@
 """Script containing class for handling all data related functions"""
+import numpy as np
 import pandas as pd
 import os
+from specialties import SpecialtyIndex, load_specialty_vocabulary
+from address_book import AddressBook
+from instrumentation import get_instrumentation
+
+# student columns holding the main and alternative addresses
+ADDRESS_SLOTS = ['address', 'alternativeAddress1', 'alternativeAddress2']
 
 
 class DataStore:
     """Class incorporating functions for extracting students and practices."""
 
-    def __init__(self):
+    def __init__(self, specialties_path='data/specialties.ts'):
         """
         Initialize the datastore with two df variables.
+        :param specialties_path: file path of the specialty vocabulary
         """
         self.df_practices = pd.DataFrame()
         self.df_students = pd.DataFrame()
+        self.specialty_index = SpecialtyIndex(
+            load_specialty_vocabulary(specialties_path))
+        self.practice_specialties = np.zeros((0, 0), dtype=bool)
+        self.student_specialties = np.zeros((0, 0), dtype=bool)
+        # bool array of shape (S, P), False for pairs pruned before fetching
+        # their routes, all pairs are candidates if None
+        self.candidates = None
+        # addresses interned into int32 ids shared with the route table
+        self.address_book = AddressBook()
 
     def clear(self):
         """
@@ -44,6 +61,9 @@ class DataStore:
         """
         df = pd.read_csv(practice_csv_file, sep="\t")
         self.df_practices = df.set_index("id")
+        self.get_practice_address_ids()
+        self.practice_specialties = self._encode_specialties(
+            self.df_practices['specialties'], practice_csv_file)
 
     def read_students_from_csv_file(self, student_csv_file):
         """
@@ -54,79 +74,255 @@ class DataStore:
         """
         df = pd.read_csv(student_csv_file, sep="\t")
         self.df_students = df.set_index("id")
+        self.get_student_address_ids()
+        self.student_specialties = self._encode_specialties(
+            self.df_students['favoriteSpecialties'], student_csv_file)
 
-    def extract_addresses(self, stud_df, pract_df, is_bike):
+    def update_student(self, student_id, **values):
         """
-        Methdod to extract all addresses of students including alternate
+        Change columns of a student, re-encoding the specialties if they
+        are among them.
+        :param student_id: id of the student
+        :param values: new values by column name
+        :return: position of the student
+        """
+        position = self.df_students.index.get_loc(student_id)
+        for column, value in values.items():
+            self.df_students.loc[student_id, column] = value
+
+        if 'favoriteSpecialties' in values:
+            row = self.specialty_index.encode([values['favoriteSpecialties']])
+            self.student_specialties = self.specialty_index.pad(
+                self.student_specialties)
+            self.student_specialties[position] = row[0]
+        return position
+
+    def get_student_address_ids(self):
+        """
+        Gets the interned ids of the student addresses.
+        :return: int32 array of shape (S, 3), -1 for missing alternatives
+        """
+        return self.address_book.intern(
+            self.df_students[ADDRESS_SLOTS].to_numpy(dtype=object))
+
+    def get_practice_address_ids(self):
+        """
+        Gets the interned ids of the practice addresses.
+        :return: int32 array of shape (P,)
+        """
+        return self.address_book.intern(
+            self.df_practices['address'].to_numpy(dtype=object))
+
+    def select_students(self, positions):
+        """
+        Make a datastore holding only some of the students, sharing the
+        practices and the specialty index with this one.
+        :param positions: positions or slice of the students to keep
+        :return: DataStore
+        """
+        shard = DataStore.__new__(DataStore)
+        shard.df_practices = self.df_practices
+        shard.practice_specialties = self.practice_specialties
+        shard.specialty_index = self.specialty_index
+        shard.address_book = self.address_book
+        shard.df_students = self.df_students.iloc[positions]
+        shard.student_specialties = self.student_specialties[positions]
+        shard.candidates = None if self.candidates is None \
+            else self.candidates[positions]
+        return shard
+
+    def select_practices(self, positions):
+        """
+        Make a datastore holding only some of the practices, sharing the
+        students and the specialty index with this one.
+        :param positions: positions or slice of the practices to keep
+        :return: DataStore
+        """
+        shard = DataStore.__new__(DataStore)
+        shard.df_students = self.df_students
+        shard.student_specialties = self.student_specialties
+        shard.specialty_index = self.specialty_index
+        shard.address_book = self.address_book
+        shard.df_practices = self.df_practices.iloc[positions]
+        shard.practice_specialties = self.practice_specialties[positions]
+        shard.candidates = None if self.candidates is None \
+            else self.candidates[:, positions]
+        return shard
+
+    def _encode_specialties(self, specialties, csv_file):
+        """
+        Encode a specialties column against the specialty vocabulary and
+        report names which are not part of it.
+        :param specialties: series of comma separated strings
+        :param csv_file: file the column was read from, for the report
+        :return: bool array with one row per entry
+        """
+        n_known = len(self.specialty_index.unknown)
+        matrix = self.specialty_index.encode(specialties)
+        unknown = self.specialty_index.unknown[n_known:]
+        if unknown:
+            print("Unknown specialties in {}: {}".format(
+                csv_file, ", ".join(unknown)))
+        return matrix
+
+    def get_match_counts(self):
+        """
+        Count the matching specialties of every student against every
+        practice with a single matrix product.
+        :return: int array of shape (S, P)
+        """
+        students = self.specialty_index.pad(self.student_specialties)
+        practices = self.specialty_index.pad(self.practice_specialties)
+        return students.astype(np.int32) @ practices.T.astype(np.int32)
+
+    def extract_address_frame(self, stud_df, pract_df, is_bike,
+                              candidates=None):
+        """
+        Method to extract all addresses of students including alternate
         addresses of the students and make combinations against all practice
-        adresses.
+        adresses as a dataframe.
 
-        This method helps to create a new address csv file from which addresses
-        can be directly queried using student address as the source and
-        practice address as the destination address. Returns a list of
-        student addresses against practice addresses
+        The addresses are interned and combined as integer ids, only the
+        result is decoded back into address strings. Rows are ordered by
+        student, then practice, then main before alternative addresses.
         :param stud_df: df
         :param pract_df: df
         :param is_bike: if True, all combinations will be made considering
         bike as the mode of transport even for people having car
-        :return: list
+        :param candidates: bool array of shape (S, P), only the addresses of
+        candidate pairs are combined if given
+        :return: df with stud_add, prac_add and is_car
+        """
+        id_df = self._extract_address_ids(
+            stud_df, self.address_book.intern(
+                stud_df[ADDRESS_SLOTS].to_numpy(dtype=object)),
+            self.address_book.intern(
+                pract_df['address'].to_numpy(dtype=object)),
+            is_bike, candidates)
+        return self._decode_address_frame(id_df)
+
+    def _extract_address_ids(self, stud_df, stud_ids, prac_ids, is_bike,
+                             candidates=None):
+        """
+        Combine the address ids of the students with the practices.
+        :param stud_df: df
+        :param stud_ids: int32 array of shape (S, 3) of the student addresses
+        :param prac_ids: int32 array of shape (P,) of the practice addresses
+        :param is_bike: if False, only students having car are combined
+        :param candidates: bool array of shape (S, P) or None
+        :return: df with stud_id, prac_id and is_car
         """
-        addr_list = []
         # make bike combinations even for people having car
         has_car = 0
 
         if not is_bike:
             # make combinations for people having car only
-            stud_df = stud_df[stud_df['hasCar'] == 1]
+            without_car = (stud_df['hasCar'] != 1).to_numpy()
+            stud_ids = np.where(without_car[:, None], -1, stud_ids)
             has_car = 1
 
-        for i in range(len(stud_df)):
-            stud_df_row = stud_df.loc[stud_df.index[i]]
+        # students x practices x slots, the order of the rows
+        shape = (len(stud_ids), len(prac_ids), len(ADDRESS_SLOTS))
+        stud_grid = np.broadcast_to(stud_ids[:, None, :], shape)
+        keep = stud_grid >= 0
+        if candidates is not None:
+            keep &= candidates[:, :, None]
 
-            for j in range(len(pract_df)):
-                pract_df_row = pract_df.loc[pract_df.index[j]]
+        return pd.DataFrame({
+            'stud_id': stud_grid[keep],
+            'prac_id': np.broadcast_to(prac_ids[None, :, None], shape)[keep],
+            'is_car': has_car})
 
-                # main address against practice address
-                df_list_main = [stud_df_row['address'],
-                                pract_df_row['address'],
-                                has_car]
-                addr_list.append(df_list_main)
+    def _decode_address_frame(self, id_df):
+        """
+        Decode an address id frame into address strings.
+        :param id_df: df with stud_id, prac_id and is_car
+        :return: df with stud_add, prac_add and is_car
+        """
+        return pd.DataFrame({
+            'stud_add': self.address_book.decode(id_df['stud_id'].to_numpy()),
+            'prac_add': self.address_book.decode(id_df['prac_id'].to_numpy()),
+            'is_car': id_df['is_car'].to_numpy()})
 
-                # alternate address against practice address
-                if not pd.isna(stud_df_row['alternativeAddress1']):
-                    df_list_main = [stud_df_row['alternativeAddress1'],
-                                    pract_df_row['address'],
-                                    has_car]
-                    addr_list.append(df_list_main)
+    def extract_addresses(self, stud_df, pract_df, is_bike):
+        """
+        Methdod to extract all addresses of students including alternate
+        addresses of the students and make combinations against all practice
+        adresses.
 
-                if not pd.isna(stud_df_row['alternativeAddress2']):
-                    df_list_main = [stud_df_row['alternativeAddress2'],
-                                    pract_df_row['address'],
-                                    has_car]
-                    addr_list.append(df_list_main)
-        return addr_list
+        This method helps to create a new address csv file from which addresses
+        can be directly queried using student address as the source and
+        practice address as the destination address. Returns a list of
+        student addresses against practice addresses
+        :param stud_df: df
+        :param pract_df: df
+        :param is_bike: if True, all combinations will be made considering
+        bike as the mode of transport even for people having car
+        :return: list
+        """
+        return self.extract_address_frame(stud_df, pract_df,
+                                          is_bike).values.tolist()
 
-    def create_address_csv_file(self):
+    def build_address_frame(self):
+        """
+        Make all bike and car combinations of student addresses against
+        practice addresses, keeping each origin, destination and mode once
+        so students sharing an address do not cause duplicate API calls.
+        Pairs pruned from the candidates are left out.
+        :return: df with stud_add, prac_add and is_car
+        """
+        frames = [self._extract_address_ids(
+            self.df_students, self.get_student_address_ids(),
+            self.get_practice_address_ids(), is_bike, self.candidates)
+            for is_bike in [True, False]]
+
+        return self._decode_address_frame(
+            pd.concat(frames, ignore_index=True).drop_duplicates(
+                ignore_index=True))
+
+    def create_address_csv_file(self, address_path="data/addresses.csv",
+                                address_df=None):
         """
         Creates the csv file addresses.csv by making all possible combinations
         of student addresses against practice addresses.
+        :param address_path: file path for the address file
+        :param address_df: df with stud_add, prac_add and is_car written
+        instead of all combinations, e.g. of a sharded run
         :return:
         """
         print("Creating addresses.csv file")
 
-        if os.path.isfile("data/addresses.csv"):
+        if os.path.isfile(address_path):
             print("Address file already exists")
             return
 
-        bike_addr_list = self.extract_addresses(self.df_students,
-                                                self.df_practices,
-                                                is_bike=True)
-        car_addr_list = self.extract_addresses(self.df_students,
-                                               self.df_practices,
-                                               is_bike=False)
+        df = self.build_address_frame() if address_df is None else address_df
+        df.to_csv(address_path, sep="\t", index=False)
+        get_instrumentation().incr("rows_written", len(df))
+        print("File saved at " + address_path)
 
-        df = pd.DataFrame(bike_addr_list + car_addr_list,
-                          columns=['stud_add', 'prac_add', 'is_car'])
+    def update_address_csv_file(self, address_df,
+                                address_path="data/addresses.csv"):
+        """
+        Append the routes of address_df missing from an existing address
+        file, leaving their distance and duration empty so only they are
+        fetched from the API.
+        :param address_df: df with stud_add, prac_add and is_car
+        :param address_path: file path for the address file
+        :return: number of appended rows
+        """
+        keys = ['stud_add', 'prac_add', 'is_car']
+        columns = pd.read_csv(address_path, sep="\t", nrows=0).columns
+        known = pd.read_csv(address_path, sep="\t", usecols=keys)
 
-        df.to_csv("data/addresses.csv", sep="\t", index=False)
-        print("File saved at data/addresses.csv")
+        new_df = address_df[keys].merge(known.drop_duplicates(), how='left',
+                                        on=keys, indicator=True)
+        new_df = new_df[new_df['_merge'] == 'left_only'].reindex(
+            columns=columns)
+        if len(new_df):
+            new_df.to_csv(address_path, sep="\t", index=False, header=False,
+                          mode="a")
+            get_instrumentation().incr("rows_written", len(new_df))
+        print("{} new routes appended to {}".format(len(new_df),
+                                                    address_path))
+        return len(new_df)
@@ -0,0 +1,161 @@
+"""Script containing the offline estimator of route distances and durations"""
+import os
+import numpy as np
+import pandas as pd
+from route_cache import normalize_address
+
+# status of routes estimated offline, replaced when fetched from the API
+ESTIMATED_STATUS = "ESTIMATED"
+
+# status of routes with an address missing from the geocode table
+NOT_GEOCODED_STATUS = "NOT_GEOCODED"
+
+# mean radius of the earth in meters
+EARTH_RADIUS = 6371008.8
+
+# average travel speeds in meters per second
+SPEEDS = {"bicycling": 4.2, "driving": 8.3}
+
+# ratio of road distance to straight line distance in a city
+DETOUR_FACTOR = 1.3
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Compute the great circle distance between coordinates, broadcasting
+    numpy arrays.
+    :param lat1: latitude of the origins in degrees
+    :param lon1: longitude of the origins in degrees
+    :param lat2: latitude of the destinations in degrees
+    :param lon2: longitude of the destinations in degrees
+    :return: distance in meters
+    """
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+class HaversineEstimator:
+    """Distance provider estimating routes from geocoded addresses instead
+    of querying the Distance Matrix API.
+
+    Distances are the straight line distance times a detour factor and
+    durations divide them by an average speed per travel mode. Routes with
+    an address missing from the geocode table get no distance or duration.
+    """
+
+    def __init__(self, geocodes, speeds=None, detour_factor=DETOUR_FACTOR):
+        """
+        Initialize the estimator.
+        :param geocodes: df with address, lat and lon columns
+        :param speeds: dict of travel mode to meters per second
+        :param detour_factor: ratio of road to straight line distance
+        """
+        geocodes = geocodes.assign(
+            key=geocodes['address'].map(normalize_address))\
+            .drop_duplicates(subset='key')
+        self.coordinates = geocodes.set_index('key')[['lat', 'lon']]
+        self.speeds = dict(SPEEDS, **(speeds or {}))
+        self.detour_factor = detour_factor
+
+    @classmethod
+    def from_csv(cls, geocode_path='data/geocodes.csv', **kwargs):
+        """
+        Create the estimator from a tab separated geocode table.
+        :param geocode_path: file path with address, lat and lon columns
+        :return: HaversineEstimator
+        :raises FileNotFoundError: if the geocode table does not exist
+        """
+        if not os.path.isfile(geocode_path):
+            raise FileNotFoundError(
+                "No geocode table at {}, run python cli.py geocode with an "
+                "api key first".format(geocode_path))
+        return cls(pd.read_csv(geocode_path, sep="\t"), **kwargs)
+
+    def locate(self, addresses):
+        """
+        Look up the coordinates of addresses.
+        :param addresses: iterable of address strings
+        :return: float arrays of latitudes and longitudes, NaN if unknown
+        """
+        keys = [normalize_address(address) for address in addresses]
+        located = self.coordinates.reindex(keys).to_numpy(dtype=float)
+        return located[:, 0], located[:, 1]
+
+    def estimate_matrix(self, origins, destinations, mode):
+        """
+        Estimate the routes of all origins against all destinations at
+        once.
+        :param origins: list of A origin addresses
+        :param destinations: list of B destination addresses
+        :param mode: "bicycling" or "driving"
+        :return: float arrays of shape (A, B) with the distances in meters
+        and durations in seconds, NaN where an address is unknown
+        """
+        orig_lat, orig_lon = self.locate(origins)
+        dest_lat, dest_lon = self.locate(destinations)
+        distances = self.detour_factor * haversine(
+            orig_lat[:, None], orig_lon[:, None], dest_lat, dest_lon)
+        return distances, distances / self.speeds[mode]
+
+    def fetch_routes(self, df_routes, cache=None):
+        """
+        Estimate the routes of the address df, taking the place of
+        GoogleAPI._fetch_routes. Estimates are never stored in the cache.
+        :param df_routes: df with stud_add, prac_add and is_car
+        :param cache: unused
+        :return: dict from (origin, destination, mode) to (distance,
+        duration, status)
+        """
+        print("Estimating {} routes offline...".format(len(df_routes)))
+        orig_lat, orig_lon = self.locate(df_routes['stud_add'])
+        dest_lat, dest_lon = self.locate(df_routes['prac_add'])
+        is_car = df_routes['is_car'].to_numpy(dtype=bool)
+        speeds = np.where(is_car, self.speeds["driving"],
+                          self.speeds["bicycling"])
+
+        # whole meters and seconds like the API returns
+        distances = np.round(self.detour_factor * haversine(
+            orig_lat, orig_lon, dest_lat, dest_lon))
+        durations = np.round(distances / speeds)
+        statuses = np.where(np.isnan(distances), NOT_GEOCODED_STATUS,
+                            ESTIMATED_STATUS)
+
+        modes = np.where(is_car, "driving", "bicycling")
+        return {key: (distance, duration, status)
+                for key, distance, duration, status in zip(
+                    zip(df_routes['stud_add'], df_routes['prac_add'], modes),
+                    distances, durations, statuses)}
+
+
+def update_geocodes(client, addresses, geocode_path='data/geocodes.csv'):
+    """
+    Geocode the addresses missing from the geocode table with a single
+    request each and append them to it.
+    :param client: object with a googlemaps compatible geocode method
+    :param addresses: iterable of address strings
+    :param geocode_path: file path of the tab separated geocode table
+    :return: number of addresses added
+    """
+    known = set()
+    if os.path.isfile(geocode_path):
+        known = set(pd.read_csv(geocode_path, sep="\t")['address']
+                    .map(normalize_address))
+
+    rows = []
+    for address in dict.fromkeys(addresses):
+        if normalize_address(address) in known:
+            continue
+        results = client.geocode(address)
+        if results:
+            location = results[0]['geometry']['location']
+            rows.append([address, location['lat'], location['lng']])
+        known.add(normalize_address(address))
+
+    if rows:
+        pd.DataFrame(rows, columns=['address', 'lat', 'lon']).to_csv(
+            geocode_path, sep="\t", index=False, mode="a",
+            header=not os.path.isfile(geocode_path))
+    print("{} addresses geocoded".format(len(rows)))
+    return len(rows)
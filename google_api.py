@@ -1,74 +1,368 @@
 """Script containing necessary functions for fetching result from API"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import random
+import threading
+import time
+import numpy as np
 import pandas as pd
-import googlemaps
+from route_cache import FINAL_STATUSES
+from distance_estimator import ESTIMATED_STATUS
+from instrumentation import get_instrumentation
+
+# limits of a single Distance Matrix request
+MAX_ELEMENTS_PER_REQUEST = 100
+MAX_ADDRESSES_PER_SIDE = 25
+
+# request level statuses that are worth retrying after a backoff
+RETRIABLE_STATUSES = {"OVER_QUERY_LIMIT", "UNKNOWN_ERROR"}
+
+
+class RateLimiter:
+    """Thread safe limiter spacing calls to a maximum rate per second."""
+
+    def __init__(self, requests_per_second=None, clock=time.monotonic,
+                 sleep=time.sleep):
+        """
+        Initialize the limiter.
+        :param requests_per_second: maximum rate, unlimited if None
+        :param clock: monotonic clock function
+        :param sleep: sleep function
+        """
+        self.interval = 1.0 / requests_per_second \
+            if requests_per_second else 0.0
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def acquire(self):
+        """
+        Block until the next request is allowed.
+        :return:
+        """
+        if not self.interval:
+            return
+        with self._lock:
+            now = self._clock()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if wait > 0:
+            self._sleep(wait)
+
+
+def get_travel_mode(is_car):
+    """
+    Get the Distance Matrix travel mode of a route.
+    :param is_car:
+    :return: mode string
+    """
+    return "driving" if is_car else "bicycling"
+
+
+def _chunk(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def build_request_tiles(df_addresses,
+                        max_elements=MAX_ELEMENTS_PER_REQUEST,
+                        max_per_side=MAX_ADDRESSES_PER_SIDE):
+    """
+    Pack the routes of the address df into Distance Matrix requests.
+
+    Rows are grouped by travel mode, and the origins of a mode by the
+    destinations they need, so that no element is billed for a route which
+    is not needed, e.g. after pruning. The origins of a group are split into
+    chunks and their destinations so that every tile stays within the
+    elements per request and addresses per side limits of the API.
+    :param df_addresses: df with stud_add, prac_add and is_car
+    :param max_elements: maximum origins x destinations per request
+    :param max_per_side: maximum origins or destinations per request
+    :return: list of (mode, origins, destinations) tuples
+    """
+    tiles = []
+    routes = df_addresses[['stud_add', 'prac_add', 'is_car']]\
+        .drop_duplicates()
+
+    for is_car, mode_routes in routes.groupby('is_car', sort=True):
+        mode = get_travel_mode(is_car)
+        origins_by_dests = {}
+        for origin, dests in mode_routes.groupby('stud_add', sort=False)[
+                'prac_add'].agg(tuple).items():
+            origins_by_dests.setdefault(dests, []).append(origin)
+
+        for dests, origins in origins_by_dests.items():
+            n_dests = min(max_per_side, len(dests), max_elements)
+            n_origins = max(1, min(max_per_side, max_elements // n_dests))
+            for origin_chunk in _chunk(origins, n_origins):
+                for dest_chunk in _chunk(list(dests), n_dests):
+                    tiles.append((mode, origin_chunk, dest_chunk))
+    return tiles
+
+
+def _routes_to_fetch(df_addresses, replace_estimates=True):
+    """
+    Find the rows of the address df still missing a distance or duration
+    and not known to be unroutable.
+    :param df_addresses:
+    :param replace_estimates: if True, routes estimated offline are fetched
+    too
+    :return: boolean series
+    """
+    if not {'distance', 'duration'}.issubset(df_addresses.columns):
+        return pd.Series(True, index=df_addresses.index)
+
+    missing = df_addresses['distance'].isna() | df_addresses['duration'].isna()
+    if 'status' in df_addresses.columns:
+        missing &= ~df_addresses['status'].isin(FINAL_STATUSES - {"OK"})
+        if replace_estimates:
+            missing |= df_addresses['status'] == ESTIMATED_STATUS
+    return missing
+
+
+def count_routes_to_fetch(dist_csv, replace_estimates=True):
+    """
+    Count the routes of the address file still missing, including those
+    which failed with over quota or transient errors.
+    :param dist_csv: file path for the address file
+    :param replace_estimates: if True, routes estimated offline are counted
+    :return: number of routes, 0 if the address file does not exist
+    """
+    if not os.path.isfile(dist_csv):
+        return 0
+    return int(_routes_to_fetch(pd.read_csv(dist_csv, sep="\t"),
+                                replace_estimates).sum())
+
+
+def _api_errors():
+    """
+    Get the exceptions of failed requests. googlemaps is only imported once
+    a request fails, so runs without API calls never load it.
+    :return: tuple of exception classes
+    """
+    from googlemaps.exceptions import ApiError, Timeout, TransportError
+    return ApiError, Timeout, TransportError
+
+
+def _is_retriable(error):
+    """
+    Check if a failed request should be retried.
+    :param error: exception raised by the client
+    :return:
+    """
+    ApiError, Timeout, TransportError = _api_errors()
+    if isinstance(error, ApiError):
+        return error.status in RETRIABLE_STATUSES
+    return isinstance(error, (Timeout, TransportError))
 
 
 class GoogleAPI:
 
-    def __init__(self, api_key=None):
+    def __init__(self, api_key=None, client=None, max_workers=1,
+                 requests_per_second=None, max_retries=5, backoff_base=1.0,
+                 provider=None):
+        """
+        Initialize the api wrapper.
+        :param api_key: Google Maps api key
+        :param client: object with a googlemaps compatible distance_matrix
+        method, a googlemaps.Client is created from the key if None
+        :param max_workers: number of requests sent concurrently
+        :param requests_per_second: rate limit over all workers, unlimited
+        if None
+        :param max_retries: retries of a request failing with an over quota
+        or transient error before its routes are recorded as failed
+        :param backoff_base: seconds waited before the first retry, doubled
+        on each further retry
+        :param provider: distance provider with a fetch_routes method like
+        _fetch_routes, e.g. a HaversineEstimator, used instead of the API.
+        Routes it estimated are replaced once fetched without a provider
+        """
         self.api_key = api_key
+        self.client = client
+        self.max_workers = max_workers
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.provider = provider
+        self._sleep = time.sleep
+
+    def _get_client(self):
+        if self.client is None:
+            import googlemaps
+            self.client = googlemaps.Client(key=self.api_key)
+        return self.client
 
     def _data_fetched_already(self, dist_csv):
         """
-        Check if duration and distances already exist in the address file
+        Check if duration and distances already exist for every route in the
+        address file
         :param dist_csv:
         :return:
         """
         df_addresses = pd.read_csv(dist_csv, sep="\t")
-        if 'distance' and 'duration' in df_addresses.columns:
+        if not self._routes_to_fetch(df_addresses).any():
             print("Data already fetched before. Not calling API")
             return True
 
         return False
 
-    def fetch_distances_from_api(self, dist_csv):
+    def _routes_to_fetch(self, df_addresses):
+        return _routes_to_fetch(df_addresses,
+                                replace_estimates=self.provider is None)
+
+    def _request_tile(self, client, tile):
+        """
+        Send the request of a tile, retrying over quota and transient errors
+        with exponential backoff.
+        :param client: googlemaps compatible client
+        :param tile: (mode, origins, destinations) tuple
+        :return: distance matrix response
+        """
+        mode, origins, dests = tile
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            get_instrumentation().incr("api_calls")
+            if attempt:
+                get_instrumentation().incr("api_retries")
+            try:
+                return client.distance_matrix(origins, dests, mode=mode)
+            except _api_errors() as error:
+                if not _is_retriable(error) or attempt == self.max_retries:
+                    raise
+                delay = self.backoff_base * (2 ** attempt)
+                self._sleep(delay * (1 + random.random()) / 2)
+
+    def _query_tile(self, client, tile):
+        """
+        Query a single tile and map its elements back to routes.
+
+        Elements that could not be routed, and all elements of a request that
+        kept failing after the retries, are recorded with their status and
+        no distance or duration.
+        :param client: googlemaps compatible client
+        :param tile: (mode, origins, destinations) tuple
+        :return: dict from (origin, destination, mode) to (distance,
+        duration, status)
+        """
+        mode, origins, dests = tile
+        try:
+            matrix = self._request_tile(client, tile)
+        except _api_errors() as error:
+            if not _is_retriable(error):
+                raise
+            status = getattr(error, 'status', None) or type(error).__name__
+            return {(origin, dest, mode): (np.nan, np.nan, status)
+                    for origin in origins for dest in dests}
+
+        results = {}
+        for origin, row in zip(origins, matrix['rows']):
+            for dest, element in zip(dests, row['elements']):
+                status = element.get('status', 'OK')
+                if status == 'OK':
+                    results[(origin, dest, mode)] = (
+                        element['distance']['value'],
+                        element['duration']['value'], status)
+                else:
+                    results[(origin, dest, mode)] = (np.nan, np.nan, status)
+        return results
+
+    def fetch_distances_from_api(self, dist_csv, cache=None):
         """
         Compute distance and durations of already saved address csv file from
         API.
 
-        This method queries the api and
-        saves the distances and durations in the already existing
-        csv file so that the api doesn't have to be queried again and again.
+        This method queries the api with batched requests of many origins
+        and destinations and saves the distances and durations in the already
+        existing csv file so that the api doesn't have to be queried again
+        and again. The status of every route is saved next to them, routes
+        which could not be fetched have no distance and duration.
+
+        Only routes without a final status are requested, so a run which
+        failed part way is completed on the next call. If a cache is given,
+        routes found in it are not requested and fetched routes are added
+        to it.
         :param dist_csv:
+        :param cache: RouteCache or None
         :return:
         """
         # check if api has already been called before
-        if not self._data_fetched_already(dist_csv):
-            client = googlemaps.Client(key=self.api_key)
-            df_addresses = pd.read_csv(dist_csv, sep="\t")
-
-            dists = []
-            durations = []
-            print("Calling API...")
-
-            # iterate over all the addresses of the dataframe and query the api
-            # iteratively
-            for index, df_row in df_addresses.iterrows():
-                origin = df_row['stud_add']
-                dest = df_row['prac_add']
-
-                if df_row['is_car']:
-                    mode = "driving"
-                else:
-                    mode = "bicycling"
+        if self._data_fetched_already(dist_csv):
+            return
+
+        df_addresses = pd.read_csv(dist_csv, sep="\t")
+        for column in ['distance', 'duration']:
+            if column not in df_addresses.columns:
+                df_addresses[column] = np.nan
+        status = df_addresses['status'] if 'status' in df_addresses.columns \
+            else pd.Series(np.nan, index=df_addresses.index, dtype=object)
+        df_addresses['status'] = status.astype(object).where(
+            status.notna() | df_addresses['duration'].isna(), 'OK')
 
-                # query the api
-                matrix = client.distance_matrix(origin, dest,
-                                                mode=mode)
-                dist_metrs = matrix['rows'][0]['elements'][0]["distance"][
-                    'value']
-                duration_secs = matrix['rows'][0]['elements'][0]["duration"][
-                    'value']
+        todo = self._routes_to_fetch(df_addresses)
+        keys = [(origin, dest, get_travel_mode(is_car))
+                for origin, dest, is_car in zip(df_addresses['stud_add'],
+                                                df_addresses['prac_add'],
+                                                df_addresses['is_car'])]
 
-                # append extracted values from api in a list
-                dists.append(dist_metrs)
-                durations.append(duration_secs)
+        results = {}
+        if cache is not None:
+            results.update(cache.get_many(
+                key for key, needed in zip(keys, todo) if needed))
+            todo &= np.array([key not in results for key in keys])
+            print("{} routes found in the route cache".format(len(results)))
+            get_instrumentation().incr("cache_hits", len(results))
 
-            # add these list in the dataframe
-            df_addresses['distance'] = dists
-            df_addresses['duration'] = durations
+        if todo.any():
+            fetch_routes = self.provider.fetch_routes if self.provider \
+                else self._fetch_routes
+            results.update(fetch_routes(df_addresses[todo], cache))
 
-            # save the dataframe back to its place
-            df_addresses.to_csv(dist_csv, sep='\t', index=False)
+        # map the tiled responses back onto the rows still to be fetched
+        rows = todo.index[self._routes_to_fetch(df_addresses)]
+        for column, position in [('distance', 0), ('duration', 1),
+                                 ('status', 2)]:
+            df_addresses.loc[rows, column] = [
+                results[keys[row]][position] for row in rows]
+
+        # keep whole meters and seconds free of a decimal point in the file
+        for column in ['distance', 'duration']:
+            values = df_addresses[column].astype(float)
+            if (values.dropna() % 1 == 0).all():
+                df_addresses[column] = values.astype('Int64')
+
+        # save the dataframe back to its place
+        df_addresses.to_csv(dist_csv, sep='\t', index=False)
+        get_instrumentation().incr("rows_written", len(df_addresses))
+
+        failed = (~df_addresses['status'].isin(
+            ['OK', ESTIMATED_STATUS])).sum()
+        if failed:
+            print("{} routes could not be fetched, see the status "
+                  "column".format(failed))
+        print("Durations fetched.")
+
+    def _fetch_routes(self, df_routes, cache=None):
+        """
+        Fetch routes from the API, storing each tile in the cache as soon as
+        it arrives.
+        :param df_routes: df with stud_add, prac_add and is_car
+        :param cache: RouteCache or None
+        :return: dict from (origin, destination, mode) to (distance,
+        duration, status)
+        """
+        client = self._get_client()
+        tiles = build_request_tiles(df_routes)
+        print("Calling API with {} requests for {} routes...".format(
+            len(tiles), len(df_routes)))
+        get_instrumentation().incr("routes_requested", len(df_routes))
 
-            print("Durations fetched.")
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = [pool.submit(self._query_tile, client, tile)
+                       for tile in tiles]
+            for future in as_completed(futures):
+                tile_results = future.result()
+                if cache is not None:
+                    cache.put_many(tile_results)
+                results.update(tile_results)
+        return results
@@ -0,0 +1,407 @@
+"""Script containing the change detection of incremental pipeline runs"""
+import json
+import os
+import numpy as np
+import pandas as pd
+from weight_engine import WeightMatrix, PAIR_COLUMNS
+from instrumentation import get_instrumentation
+
+
+def row_hashes(df):
+    """
+    Hash the content of every row of a students or practices df.
+    :param df: df indexed by id
+    :return: dict of id to hex digest
+    """
+    hashes = pd.util.hash_pandas_object(df, index=True)
+    return {str(i): format(h, "016x") for i, h in hashes.items()}
+
+
+def route_hashes(lookup):
+    """
+    Hash every route of a duration lookup, keyed by its addresses and mode,
+    which change when estimates are replaced by fetched routes or the cache
+    is refreshed.
+    :param lookup: DurationLookup with the durations of the current run
+    :return: uint64 arrays of shape (A, 2, B) with the key of every route
+    and the hash of its duration
+    """
+    stud_hashes = pd.util.hash_array(
+        lookup.address_book.decode(lookup.stud_ids).astype(object))
+    prac_hashes = pd.util.hash_array(
+        lookup.address_book.decode(lookup.prac_ids).astype(object))
+    modes = pd.util.hash_array(
+        np.add.outer(stud_hashes, np.arange(2, dtype=np.uint64)).ravel())
+    keys = pd.util.hash_array(
+        (modes[:, None] ^ prac_hashes[None, :]).ravel())
+    durations = np.nan_to_num(np.asarray(lookup.durations, dtype=float),
+                              nan=-1.0)
+    values = pd.util.hash_array(durations.ravel().view(np.uint64))
+    shape = lookup.durations.shape
+    return keys.reshape(shape), values.reshape(shape)
+
+
+def _pairs_path(path):
+    return os.path.splitext(path)[0] + "_pairs.npz"
+
+
+class RunManifest:
+    """Content hashes of the students and practices a run was computed
+    from, with the longest route duration its weights depend on, the route
+    hashes and where the pairs of every student are in the pairs file."""
+
+    def __init__(self, students, practices, max_duration=None, routes=None,
+                 scored=None, offsets=None):
+        """
+        Initialize the manifest.
+        :param students: dict of student id to row hash
+        :param practices: dict of practice id to row hash
+        :param max_duration: longest duration of the route table
+        :param routes: sorted uint64 arrays of the keys and duration hashes
+        of the routes in the table, None if unknown
+        :param scored: bool array of shape (S, P), True for the pairs in
+        the pairs file, None if unknown
+        :param offsets: int array of the S + 1 byte offsets of the pairs of
+        every student in the pairs file, after the header, None if unknown
+        """
+        self.students = students
+        self.practices = practices
+        self.max_duration = max_duration
+        self.routes = routes
+        self.scored = scored
+        self.offsets = offsets
+        # cell of the duration lookup of every route, for the current run
+        self.route_cells = None
+
+    @classmethod
+    def from_data_store(cls, data_store, max_duration=None, lookup=None):
+        """
+        Hash the students and practices of a datastore.
+        :param data_store:
+        :param max_duration: longest duration of the route table
+        :param lookup: DurationLookup the route hashes are computed from,
+        none are computed if None
+        :return: RunManifest
+        """
+        manifest = cls(row_hashes(data_store.df_students),
+                       row_hashes(data_store.df_practices), max_duration)
+        if lookup is not None:
+            keys, values = route_hashes(lookup)
+            # the routes in the table sorted by key, with their cell of the
+            # lookup
+            cells = np.flatnonzero(lookup.present)
+            order = np.argsort(keys.ravel()[cells])
+            manifest.route_cells = cells[order]
+            manifest.routes = (keys.ravel()[manifest.route_cells],
+                               values.ravel()[manifest.route_cells])
+            manifest.scored = data_store.candidates
+            if manifest.scored is None:
+                manifest.scored = np.ones((len(data_store.df_students),
+                                           len(data_store.df_practices)),
+                                          dtype=bool)
+        return manifest
+
+    @classmethod
+    def load(cls, path='data/manifest.json', pairs=True):
+        """
+        Read a saved manifest and the route hashes and pair offsets saved
+        next to it.
+        :param path: file path of the manifest
+        :param pairs: if False, only read the row hashes
+        :return: RunManifest, None if the file does not exist
+        """
+        if not os.path.isfile(path):
+            return None
+        with open(path, encoding="utf-8") as manifest_file:
+            data = json.load(manifest_file)
+        manifest = cls(data["students"], data["practices"],
+                       data.get("max_duration"))
+        if pairs and os.path.isfile(_pairs_path(path)):
+            with np.load(_pairs_path(path)) as arrays:
+                shape = (len(manifest.students), len(manifest.practices))
+                if arrays["offsets"].shape == (shape[0] + 1,):
+                    manifest.routes = (arrays["route_keys"],
+                                       arrays["route_values"])
+                    manifest.scored = np.unpackbits(
+                        arrays["scored"], axis=1, count=shape[1]
+                    ).astype(bool).reshape(shape)
+                    manifest.offsets = arrays["offsets"]
+        return manifest
+
+    def save(self, path='data/manifest.json'):
+        """
+        Save the manifest as JSON and the route hashes and pair offsets as
+        binary file next to it.
+        :param path: file path of the manifest
+        :return:
+        """
+        with open(path, "w", encoding="utf-8") as manifest_file:
+            json.dump({"students": self.students,
+                       "practices": self.practices,
+                       "max_duration": self.max_duration},
+                      manifest_file, ensure_ascii=False)
+        if self.routes is not None and self.offsets is not None:
+            np.savez(_pairs_path(path), route_keys=self.routes[0],
+                     route_values=self.routes[1],
+                     scored=np.packbits(self.scored, axis=1),
+                     offsets=self.offsets)
+        elif os.path.isfile(_pairs_path(path)):
+            os.remove(_pairs_path(path))
+        print("Manifest saved at " + path)
+
+    def describes(self, output_path):
+        """
+        Check that the pairs file is the one written with this manifest.
+        :param output_path: file path of the pairs csv file
+        :return: bool
+        """
+        return self.offsets is not None and os.path.isfile(output_path) \
+            and int(self.offsets[-1]) == os.path.getsize(output_path)
+
+    def changed_positions(self, current):
+        """
+        Find the students and practices which are new or changed since this
+        manifest was saved.
+        :param current: RunManifest of the current datastore
+        :return: int arrays of the student and practice positions
+        """
+        def changed(previous, hashes):
+            return np.array([i for i, (key, digest) in
+                             enumerate(hashes.items())
+                             if previous.get(key) != digest], dtype=int)
+
+        return (changed(self.students, current.students),
+                changed(self.practices, current.practices))
+
+    def changed_routes(self, current, data_store, lookup):
+        """
+        Find the pairs of students and practices whose routes changed or
+        were removed since this manifest was saved.
+
+        Only the sorted route hashes are compared, the pairs are found from
+        the few changed routes.
+        :param current: RunManifest of the current datastore with route
+        hashes
+        :param data_store: current datastore
+        :param lookup: DurationLookup the current route hashes were
+        computed from
+        :return: bool array of shape (S, P) in the current order, all True
+        if this manifest has no route hashes
+        """
+        shape = (len(data_store.df_students), len(data_store.df_practices))
+        if self.routes is None:
+            return np.ones(shape, dtype=bool)
+        keys, values = current.routes
+        previous_keys, previous_values = self.routes
+        rows, known = _find_sorted(previous_keys, keys)
+        changed = np.zeros(lookup.durations.size, dtype=bool)
+        changed[current.route_cells[known & (previous_values[rows]
+                                             != values)]] = True
+        removed = previous_keys[~_find_sorted(keys, previous_keys)[1]]
+        if len(removed):
+            changed |= np.isin(route_hashes(lookup)[0].ravel(), removed)
+        # student and practice addresses of the changed routes
+        changed = changed.reshape(lookup.durations.shape).any(axis=1)
+
+        pairs = np.zeros(shape, dtype=bool)
+        stud_codes, prac_codes = lookup.address_codes(
+            data_store.df_students, data_store.df_practices)
+        prac_found = prac_codes >= 0
+        affected = changed.any(axis=1)[np.maximum(stud_codes, 0)] & \
+            (stud_codes >= 0)
+        for slot in range(stud_codes.shape[1]):
+            students = np.flatnonzero(affected[:, slot])
+            pairs[students] |= changed[stud_codes[students, slot]][
+                :, np.maximum(prac_codes, 0)] & prac_found
+        return pairs
+
+
+def _find_sorted(sorted_keys, keys):
+    """
+    Find keys in a sorted array.
+    :param sorted_keys: sorted array
+    :param keys: array of keys, fastest if sorted too
+    :return: int array of the positions of the keys and bool array, True
+    for the keys found
+    """
+    if not len(sorted_keys):
+        return (np.zeros(len(keys), dtype=int),
+                np.zeros(len(keys), dtype=bool))
+    rows = np.minimum(np.searchsorted(sorted_keys, keys),
+                      len(sorted_keys) - 1)
+    return rows, sorted_keys[rows] == keys
+
+
+def changed_address_frame(data_store, stud_positions, prac_positions):
+    """
+    Make the bike and car routes of the changed students against all
+    practices and of all students against the changed practices.
+    :param data_store:
+    :param stud_positions: positions of the changed students
+    :param prac_positions: positions of the changed practices
+    :return: df with stud_add, prac_add and is_car
+    """
+    frames = [data_store.select_students(stud_positions).build_address_frame(),
+              data_store.select_practices(prac_positions)
+              .build_address_frame()]
+    return pd.concat(frames, ignore_index=True).drop_duplicates(
+        ignore_index=True)
+
+
+def pair_offsets(output_path, counts):
+    """
+    Find the byte offsets of the pairs of every student in a pairs file
+    ordered by student.
+    :param output_path: file path of the pairs csv file
+    :param counts: int array with the number of pairs of every student
+    :return: int array of S + 1 offsets, None if rows span several lines
+    """
+    line_ends = np.flatnonzero(np.fromfile(output_path, dtype=np.uint8)
+                               == ord("\n")) + 1
+    ends = np.cumsum(counts)
+    if len(line_ends) != 1 + (ends[-1] if len(ends) else 0):
+        return None
+    return np.concatenate([line_ends[:1], line_ends[ends]]).astype(np.int64)
+
+
+def rescore_changed_pairs(data_store, previous, current, lookup,
+                          output_path='data/all_possible_pairs.csv'):
+    """
+    Re-score the pairs of the changed students and practices and the pairs
+    whose routes changed, and replace only their rows of the pairs file.
+
+    The pairs file is ordered by student, so the rows of students without
+    changed pairs are copied from the previous file as byte ranges, and the
+    kept lines of the other students are merged with their re-scored ones.
+    The result is the same file a full run would write. The weights of all
+    pairs depend on the longest route duration, so this is only valid while
+    it is unchanged.
+    :param data_store:
+    :param previous: RunManifest of the previous run, with pair offsets
+    describing the pairs file
+    :param current: RunManifest of the current datastore
+    :param lookup: DurationLookup with the durations of the current run
+    :param output_path: file path of the pairs csv file
+    :return: int array of the pair offsets of the updated file, None if the
+    previous file cannot be updated row by row
+    """
+    stud_positions, prac_positions = previous.changed_positions(current)
+    stud_rows = pd.Index(list(previous.students)).get_indexer(
+        list(current.students))
+    prac_rows = pd.Index(list(previous.practices)).get_indexer(
+        list(current.practices))
+    # current position of every previous practice
+    prac_moves = pd.Index(list(current.practices)).get_indexer(
+        list(previous.practices))
+
+    # unchanged pairs are kept while they are scored and candidates, and
+    # their routes did not change
+    candidates = current.scored
+    keep = previous.scored[np.maximum(stud_rows, 0)][
+        :, np.maximum(prac_rows, 0)]
+    keep &= (stud_rows >= 0)[:, None] & (prac_rows >= 0)[None, :]
+    keep &= candidates
+    keep[stud_positions] = False
+    keep[:, prac_positions] = False
+    keep &= ~previous.changed_routes(current, data_store, lookup)
+    rescore = candidates & ~keep
+
+    # students whose previous rows are copied as they are
+    moved = prac_moves[prac_moves >= 0]
+    in_order = bool(np.all(moved[1:] > moved[:-1]))
+    previous_counts = previous.scored.sum(axis=1)
+    copied = ~rescore.any(axis=1) & (stud_rows >= 0) & in_order & \
+        (keep.sum(axis=1) == previous_counts[np.maximum(stud_rows, 0)])
+
+    # the changed students against all practices, and the other students
+    # with re-scored pairs against the practices of those pairs
+    others = np.setdiff1d(np.flatnonzero(rescore.any(axis=1)),
+                          stud_positions)
+    columns = np.flatnonzero(rescore[others].any(axis=0))
+    shard = data_store.select_students(others).select_practices(columns)
+    shard.candidates = rescore[others][:, columns]
+    frames = [pd.DataFrame(columns=PAIR_COLUMNS)]
+    for shard in [data_store.select_students(stud_positions), shard]:
+        if len(shard.df_students) and len(shard.df_practices):
+            frames.append(WeightMatrix(shard, lookup=lookup).to_dataframe())
+    new_df = pd.concat(frames, ignore_index=True)
+    new_studs = data_store.df_students.index.get_indexer(new_df['s_id'])
+    new_pracs = data_store.df_practices.index.get_indexer(new_df['p_id'])
+    order = np.lexsort((new_pracs, new_studs))
+    new_studs, new_pracs = new_studs[order], new_pracs[order]
+    new_lines = new_df.iloc[order].to_csv(
+        sep="\t", index=False, header=False).encode("utf-8")
+    new_lines = new_lines.split(b"\n")[:-1]
+    if len(new_lines) != len(order):
+        return None
+    get_instrumentation().incr("pairs_scored", len(new_lines))
+    get_instrumentation().incr("rows_written", len(new_lines))
+    new_bounds = np.searchsorted(new_studs,
+                                 np.arange(len(current.students) + 1))
+
+    temp_path = output_path + ".tmp"
+    offsets = np.zeros(len(current.students) + 1, dtype=np.int64)
+    with open(output_path, "rb") as source, open(temp_path, "wb") as target:
+        target.write(source.read(int(previous.offsets[0])))
+        span = None
+        for s in range(len(current.students)):
+            if copied[s]:
+                start, end = previous.offsets[stud_rows[s]:stud_rows[s] + 2]
+                if span is not None and span[1] == start:
+                    span[1] = end
+                    offsets[s + 1] = offsets[s] + end - start
+                    continue
+                _copy_span(source, target, span)
+                span = [start, end]
+                offsets[s + 1] = offsets[s] + end - start
+                continue
+            _copy_span(source, target, span)
+            span = None
+
+            lines, line_pracs = [], []
+            if stud_rows[s] >= 0 and keep[s].any():
+                # the kept lines of the previous rows of this student
+                start, end = previous.offsets[stud_rows[s]:stud_rows[s] + 2]
+                source.seek(start)
+                old_lines = source.read(end - start).split(b"\n")[:-1]
+                old_pracs = prac_moves[np.flatnonzero(
+                    previous.scored[stud_rows[s]])]
+                if len(old_lines) != len(old_pracs):
+                    target.close()
+                    os.remove(temp_path)
+                    return None
+                kept = (old_pracs >= 0) & keep[s, np.maximum(old_pracs, 0)]
+                lines += [old_lines[i] for i in np.flatnonzero(kept)]
+                line_pracs.append(old_pracs[kept])
+            lines += new_lines[new_bounds[s]:new_bounds[s + 1]]
+            line_pracs.append(new_pracs[new_bounds[s]:new_bounds[s + 1]])
+            block = b"".join(lines[i] + b"\n" for i in np.argsort(
+                np.concatenate(line_pracs), kind="stable"))
+            target.write(block)
+            offsets[s + 1] = offsets[s] + len(block)
+        _copy_span(source, target, span)
+    os.replace(temp_path, output_path)
+    offsets += previous.offsets[0]
+
+    print("{} pairs re-scored, {} kept".format(len(new_lines),
+                                               keep.sum()))
+    return offsets
+
+
+def _copy_span(source, target, span, block_size=2 ** 20):
+    """
+    Copy a byte range of the previous pairs file.
+    :param source: previous file
+    :param target: updated file
+    :param span: list of the start and end offsets, nothing is copied if
+    None
+    :return:
+    """
+    if span is None:
+        return
+    source.seek(span[0])
+    remaining = span[1] - span[0]
+    while remaining > 0:
+        block = source.read(min(remaining, block_size))
+        target.write(block)
+        remaining -= len(block)
@@ -0,0 +1,182 @@
+"""Script containing the lightweight instrumentation of pipeline runs"""
+from contextlib import contextmanager
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+# environment variable enabling instrumentation, a comma separated list of
+# "stages", "profile" and "memory", or "1" for stages only
+ENV_VAR = "MSPS_INSTRUMENT"
+
+
+class Instrumentation:
+    """Collects stage timers and counters of a pipeline run.
+
+    When disabled, stages and counters cost next to nothing, so the hooks
+    can stay in the pipeline code.
+    """
+
+    def __init__(self, enabled=False, profile=False, trace_memory=False,
+                 profile_top=15):
+        """
+        Initialize the instrumentation.
+        :param enabled: record stage timers and counters
+        :param profile: capture a cProfile summary per stage
+        :param trace_memory: capture the peak traced memory per stage
+        :param profile_top: number of functions kept per profile summary
+        """
+        self.enabled = enabled or profile or trace_memory
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.profile_top = profile_top
+        self.stages = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._started = time.time()
+        # number of stages entered and the peak memory of every traced
+        # stage before its inner stages reset the peak
+        self._depth = 0
+        self._peaks = []
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time a stage of the pipeline.
+
+        Stages may nest, e.g. loading the data within the first stage using
+        it. The inner stage gets its own time and peak memory without
+        stopping the tracing of the outer stage, and only the outermost
+        stage is profiled.
+        :param name: stage name
+        :return:
+        """
+        if not self.enabled:
+            yield
+            return
+
+        with self._lock:
+            outermost = not self._depth
+            self._depth += 1
+        profiler = cProfile.Profile() if self.profile and outermost \
+            else None
+        if self.trace_memory:
+            if self._peaks:
+                # keep the peak of the enclosing stage before measuring
+                # this one
+                self._peaks[-1] = max(self._peaks[-1],
+                                      tracemalloc.get_traced_memory()[1])
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.start()
+            self._peaks.append(0)
+        if profiler:
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = {"wall_time_s": round(time.perf_counter() - start, 4)}
+            if profiler:
+                profiler.disable()
+                record["profile"] = self._summarize(profiler)
+            if self.trace_memory:
+                peak = max(tracemalloc.get_traced_memory()[1],
+                           self._peaks.pop())
+                if self._peaks:
+                    self._peaks[-1] = max(self._peaks[-1], peak)
+                else:
+                    tracemalloc.stop()
+                record["peak_memory_mb"] = round(peak / 2 ** 20, 2)
+            with self._lock:
+                self._depth -= 1
+            self.stages[name] = record
+
+    def _summarize(self, profiler):
+        """
+        Summarize a profile into the functions with the most cumulative time.
+        :param profiler: cProfile.Profile
+        :return: list of dicts
+        """
+        stats = pstats.Stats(profiler, stream=io.StringIO())
+        stats.sort_stats("cumulative")
+        summary = []
+        for func in stats.fcn_list[:self.profile_top]:
+            _, calls, own_time, cumulative, _ = stats.stats[func]
+            summary.append({"function": "{}:{}({})".format(*func),
+                            "calls": calls,
+                            "own_time_s": round(own_time, 4),
+                            "cumulative_s": round(cumulative, 4)})
+        return summary
+
+    def incr(self, counter, count=1):
+        """
+        Add to a counter, e.g. api_calls, cache_hits or rows_written.
+        :param counter: counter name
+        :param count: amount added
+        :return:
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + count
+
+    def report(self):
+        """
+        Build the machine readable report of the run.
+        :return: dict
+        """
+        return {"started": self._started,
+                "wall_time_s": round(time.time() - self._started, 4),
+                "stages": self.stages,
+                "counters": dict(self.counters)}
+
+    def write_report(self, path):
+        """
+        Save the report as JSON.
+        :param path: file path of the report
+        :return:
+        """
+        with open(path, "w") as report_file:
+            json.dump(self.report(), report_file, indent=2)
+        print("Run report saved at " + path)
+
+
+_active = Instrumentation()
+
+
+def get_instrumentation():
+    """
+    Get the instrumentation of the current run, disabled unless configured.
+    :return: Instrumentation
+    """
+    return _active
+
+
+def configure(enabled=False, profile=False, trace_memory=False):
+    """
+    Start a new instrumentation for the current run.
+    :param enabled: record stage timers and counters
+    :param profile: capture a cProfile summary per stage
+    :param trace_memory: capture the peak traced memory per stage
+    :return: Instrumentation
+    """
+    global _active
+    _active = Instrumentation(enabled, profile, trace_memory)
+    return _active
+
+
+def configure_from_environment(environ=os.environ):
+    """
+    Start a new instrumentation configured by the MSPS_INSTRUMENT variable.
+    :param environ: environment mapping
+    :return: Instrumentation
+    """
+    options = {x.strip() for x in environ.get(ENV_VAR, "").split(",")}
+    return configure(enabled=bool(options & {"1", "stages"}),
+                     profile="profile" in options,
+                     trace_memory="memory" in options)
@@ -1,43 +1,466 @@
-"""Main entry point for the program"""
+"""Main entry point for the program
 
-from data_store import DataStore
-from google_api import GoogleAPI
-import weight_combination
-import json
+The modules of the stages import pandas, numpy, scipy and googlemaps, so
+they are only imported by the stages which run. Runs where every stage is
+up to date never load them.
+"""
+
+from config import WEIGHT_COEFFICIENTS, get_config
+from pipeline import Pipeline, Stage
+import instrumentation
+import argparse
+import os
+import threading
 
 
 def get_api_key():
-    with open('config.json') as json_data_file:
-        data = json.load(json_data_file)
-    return data['api_key']
+    return get_config()['api_key']
+
+
+# candidate mask of the prune stage, read back when the stage is skipped
+CANDIDATES_PATH = 'data/candidates.npy'
+
+# ranked practices of every student, saved with --top-k
+RANKED_PAIRS_PATH = 'data/ranked_pairs.csv'
+
+# files read by the stages which no stage writes
+INPUT_PATHS = ['data/students.csv', 'data/practices.csv',
+               'data/specialties.ts']
+
+# options adding the optional stages to a run
+STAGE_OPTIONS = {"prune": "--prune-minutes or --prune-nearest",
+                 "optimal_assignment": "--assignment optimal"}
+
+STAGE_NAMES = ["prune", "extract_addresses", "fetch_distances",
+               "create_weight_combinations", "extract_best_weights",
+               "optimal_assignment"]
+
+
+class PipelineRun:
+    """Options and data shared by the stages of one pipeline run. The
+    datastore and the pairs are loaded on first use, so skipped stages cost
+    nothing."""
+
+    def __init__(self, assignment="greedy", workers=None, chunk_size=None,
+                 binary=False, incremental=False, offline=False,
+                 prune_minutes=None, prune_nearest=None, shard_prefix=None,
+                 shard_border=0, api_workers=4, requests_per_second=10,
+                 top_k=None):
+        """
+        Initialize the run, see execute_pipeline for the options.
+        """
+        self.assignment = assignment
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.binary = binary
+        self.incremental = incremental
+        self.offline = offline
+        self.prune_minutes = prune_minutes
+        self.prune_nearest = prune_nearest
+        self.prune = prune_minutes is not None or bool(prune_nearest)
+        self.shard_prefix = shard_prefix
+        self.shard_border = shard_border
+        self.api_workers = api_workers
+        self.requests_per_second = requests_per_second
+        self.top_k = top_k
+        self._shards = None
+        self.weight_df = None
+        self.top_df = None
+        self._data_store = None
+        self._lock = threading.Lock()
+
+    @property
+    def data_store(self):
+        with self._lock:
+            if self._data_store is None:
+                from data_store import DataStore
+                from pruning import load_candidates
+                with instrumentation.get_instrumentation().stage("load"):
+                    # create datastore
+                    ds = DataStore()
+
+                    # read csv files
+                    ds.read_practices_from_csv_file("data/practices.csv")
+                    ds.read_students_from_csv_file("data/students.csv")
+                    if self.prune:
+                        load_candidates(ds, CANDIDATES_PATH)
+                self._data_store = ds
+            return self._data_store
+
+    @property
+    def saves_pair_matrix(self):
+        """
+        Whether the scoring stage saves the binary pair matrix, which only
+        the serial scoring of all pairs at once does.
+        """
+        return self.binary and not (self.shard_prefix or self.incremental
+                                    or self.chunk_size
+                                    or (self.workers or 1) > 1)
 
+    @property
+    def shards(self):
+        """
+        Regional shards of the roster, None if not sharded.
+        """
+        if self.shard_prefix and self._shards is None:
+            import sharding
+            self._shards = sharding.plan_shards(
+                self.data_store, self.shard_prefix, self.shard_border)
+            sharding.describe_shards(self.data_store, self._shards)
+        return self._shards
 
-def execute_pipeline():
+    def all_pairs(self):
+        """
+        Get all scored pairs, reading them back if the scoring stage was
+        skipped or streamed them to the file.
+        :return: df of all_possible_pairs.csv
+        """
+        with self._lock:
+            if self.weight_df is None:
+                import weight_combination
+                self.weight_df = \
+                    weight_combination.read_all_weight_combinations()
+            return self.weight_df
+
+
+def prune_stage(run):
+    import numpy as np
+    from distance_estimator import HaversineEstimator
+    from pruning import CachedRouteEstimator, prune_pairs
+    from route_cache import RouteCache
+    ds = run.data_store
+    # estimate from the geocoded addresses if available, else from the
+    # routes fetched before
+    if run.offline or os.path.isfile('data/geocodes.csv'):
+        prune_pairs(ds, HaversineEstimator.from_csv('data/geocodes.csv'),
+                    run.prune_minutes, run.prune_nearest)
+    else:
+        cache = RouteCache('data/route_cache.sqlite')
+        prune_pairs(ds, CachedRouteEstimator(cache), run.prune_minutes,
+                    run.prune_nearest)
+        cache.close()
+    np.save(CANDIDATES_PATH, ds.candidates)
+
+
+def extract_addresses_stage(run):
+    import numpy as np
+    from incremental import RunManifest, changed_address_frame
+    ds = run.data_store
+    if not run.prune and os.path.isfile(CANDIDATES_PATH):
+        # the other tools score the pairs of the mask while it exists
+        os.remove(CANDIDATES_PATH)
+    # # create address combination file
+    if run.shards is not None:
+        # only the routes within every shard
+        import sharding
+        address_df = sharding.build_sharded_address_frame(ds, run.shards)
+        if os.path.isfile('data/addresses.csv'):
+            ds.update_address_csv_file(address_df)
+        else:
+            ds.create_address_csv_file(address_df=address_df)
+    elif run.incremental and os.path.isfile('data/addresses.csv'):
+        # only add the routes of new or changed rows
+        previous = RunManifest.load(pairs=False)
+        if previous is None:
+            positions = (np.arange(len(ds.df_students)),
+                         np.arange(len(ds.df_practices)))
+        else:
+            positions = previous.changed_positions(
+                RunManifest.from_data_store(ds))
+        ds.update_address_csv_file(changed_address_frame(ds, *positions))
+    elif os.path.isfile('data/addresses.csv'):
+        # keep the fetched routes and add the missing ones
+        ds.update_address_csv_file(ds.build_address_frame())
+    else:
+        ds.create_address_csv_file()
+
+
+def fetch_distances_stage(run):
+    from distance_estimator import HaversineEstimator
+    from google_api import GoogleAPI
+    from route_cache import RouteCache
+    # fetch distance and duration from Google API, skipping cached routes
+    cache = RouteCache('data/route_cache.sqlite')
+    if run.offline:
+        api = GoogleAPI(
+            provider=HaversineEstimator.from_csv('data/geocodes.csv'))
+    else:
+        api = GoogleAPI(api_key=get_api_key(), max_workers=run.api_workers,
+                        requests_per_second=run.requests_per_second)
+    api.fetch_distances_from_api('data/addresses.csv', cache=cache)
+    cache.close()
+
+
+def routes_fetched(run):
+    """
+    Check that no route of the address file is left to fetch, so routes
+    which failed with over quota or transient errors are retried next run.
+    Only called after the stage ran, the result is kept in the pipeline
+    state.
+    :param run: PipelineRun
+    :return: bool
+    """
+    from google_api import count_routes_to_fetch
+    return count_routes_to_fetch('data/addresses.csv',
+                                 replace_estimates=not run.offline) == 0
+
+
+def create_weight_combinations_stage(run):
+    from route_table import RouteTable
+    import matrix_store
+    import weight_combination
+    ds = run.data_store
+    # load the route table once and share it with all pairs
+    route_table, lookup = None, None
+    pair_matrix_dir = 'data/pair_matrix' if run.saves_pair_matrix else None
+    if run.binary:
+        lookup = matrix_store.load_duration_lookup('data/addresses.csv')
+    else:
+        route_table = RouteTable.from_csv('data/addresses.csv')
+
+    # create all weight combination file
+    if run.shards is not None:
+        run.weight_df = weight_combination.create_sharded_weight_combinations(
+            ds, run.shards, route_table=route_table,
+            workers=run.workers or os.cpu_count(), lookup=lookup)
+    elif run.incremental:
+        run.weight_df = weight_combination.update_all_weight_combinations(
+            ds, route_table=route_table, lookup=lookup)
+    elif run.chunk_size:
+        # only the best pairs are kept in memory
+        run.top_df = weight_combination.stream_all_weight_combinations(
+            ds, route_table=route_table, chunk_size=run.chunk_size,
+            top_k=run.top_k or 1, lookup=lookup)
+    else:
+        run.weight_df = weight_combination.create_all_weight_combinations(
+            ds, route_table=route_table, workers=run.workers, lookup=lookup,
+            pair_matrix_dir=pair_matrix_dir)
+
+
+def extract_best_weights_stage(run):
+    import weight_combination
+    # extract best possible weight combinations
+    weight_df = run.top_df if run.top_df is not None else run.all_pairs()
+    weight_combination.extract_best_weights_students(
+        run.data_store, weight_df, shards=run.shards)
+    if run.top_k:
+        # the ranked alternatives of every student
+        weight_combination.extract_best_weights_students(
+            run.data_store, weight_df, top_k=run.top_k,
+            output_path=RANKED_PAIRS_PATH, shards=run.shards)
+
+
+def optimal_assignment_stage(run):
+    import assignment as optimal_assignment
+    # the assignment needs every pair, not only the best ones
+    optimal_assignment.create_optimal_assignment(run.data_store,
+                                                 run.all_pairs())
+
+
+def build_pipeline(run, max_workers=2):
+    """
+    Declare the stages of a run with the files they read and write and the
+    settings their outputs depend on.
+    :param run: PipelineRun
+    :param max_workers: number of stages running at once
+    :return: Pipeline
+    """
+    stages = []
+    upstream = []
+    if run.prune:
+        # routes cached by earlier runs are not fingerprinted
+        stages.append(Stage(
+            "prune", prune_stage, INPUT_PATHS + ['data/geocodes.csv'],
+            [CANDIDATES_PATH], config={"minutes": run.prune_minutes,
+                                       "nearest": run.prune_nearest,
+                                       "offline": run.offline}))
+        upstream = ["prune"]
+    stages.append(Stage(
+        "extract_addresses", extract_addresses_stage, INPUT_PATHS,
+        ['data/addresses.csv'], upstream,
+        config={"shard_prefix": run.shard_prefix,
+                "shard_border": run.shard_border}))
+    stages.append(Stage(
+        "fetch_distances", fetch_distances_stage,
+        ['data/geocodes.csv'] if run.offline else [], ['data/addresses.csv'],
+        ["extract_addresses"], config={"offline": run.offline},
+        complete=routes_fetched))
+    stages.append(Stage(
+        "create_weight_combinations", create_weight_combinations_stage,
+        INPUT_PATHS, ['data/all_possible_pairs.csv'] +
+        (['data/pair_matrix'] if run.saves_pair_matrix else []),
+        ["fetch_distances"],
+        config={"weights": WEIGHT_COEFFICIENTS, "binary": run.binary}))
+    stages.append(Stage("extract_best_weights", extract_best_weights_stage,
+                        outputs=['data/best_pairs.csv'] +
+                        ([RANKED_PAIRS_PATH] if run.top_k else []),
+                        depends=["create_weight_combinations"],
+                        config={"top_k": run.top_k}))
+    if run.assignment == "optimal":
+        stages.append(Stage("optimal_assignment", optimal_assignment_stage,
+                            outputs=['data/optimal_pairs.csv'],
+                            depends=["create_weight_combinations"]))
+    return Pipeline(stages, max_workers=max_workers)
+
+
+def execute_pipeline(assignment="greedy", workers=None, chunk_size=None,
+                     binary=False, incremental=False, offline=False,
+                     prune_minutes=None, prune_nearest=None, until=None,
+                     only=None, force=False, shard_prefix=None,
+                     shard_border=0, api_workers=4, requests_per_second=10,
+                     top_k=None):
     """
     Executes and calls all necessary functions to run the program.
+
+    The stages are fingerprinted by their inputs, settings and upstream
+    stages in data/pipeline_state.json, a stage only runs if its
+    fingerprint changed since its last run or one of its outputs is
+    missing. Independent stages run concurrently.
+
+    Every stage is timed by the active instrumentation, which only records
+    anything when enabled with the --instrument flag or the MSPS_INSTRUMENT
+    environment variable.
+    :param assignment: "greedy" to give every student their best practice,
+    "optimal" to additionally solve the capacity aware optimal assignment
+    :param workers: number of processes scoring the pairs, serial if None
+    :param chunk_size: if given, stream the pairs to the csv file this many
+    students at a time, keeping only the best pairs in memory
+    :param binary: if True, open the routes from the memory mapped route
+    matrix in data/route_matrix and save the pairs to data/pair_matrix too
+    when all pairs are scored at once in a single process
+    :param incremental: if True, only fetch the routes and re-score the pairs
+    of students and practices changed since the manifest of the last
+    incremental run in data/manifest.json
+    :param offline: if True, estimate the routes from the geocoded addresses
+    in data/geocodes.csv instead of querying the Google API
+    :param prune_minutes: if given, only fetch and score the practices a
+    student reaches within this many minutes by the estimate, besides the
+    nearest ones and those with a matching specialty
+    :param prune_nearest: if given, keep this many nearest practices of
+    every student when pruning
+    :param until: run this stage and the stages it depends on only
+    :param only: list of the only stages to run
+    :param force: if True, run the selected stages even if up to date
+    :param shard_prefix: if given, split the roster into regions by this
+    many leading postal code digits and only pair students with the
+    practices of their region, scoring the regions in parallel
+    :param shard_border: also pair the students of a region with the
+    practices of regions whose postal code prefix differs by at most this
+    :param api_workers: number of concurrent Distance Matrix API requests
+    :param requests_per_second: most Distance Matrix API requests started
+    per second, unlimited if None
+    :param top_k: if given, also save the top_k ranked practices of every
+    student to data/ranked_pairs.csv
+    :return: dict of stage name to "ran" or "skipped"
+    """
+    run = PipelineRun(assignment, workers, chunk_size, binary, incremental,
+                      offline, prune_minutes, prune_nearest, shard_prefix,
+                      shard_border, api_workers, requests_per_second, top_k)
+    instruments = instrumentation.get_instrumentation()
+    # profiles and memory traces of concurrent stages would mix
+    max_workers = 1 if instruments.profile or instruments.trace_memory \
+        else 2
+    return build_pipeline(run, max_workers).run(run, until, only, force)
+
+
+def add_pipeline_arguments(parser):
+    """
+    Add the options of a pipeline run to a parser.
+    :param parser: argparse.ArgumentParser
     :return:
     """
-    api_key = get_api_key()
+    parser.add_argument("--workers", type=int,
+                        help="number of processes scoring the pairs")
+    parser.add_argument("--chunk-size", type=int,
+                        help="stream the pairs this many students at a time")
+    parser.add_argument("--binary", action="store_true",
+                        help="use the binary route and pair matrices")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only re-run the students and practices changed "
+                        "since the last incremental run")
+    parser.add_argument("--offline", action="store_true",
+                        help="estimate the routes from data/geocodes.csv "
+                        "instead of calling the Google API")
+    parser.add_argument("--prune-minutes", type=float,
+                        help="skip practices further than this many minutes "
+                        "by the estimated duration")
+    parser.add_argument("--prune-nearest", type=int,
+                        help="always keep this many nearest practices when "
+                        "pruning")
+    parser.add_argument("--shard-prefix", type=int,
+                        help="only pair students with practices of their "
+                        "region, by this many postal code digits")
+    parser.add_argument("--shard-border", type=int, default=0,
+                        help="also pair with practices of regions whose "
+                        "postal code prefix differs by at most this")
+    parser.add_argument("--api-workers", type=int, default=4,
+                        help="number of concurrent Google API requests")
+    parser.add_argument("--requests-per-second", type=float, default=10,
+                        help="most Google API requests started per second")
+    parser.add_argument("--top-k", type=int,
+                        help="also save this many ranked practices of every "
+                        "student to " + RANKED_PAIRS_PATH)
+    parser.add_argument("--force", action="store_true",
+                        help="run the stages even if they are up to date")
+    parser.add_argument("--instrument", action="store_true",
+                        help="record stage timers and counters")
+    parser.add_argument("--profile", action="store_true",
+                        help="capture a cProfile summary per stage")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="capture the peak memory per stage")
+    parser.add_argument("--report", default="data/run_report.json",
+                        help="file path of the run report")
 
-    # create datastore
-    ds = DataStore()
 
-    # read csv files
-    ds.read_practices_from_csv_file("data/practices.csv")
-    ds.read_students_from_csv_file("data/students.csv")
+def run_pipeline(args, assignment="greedy", until=None, only=None):
+    """
+    Run the pipeline with the options parsed by add_pipeline_arguments and
+    save the run report if instrumented.
+    :param args: argparse.Namespace
+    :param assignment: "greedy" or "optimal"
+    :param until: run this stage and the stages it depends on only
+    :param only: list of the only stages to run
+    :return: dict of stage name to "ran" or "skipped"
+    """
+    instruments = instrumentation.configure_from_environment()
+    if args.instrument or args.profile or args.trace_memory:
+        instruments = instrumentation.configure(
+            True, args.profile or instruments.profile,
+            args.trace_memory or instruments.trace_memory)
 
-    # # create address combination file
-    ds.create_address_csv_file()
+    results = execute_pipeline(assignment, args.workers, args.chunk_size,
+                               args.binary, args.incremental, args.offline,
+                               args.prune_minutes, args.prune_nearest, until,
+                               only, args.force, args.shard_prefix,
+                               args.shard_border, args.api_workers,
+                               args.requests_per_second, args.top_k)
 
-    # fetch distance and duration from Google API
-    GoogleAPI(api_key=api_key).fetch_distances_from_api('data/addresses.csv')
+    if instruments.enabled:
+        instruments.write_report(args.report)
+    return results
 
-    # create all weight combination file
-    weight_df = weight_combination.create_all_weight_combinations(ds)
 
-    # extract best possible weight combinations
-    weight_combination.extract_best_weights_students(ds, weight_df)
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Assign medical students to practices")
+    parser.add_argument("--assignment", choices=["greedy", "optimal"],
+                        default="greedy")
+    parser.add_argument("--until", choices=STAGE_NAMES,
+                        help="run this stage and the stages it depends on")
+    parser.add_argument("--only", nargs="+", choices=STAGE_NAMES,
+                        help="run only these stages")
+    add_pipeline_arguments(parser)
+    args = parser.parse_args(argv)
+
+    stages = build_pipeline(PipelineRun(
+        args.assignment, prune_minutes=args.prune_minutes,
+        prune_nearest=args.prune_nearest)).stages
+    for name in [args.until] + (args.only or []):
+        if name and name not in stages:
+            parser.error("stage {} is not part of this run, it needs {}"
+                         .format(name, STAGE_OPTIONS[name]))
+    run_pipeline(args, args.assignment, args.until, args.only)
 
 
 if __name__ == "__main__":
-    execute_pipeline()
+    main()
@@ -0,0 +1,196 @@
+"""Script containing the columnar binary storage of routes and pairs"""
+import json
+import os
+import numpy as np
+import pandas as pd
+from route_table import RouteTable
+from weight_engine import DurationLookup
+
+# travel modes along the mode axis of the route matrix, 0 is bike, 1 is car
+ROUTE_MODES = ["bicycling", "driving"]
+
+
+def _save_index(directory, index):
+    with open(os.path.join(directory, "index.json"), "w",
+              encoding="utf-8") as index_file:
+        json.dump(index, index_file, ensure_ascii=False)
+
+
+def _load_index(directory):
+    with open(os.path.join(directory, "index.json"),
+              encoding="utf-8") as index_file:
+        return json.load(index_file)
+
+
+def _load_array(directory, name, mmap):
+    return np.load(os.path.join(directory, name + ".npy"),
+                   mmap_mode="r" if mmap else None)
+
+
+class RouteMatrix:
+    """Dense float32 durations and distances of the route table, indexed
+    by [student address, mode, practice address]."""
+
+    def __init__(self, stud_addresses, prac_addresses, durations, distances,
+                 present, max_duration):
+        """
+        Initialize the matrix from its arrays.
+        :param stud_addresses: list of student addresses
+        :param prac_addresses: list of practice addresses
+        :param durations: float32 array of shape (A, 2, B) in seconds
+        :param distances: float32 array of shape (A, 2, B) in meters
+        :param present: bool array of shape (A, 2, B), False where the
+        route is not in the table
+        :param max_duration: longest duration of the route table
+        """
+        self.stud_addresses = list(stud_addresses)
+        self.prac_addresses = list(prac_addresses)
+        self.durations = durations
+        self.distances = distances
+        self.present = present
+        self.max_duration = max_duration
+
+    @classmethod
+    def from_route_table(cls, route_table):
+        """
+        Build the dense matrix from a route table.
+        :param route_table: RouteTable with fetched distances and durations
+        :return: RouteMatrix
+        """
+        routes = route_table.df.drop_duplicates(
+            subset=['stud_add', 'prac_add', 'is_car'], keep='first')
+        stud_codes, stud_addresses = pd.factorize(routes['stud_add'])
+        prac_codes, prac_addresses = pd.factorize(routes['prac_add'])
+        codes = (stud_codes, routes['is_car'].to_numpy(dtype=int),
+                 prac_codes)
+
+        shape = (len(stud_addresses), len(ROUTE_MODES), len(prac_addresses))
+        durations = np.full(shape, np.nan, dtype=np.float32)
+        durations[codes] = routes['duration'].to_numpy(dtype=float)
+        distances = np.full(shape, np.nan, dtype=np.float32)
+        distances[codes] = routes['distance'].to_numpy(dtype=float)
+        present = np.zeros(shape, dtype=bool)
+        present[codes] = True
+
+        return cls(stud_addresses, prac_addresses, durations, distances,
+                   present, float(route_table.df['duration'].max()))
+
+    def save(self, directory):
+        """
+        Save the matrix as .npy arrays and a JSON index of the addresses.
+        :param directory: directory of the matrix, created if missing
+        :return:
+        """
+        os.makedirs(directory, exist_ok=True)
+        for name in ["durations", "distances", "present"]:
+            np.save(os.path.join(directory, name + ".npy"),
+                    getattr(self, name))
+        _save_index(directory, {"student_addresses": self.stud_addresses,
+                                "practice_addresses": self.prac_addresses,
+                                "modes": ROUTE_MODES,
+                                "max_duration": self.max_duration})
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """
+        Open a saved matrix, memory mapping the arrays by default so nothing
+        is parsed or copied until it is used.
+        :param directory: directory of the matrix
+        :param mmap: if False, read the arrays into memory
+        :return: RouteMatrix
+        """
+        index = _load_index(directory)
+        return cls(index["student_addresses"], index["practice_addresses"],
+                   _load_array(directory, "durations", mmap),
+                   _load_array(directory, "distances", mmap),
+                   _load_array(directory, "present", mmap),
+                   index["max_duration"])
+
+    def to_duration_lookup(self):
+        """
+        Get the lookup used by the weight engine, sharing the arrays.
+        :return: DurationLookup
+        """
+        return DurationLookup.from_arrays(self.stud_addresses,
+                                          self.prac_addresses,
+                                          self.durations, self.present,
+                                          self.max_duration)
+
+    def to_route_table(self):
+        """
+        Expand the matrix back into the rows of the address file.
+        :return: RouteTable
+        """
+        stud, mode, prac = np.nonzero(np.asarray(self.present))
+        df = pd.DataFrame({
+            "stud_add": np.asarray(self.stud_addresses, dtype=object)[stud],
+            "prac_add": np.asarray(self.prac_addresses, dtype=object)[prac],
+            "is_car": mode,
+            "distance": np.asarray(self.distances)[stud, mode, prac],
+            "duration": np.asarray(self.durations)[stud, mode, prac]})
+        return RouteTable(df)
+
+    def to_csv(self, address_path):
+        """
+        Export the matrix as a tab separated address file.
+        :param address_path: file path of the exported file
+        :return:
+        """
+        self.to_route_table().df.to_csv(address_path, sep="\t", index=False)
+
+
+def load_duration_lookup(address_path='data/addresses.csv',
+                         matrix_dir='data/route_matrix'):
+    """
+    Get the duration lookup of the address file, opening the binary route
+    matrix when it is at least as new as the file and converting the file
+    otherwise.
+    :param address_path: file path for address file
+    :param matrix_dir: directory of the route matrix
+    :return: DurationLookup
+    """
+    index_path = os.path.join(matrix_dir, "index.json")
+    if os.path.isfile(index_path) and \
+            os.path.getmtime(index_path) >= os.path.getmtime(address_path):
+        print("Opening route matrix at " + matrix_dir)
+        return RouteMatrix.load(matrix_dir).to_duration_lookup()
+
+    route_matrix = RouteMatrix.from_route_table(
+        RouteTable.from_csv(address_path))
+    route_matrix.save(matrix_dir)
+    print("Route matrix saved at " + matrix_dir)
+    return route_matrix.to_duration_lookup()
+
+
+def save_pair_matrix(weight_matrix, directory='data/pair_matrix'):
+    """
+    Save the weights and derived values of all pairs as .npy arrays, with
+    the student and practice ids in a JSON index.
+    :param weight_matrix: WeightMatrix
+    :param directory: directory of the pair matrix, created if missing
+    :return:
+    """
+    os.makedirs(directory, exist_ok=True)
+    arrays = {"weights": weight_matrix.weights,
+              "durations": weight_matrix.durations.astype(np.float32),
+              "modes": weight_matrix.modes.astype(np.int8),
+              "slots": weight_matrix.slots.astype(np.int8),
+              "match_counts": weight_matrix.match_counts.astype(np.int16)}
+    for name, array in arrays.items():
+        np.save(os.path.join(directory, name + ".npy"), array)
+    _save_index(directory,
+                {"student_ids": weight_matrix.student_ids.tolist(),
+                 "practice_ids": weight_matrix.practice_ids.tolist()})
+
+
+def load_pair_matrix(directory='data/pair_matrix', mmap=True):
+    """
+    Open a saved pair matrix.
+    :param directory: directory of the pair matrix
+    :param mmap: if False, read the arrays into memory
+    :return: dict with the index lists and the arrays of shape (S, P)
+    """
+    pairs = _load_index(directory)
+    for name in ["weights", "durations", "modes", "slots", "match_counts"]:
+        pairs[name] = _load_array(directory, name, mmap)
+    return pairs
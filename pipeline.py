@@ -0,0 +1,254 @@
+"""Script containing the runner of the pipeline stages"""
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import hashlib
+import json
+import os
+from instrumentation import get_instrumentation
+
+# fingerprints of the last successful run of every stage and the number of
+# times every stage ran
+STATE_PATH = 'data/pipeline_state.json'
+
+RAN = "ran"
+SKIPPED = "skipped"
+
+
+def file_digest(path, block_size=2 ** 20):
+    """
+    Hash the content of a file.
+    :param path: file path
+    :param block_size: bytes read at once
+    :return: hex digest, None if the file does not exist
+    """
+    if not os.path.isfile(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Stage:
+    """Step of the pipeline with declared inputs, outputs and upstream
+    stages.
+
+    The inputs are the files the stage reads which no stage writes, the
+    config holds every setting that changes its outputs. Files written by
+    upstream stages are covered by the fingerprints of those stages.
+    """
+
+    def __init__(self, name, func, inputs=(), outputs=(), depends=(),
+                 config=None, complete=None):
+        """
+        Declare a stage.
+        :param name: stage name
+        :param func: function called with the run context
+        :param inputs: file paths read by the stage
+        :param outputs: file paths written by the stage
+        :param depends: names of the stages which must run before
+        :param config: json serializable dict of settings
+        :param complete: function called with the run context after the
+        stage ran, returning False while the outputs are incomplete, e.g.
+        routes left to fetch after transient errors. The stage then stays
+        out of date
+        """
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.depends = list(depends)
+        self.config = config or {}
+        self.complete = complete
+
+
+class Pipeline:
+    """Runs a DAG of stages, skipping the stages whose fingerprint did not
+    change since their last run and running independent stages
+    concurrently.
+
+    The fingerprint of a stage includes how often its upstream stages ran,
+    so a stage re-running with the same fingerprint, e.g. when forced or
+    incomplete, also runs the stages depending on it.
+    """
+
+    def __init__(self, stages, state_path=STATE_PATH, max_workers=2):
+        """
+        Initialize the pipeline.
+        :param stages: list of Stage
+        :param state_path: json file of the fingerprints of the last run
+        :param max_workers: number of stages running at once
+        """
+        self.stages = {stage.name: stage for stage in stages}
+        self.order = self._sort(stages)
+        self.state_path = state_path
+        self.max_workers = max_workers
+
+    def _sort(self, stages):
+        """
+        Order the stages so that every stage comes after its upstream
+        stages, keeping the declared order otherwise.
+        :param stages: list of Stage
+        :return: list of stage names
+        """
+        order = []
+        remaining = [stage.name for stage in stages]
+        for stage in stages:
+            unknown = set(stage.depends) - set(self.stages)
+            if unknown:
+                raise ValueError("Stage {} depends on unknown stages {}"
+                                 .format(stage.name, sorted(unknown)))
+        while remaining:
+            ready = [name for name in remaining
+                     if set(self.stages[name].depends) <= set(order)]
+            if not ready:
+                raise ValueError("Stages {} depend on each other"
+                                 .format(remaining))
+            order.append(ready[0])
+            remaining.remove(ready[0])
+        return order
+
+    def upstream(self, name):
+        """
+        Get a stage and all stages it depends on.
+        :param name: stage name
+        :return: set of stage names
+        """
+        names = {name}
+        for dependency in self.stages[name].depends:
+            names |= self.upstream(dependency)
+        return names
+
+    def select(self, until=None, only=None):
+        """
+        Select the stages of a run.
+        :param until: run this stage and the stages it depends on
+        :param only: list of the only stages to run
+        :return: set of stage names
+        """
+        for name in ([until] if until else []) + list(only or []):
+            if name not in self.stages:
+                raise ValueError("Unknown stage " + name)
+        if only:
+            return set(only)
+        if until:
+            return self.upstream(until)
+        return set(self.order)
+
+    def fingerprints(self, runs=None, digests=None):
+        """
+        Fingerprint every stage by its config, the content of its inputs and
+        the fingerprints and run counts of its upstream stages.
+        :param runs: dict of stage name to the number of times it ran
+        :param digests: dict of input path to digest, hashed if missing
+        :return: dict of stage name to hex digest
+        """
+        runs = runs or {}
+        digests = digests or {}
+        fingerprints = {}
+        for name in self.order:
+            stage = self.stages[name]
+            key = json.dumps({
+                "config": stage.config,
+                "inputs": {path: digests[path] if path in digests
+                           else file_digest(path) for path in stage.inputs},
+                "depends": {dependency: [fingerprints[dependency],
+                                         runs.get(dependency, 0)]
+                            for dependency in stage.depends},
+            }, sort_keys=True, default=str)
+            fingerprints[name] = hashlib.sha256(key.encode()).hexdigest()
+        return fingerprints
+
+    def load_state(self):
+        """
+        Read the state of the last run.
+        :return: dict with the fingerprints and run counts by stage name
+        """
+        state = {}
+        if os.path.isfile(self.state_path):
+            with open(self.state_path) as f:
+                state = json.load(f)
+        if "fingerprints" not in state:
+            # state of an older version, every stage runs once
+            state = {}
+        return {"fingerprints": state.get("fingerprints", {}),
+                "runs": state.get("runs", {})}
+
+    def save_state(self, state):
+        with open(self.state_path, 'w') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+
+    def is_complete(self, name, context):
+        complete = self.stages[name].complete
+        return complete is None or complete(context)
+
+    def is_up_to_date(self, name, fingerprint, state):
+        """
+        Check if a stage completed with the same fingerprint and its outputs
+        still exist.
+        :param name: stage name
+        :param fingerprint: current fingerprint of the stage
+        :param state: state of the last run
+        :return: bool
+        """
+        return state["fingerprints"].get(name) == fingerprint and \
+            all(os.path.exists(path) for path in self.stages[name].outputs)
+
+    def _run_stage(self, name, context):
+        with get_instrumentation().stage(name):
+            self.stages[name].func(context)
+
+    def run(self, context=None, until=None, only=None, force=False):
+        """
+        Run the selected stages which are not up to date, every stage as soon
+        as the stages it depends on are done.
+        :param context: object passed to every stage function
+        :param until: run this stage and the stages it depends on
+        :param only: list of the only stages to run
+        :param force: if True, run the selected stages even if up to date
+        :return: dict of stage name to RAN or SKIPPED
+        """
+        pending = [name for name in self.order
+                   if name in self.select(until, only)]
+        digests = {path: file_digest(path) for stage in self.stages.values()
+                   for path in stage.inputs}
+        state = self.load_state()
+        results = {}
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for name in list(pending):
+                    busy = {stage for stage, _ in running.values()}
+                    if any(dependency in pending or dependency in busy
+                           for dependency in self.stages[name].depends):
+                        continue
+                    pending.remove(name)
+                    # upstream stages which ran change the fingerprint
+                    fingerprint = self.fingerprints(state["runs"],
+                                                    digests)[name]
+                    if not force and self.is_up_to_date(name, fingerprint,
+                                                        state):
+                        print("Stage {} is up to date".format(name))
+                        results[name] = SKIPPED
+                        continue
+                    print("Running stage " + name)
+                    running[executor.submit(self._run_stage, name,
+                                            context)] = (name, fingerprint)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, fingerprint = running.pop(future)
+                    # a failed stage keeps its old fingerprint and stops
+                    # the run once the running stages are done
+                    future.result()
+                    results[name] = RAN
+                    state["runs"][name] = state["runs"].get(name, 0) + 1
+                    if not self.is_complete(name, context):
+                        print("Stage {} is incomplete and runs again next "
+                              "time".format(name))
+                        state["fingerprints"].pop(name, None)
+                    else:
+                        state["fingerprints"][name] = fingerprint
+                    self.save_state(state)
+        return results
@@ -0,0 +1,156 @@
+"""Script containing the pruning of pairs which can never be the best"""
+import os
+import numpy as np
+import pandas as pd
+from data_store import ADDRESS_SLOTS
+from google_api import get_travel_mode
+from instrumentation import get_instrumentation
+from config import WEIGHT_COEFFICIENTS
+
+# candidate mask of the last pruned run
+CANDIDATES_PATH = 'data/candidates.npy'
+
+
+class CachedRouteEstimator:
+    """Duration source answering from the routes already in the route
+    cache, NaN for routes which were never fetched."""
+
+    def __init__(self, cache):
+        """
+        Initialize the source.
+        :param cache: RouteCache
+        """
+        self.cache = cache
+
+    def estimate_matrix(self, origins, destinations, mode):
+        """
+        Look up the cached routes of all origins against all destinations.
+        :param origins: list of A origin addresses
+        :param destinations: list of B destination addresses
+        :param mode: "bicycling" or "driving"
+        :return: float arrays of shape (A, B) with the distances and
+        durations, NaN where the route is not cached
+        """
+        keys = [(origin, dest, mode) for origin in origins
+                for dest in destinations]
+        cached = self.cache.get_many(keys)
+        routes = np.array([cached.get(key, (np.nan, np.nan))[:2]
+                           for key in keys], dtype=float).reshape(
+            len(origins), len(destinations), 2)
+        return routes[:, :, 0], routes[:, :, 1]
+
+
+def estimate_pair_durations(data_store, estimator):
+    """
+    Estimate the duration of the fastest route of every student against
+    every practice, over all addresses of the student and the bike and,
+    for students with a car, car mode.
+    :param data_store:
+    :param estimator: object with an estimate_matrix method, e.g. a
+    HaversineEstimator or a CachedRouteEstimator
+    :return: float array of shape (S, P) in seconds, NaN if no route of the
+    pair could be estimated
+    """
+    stud_addrs = data_store.df_students[ADDRESS_SLOTS].to_numpy(dtype=object)
+    has_slot = ~pd.isna(stud_addrs)
+    origins = pd.Index(pd.unique(stud_addrs[has_slot]))
+    codes = origins.get_indexer(stud_addrs.ravel()).reshape(stud_addrs.shape)
+    destinations = list(data_store.df_practices['address'])
+    has_car = data_store.df_students['hasCar'].to_numpy(dtype=int) == 1
+
+    fastest = np.full((len(stud_addrs), len(destinations)), np.nan)
+    for is_car in [0, 1]:
+        _, durations = estimator.estimate_matrix(
+            list(origins), destinations, get_travel_mode(is_car))
+        for slot in range(len(ADDRESS_SLOTS)):
+            usable = has_slot[:, slot] & (has_car if is_car else True)
+            fastest[usable] = np.fmin(fastest[usable],
+                                      durations[codes[usable, slot]])
+    return fastest
+
+
+def select_candidates(durations, match_counts, max_minutes=None,
+                      k_nearest=None, children=None):
+    """
+    Select the pairs worth fetching and scoring.
+
+    A practice can only outweigh the nearest practice of a student if the
+    duration it loses is made up by its matching specialities, so a pair is
+    pruned only if its duration exceeds the nearest duration of the student
+    by more than (99 * most matches + 0.8 * children) / 0.2 seconds. Pairs
+    within max_minutes, among the k_nearest practices of the student or
+    without an estimate are always kept.
+    :param durations: float array of shape (S, P) of estimated durations in
+    seconds
+    :param match_counts: int array of shape (S, P)
+    :param max_minutes: duration in minutes within which pairs are kept, not
+    used if None
+    :param k_nearest: number of nearest practices kept, not used if None
+    :param children: int array of shape (S,) of the hasChildren flags, 1 for
+    every student if None
+    :return: bool array of shape (S, P)
+    """
+    if max_minutes is None and not k_nearest:
+        return np.ones(durations.shape, dtype=bool)
+    if children is None:
+        children = np.ones(len(durations))
+
+    unknown = np.isnan(durations)
+    known = np.where(unknown, np.inf, durations)
+    duration_coef, specialty_coef, children_coef = WEIGHT_COEFFICIENTS
+    slack = (specialty_coef * match_counts.max(axis=1, initial=0)
+             + children_coef * np.asarray(children)) / duration_coef
+    keep = unknown | (known <= known.min(axis=1, initial=np.inf)[:, None]
+                      + slack[:, None])
+    if max_minutes is not None:
+        keep |= known <= max_minutes * 60
+    if k_nearest:
+        k_nearest = min(k_nearest, durations.shape[1])
+        nearest = np.argpartition(known, k_nearest - 1,
+                                  axis=1)[:, :k_nearest]
+        np.put_along_axis(keep, nearest, True, axis=1)
+    return keep
+
+
+def prune_pairs(data_store, estimator, max_minutes=None, k_nearest=None):
+    """
+    Prune the pairs which can never win before their routes are fetched.
+    The candidates are stored in the datastore, so both the routes of the
+    address file and the scored pairs shrink.
+    :param data_store:
+    :param estimator: object with an estimate_matrix method
+    :param max_minutes: duration in minutes within which pairs are kept, not
+    used if None
+    :param k_nearest: number of nearest practices kept, not used if None
+    :return: number of pruned pairs
+    """
+    print("Pruning pairs..")
+    candidates = select_candidates(
+        estimate_pair_durations(data_store, estimator),
+        data_store.get_match_counts(), max_minutes, k_nearest,
+        data_store.df_students['hasChildren'].to_numpy(dtype=int))
+    data_store.candidates = candidates
+
+    pruned = int(candidates.size - candidates.sum())
+    get_instrumentation().incr("pairs_pruned", pruned)
+    print("{} of {} pairs pruned".format(pruned, candidates.size))
+    return pruned
+
+
+def load_candidates(data_store, path=CANDIDATES_PATH):
+    """
+    Load the candidate mask of the last pruned run into the datastore, so
+    pairs whose routes were never fetched are not scored.
+    :param data_store:
+    :param path: file path of the mask, nothing is loaded if missing
+    :return: bool array of shape (S, P) or None
+    """
+    if os.path.isfile(path):
+        candidates = np.load(path)
+        shape = (len(data_store.df_students), len(data_store.df_practices))
+        if candidates.shape == shape:
+            data_store.candidates = candidates
+        else:
+            print("Ignoring the candidates at {}, they do not match the "
+                  "students and practices".format(path))
+    return data_store.candidates
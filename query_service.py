@@ -0,0 +1,259 @@
+"""Interactive queries over the precomputed weight matrix"""
+import argparse
+import cmd
+import shlex
+import time
+import numpy as np
+import pandas as pd
+from data_store import DataStore
+from route_table import RouteTable, MissingRouteError
+from weight_engine import WeightMatrix, DurationLookup
+import matrix_store
+from pruning import load_candidates
+
+
+class PairIndex:
+    """Weight matrix of all pairs held in memory with sorted indexes per
+    student and per practice.
+
+    The order of a student's practices by weight and of a practice's
+    students by duration is sorted on the first query and kept until an
+    edit changes it.
+    """
+
+    def __init__(self, data_store, route_table=None, lookup=None):
+        """
+        Score all pairs once.
+        :param data_store: DataStore with students and practices, pairs
+        pruned from its candidates are not scored or returned
+        :param route_table: RouteTable with fetched durations
+        :param lookup: DurationLookup used instead of the route table if given
+        """
+        if lookup is None:
+            lookup = DurationLookup(data_store.df_students,
+                                    data_store.df_practices, route_table,
+                                    data_store.address_book)
+        self.data_store = data_store
+        self.lookup = lookup
+        self.matrix = WeightMatrix(data_store, lookup=lookup)
+        self._by_weight = {}
+        self._by_duration = {}
+
+    def _student(self, student_id):
+        return self.data_store.df_students.index.get_loc(student_id)
+
+    def _practice(self, practice_id):
+        return self.data_store.df_practices.index.get_loc(practice_id)
+
+    def _practices_by_weight(self, stud_row):
+        if stud_row not in self._by_weight:
+            weights = self.matrix.weights[stud_row]
+            order = np.argsort(-weights, kind='stable')
+            self._by_weight[stud_row] = order[~np.isnan(weights[order])]
+        return self._by_weight[stud_row]
+
+    def _students_by_duration(self, prac_row):
+        if prac_row not in self._by_duration:
+            durations = self.matrix.durations[:, prac_row]
+            order = np.argsort(durations, kind='stable')
+            self._by_duration[prac_row] = (order, durations[order])
+        return self._by_duration[prac_row]
+
+    def top_practices(self, student_id, n=5):
+        """
+        Get the n highest weight practices of a student.
+        :param student_id: id of the student
+        :param n: number of practices
+        :return: df with the rows of all_possible_pairs.csv
+        """
+        stud_row = self._student(student_id)
+        prac_rows = self._practices_by_weight(stud_row)[:n]
+        return self.matrix.pair_rows(np.full(len(prac_rows), stud_row),
+                                     prac_rows)
+
+    def students_within(self, practice_id, minutes):
+        """
+        Get the students reaching a practice within a duration, fastest
+        first.
+        :param practice_id: id of the practice
+        :param minutes: longest duration in minutes
+        :return: df with the rows of all_possible_pairs.csv
+        """
+        prac_row = self._practice(practice_id)
+        order, durations = self._students_by_duration(prac_row)
+        stud_rows = order[:np.searchsorted(durations, minutes * 60,
+                                           side='right')]
+        return self.matrix.pair_rows(stud_rows,
+                                     np.full(len(stud_rows), prac_row))
+
+    def pair(self, student_id, practice_id):
+        """
+        Get the row of a single pair.
+        :param student_id: id of the student
+        :param practice_id: id of the practice
+        :return: df with one row of all_possible_pairs.csv
+        """
+        return self.matrix.pair_rows([self._student(student_id)],
+                                     [self._practice(practice_id)])
+
+    def update_student(self, student_id, **values):
+        """
+        Edit a student and re-score only their pairs, with the same weights
+        a full run would give them.
+        :param student_id: id of the student
+        :param values: new values by column of students.csv
+        :return: df with the new top 5 practices of the student
+        :raises MissingRouteError: if a new address has no fetched routes
+        """
+        stud_row = self._student(student_id)
+        previous = self.data_store.df_students.loc[student_id, list(values)]
+        self.data_store.update_student(student_id, **values)
+        try:
+            shard = self.data_store.select_students([stud_row])
+            self.matrix.replace_students(
+                [stud_row], WeightMatrix(shard, lookup=self.lookup))
+        except Exception:
+            self.data_store.update_student(student_id, **previous.to_dict())
+            raise
+
+        self._by_weight.pop(stud_row, None)
+        self._by_duration.clear()
+        return self.top_practices(student_id)
+
+
+def _parse_value(df, column, value):
+    """
+    Convert a value typed in the shell to the dtype of its column.
+    :param df: df holding the column
+    :param column: column name
+    :param value: string
+    :return: converted value
+    """
+    if column not in df.columns:
+        raise KeyError("Unknown column " + column)
+    if value.lower() in ("", "nan", "none"):
+        return np.nan
+    if pd.api.types.is_numeric_dtype(df[column]):
+        return pd.to_numeric(value)
+    return value
+
+
+def _split_args(arg, required, optional=()):
+    """
+    Split the arguments of a shell command.
+    :param arg: argument string
+    :param required: number of required arguments
+    :param optional: default values of the optional arguments
+    :return: list of the required and optional arguments
+    :raises ValueError: if too few or too many arguments are given
+    """
+    args = shlex.split(arg)
+    if not required <= len(args) <= required + len(optional):
+        raise ValueError("expected {} arguments, got {}".format(
+            required if not optional else "{} to {}".format(
+                required, required + len(optional)), len(args)))
+    return args + list(optional)[len(args) - required:]
+
+
+class QueryShell(cmd.Cmd):
+    """Command line shell answering queries from a PairIndex."""
+
+    intro = "Type help or ? to list the commands."
+    prompt = "(pairs) "
+
+    def __init__(self, index, **kwargs):
+        """
+        Initialize the shell.
+        :param index: PairIndex
+        """
+        super(QueryShell, self).__init__(**kwargs)
+        self.index = index
+
+    def _show(self, func, command):
+        """
+        Run a query and print its rows, or the error and the usage of the
+        command if it fails, so a typo never ends the shell.
+        :param func: function taking no arguments returning a df
+        :param command: do_ method of the command
+        :return:
+        """
+        start = time.perf_counter()
+        try:
+            result = func()
+        except (KeyError, IndexError, ValueError,
+                MissingRouteError) as error:
+            print("Error: {}".format(error))
+            if isinstance(error, (IndexError, ValueError)):
+                print("Usage: " + command.__doc__.split(":")[0])
+            return
+        print(result.to_string(index=False))
+        print("({} rows in {:.1f} ms)".format(
+            len(result), (time.perf_counter() - start) * 1000))
+
+    def do_top(self, arg):
+        """top STUDENT [N]: the N best practices of a student, 5 by default"""
+        def query():
+            student_id, n = _split_args(arg, 1, ["5"])
+            return self.index.top_practices(student_id, int(n))
+        self._show(query, self.do_top)
+
+    def do_near(self, arg):
+        """near PRACTICE MINUTES: students reaching a practice in time"""
+        def query():
+            practice_id, minutes = _split_args(arg, 2)
+            return self.index.students_within(practice_id, float(minutes))
+        self._show(query, self.do_near)
+
+    def do_pair(self, arg):
+        """pair STUDENT PRACTICE: the row of a single pair"""
+        self._show(lambda: self.index.pair(*_split_args(arg, 2)),
+                   self.do_pair)
+
+    def do_set(self, arg):
+        """set STUDENT COLUMN VALUE: edit a student and re-score them,
+        e.g. set S017 hasCar 0"""
+        def query():
+            student_id, column, value = _split_args(arg, 3)
+            value = _parse_value(self.index.data_store.df_students, column,
+                                 value)
+            return self.index.update_student(student_id, **{column: value})
+        self._show(query, self.do_set)
+
+    def do_quit(self, arg):
+        """quit: leave the shell"""
+        return True
+
+    do_EOF = do_quit
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Query the weights of student practice pairs")
+    parser.add_argument("--binary", action="store_true",
+                        help="open the routes from the binary route matrix")
+    parser.add_argument("command", nargs="*",
+                        help="run a single command instead of the shell, "
+                        "e.g. top S017 5")
+    args = parser.parse_args(argv)
+
+    ds = DataStore()
+    ds.read_practices_from_csv_file("data/practices.csv")
+    ds.read_students_from_csv_file("data/students.csv")
+    # pairs pruned by the last run have no fetched routes
+    load_candidates(ds)
+    if args.binary:
+        index = PairIndex(ds, lookup=matrix_store.load_duration_lookup(
+            'data/addresses.csv'))
+    else:
+        index = PairIndex(ds, RouteTable.from_csv('data/addresses.csv'))
+
+    shell = QueryShell(index)
+    if args.command:
+        shell.onecmd(" ".join(shlex.quote(x) for x in args.command))
+    else:
+        shell.cmdloop()
+    return shell
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Script containing the persistent cache of fetched routes"""
+import sqlite3
+import time
+
+# element statuses that will not change when the route is queried again
+FINAL_STATUSES = {"OK", "NOT_FOUND", "ZERO_RESULTS",
+                  "MAX_ROUTE_LENGTH_EXCEEDED"}
+
+
+def normalize_address(address):
+    """
+    Normalize an address for comparisons by collapsing whitespace and
+    ignoring case.
+    :param address: address string
+    :return: normalized address string
+    """
+    return " ".join(str(address).split()).casefold()
+
+
+class RouteCache:
+    """On-disk SQLite cache of routes keyed by (origin, destination, mode).
+
+    Results are committed as soon as they are stored, so an interrupted
+    fetch resumes with the routes it already received.
+    """
+
+    def __init__(self, path='data/route_cache.sqlite', ttl=None):
+        """
+        Open or create the cache.
+        :param path: file path of the SQLite database
+        :param ttl: seconds after which entries expire, never if None
+        """
+        self.path = path
+        self.ttl = ttl
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS routes ("
+            "origin TEXT NOT NULL, destination TEXT NOT NULL, "
+            "mode TEXT NOT NULL, distance REAL, duration REAL, "
+            "status TEXT NOT NULL, fetched_at REAL NOT NULL, "
+            "PRIMARY KEY (origin, destination, mode))")
+        self.connection.commit()
+
+    @staticmethod
+    def _key(origin, destination, mode):
+        return normalize_address(origin), normalize_address(destination), mode
+
+    def _oldest_valid(self):
+        return time.time() - self.ttl if self.ttl is not None else None
+
+    def get_many(self, keys):
+        """
+        Look up routes in the cache, skipping expired entries.
+        :param keys: iterable of (origin, destination, mode) tuples
+        :return: dict from the given keys to (distance, duration, status)
+        """
+        oldest = self._oldest_valid()
+        found = {}
+        for key in set(keys):
+            row = self.connection.execute(
+                "SELECT distance, duration, status, fetched_at FROM routes "
+                "WHERE origin = ? AND destination = ? AND mode = ?",
+                self._key(*key)).fetchone()
+            if row is None or (oldest is not None and row[3] < oldest):
+                continue
+            distance, duration, status = row[:3]
+            found[key] = (float('nan') if distance is None else distance,
+                          float('nan') if duration is None else duration,
+                          status)
+        return found
+
+    def put_many(self, results):
+        """
+        Store fetched routes. Routes whose status may change on a retry,
+        such as over quota failures, are not stored.
+        :param results: dict from (origin, destination, mode) to (distance,
+        duration, status)
+        :return:
+        """
+        now = time.time()
+        rows = []
+        for key, (distance, duration, status) in results.items():
+            if status not in FINAL_STATUSES:
+                continue
+            rows.append(self._key(*key) + (
+                None if distance != distance else float(distance),
+                None if duration != duration else float(duration),
+                status, now))
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO routes VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows)
+        self.connection.commit()
+
+    def purge_expired(self):
+        """
+        Delete all expired entries from the cache.
+        :return: number of deleted entries
+        """
+        oldest = self._oldest_valid()
+        if oldest is None:
+            return 0
+        cursor = self.connection.execute(
+            "DELETE FROM routes WHERE fetched_at < ?", (oldest,))
+        self.connection.commit()
+        return cursor.rowcount
+
+    def __len__(self):
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM routes").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
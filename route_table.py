@@ -0,0 +1,127 @@
+"""Script containing class for the shared route table of the pipeline"""
+import pandas as pd
+
+
+class MissingRouteError(IndexError):
+    """Raised when a route is not present in the route table.
+
+    Subclasses IndexError, which is what the former boolean mask lookup
+    raised for missing routes, so existing handlers keep working.
+    """
+
+
+class RouteTable:
+    """Read-only view of the routes saved in the address csv file.
+
+    The table is loaded once per pipeline run and shared by all student
+    practice pairs, so the address file is parsed once instead of once per
+    pair.
+    """
+
+    __slots__ = ('_addresses_df', '_duration_index', '_max_duration')
+
+    def __init__(self, addresses_df):
+        """
+        Initialize the route table from an already loaded dataframe.
+        :param addresses_df: df with stud_add, prac_add, is_car and duration
+        """
+        object.__setattr__(self, '_addresses_df', addresses_df.copy())
+        # built on the first lookup, the vectorized engine never needs it
+        object.__setattr__(self, '_duration_index', None)
+        object.__setattr__(self, '_max_duration', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("RouteTable is immutable")
+
+    def __reduce__(self):
+        return RouteTable, (self._addresses_df,)
+
+    @classmethod
+    def from_csv(cls, address_path='data/addresses.csv'):
+        """
+        Load the route table from the tab separated address file.
+        :param address_path: file path for address file
+        :return: RouteTable
+        """
+        # addresses repeat across many routes, keep each string once
+        return cls(pd.read_csv(address_path, sep="\t",
+                               dtype={'stud_add': 'category',
+                                      'prac_add': 'category'}))
+
+    @property
+    def df(self):
+        """
+        Gets the underlying routes dataframe. It must not be modified.
+        :return:
+        """
+        return self._addresses_df
+
+    @property
+    def max_duration(self):
+        """
+        Gets the longest duration of all routes, computed once.
+        :return: duration in seconds
+        """
+        if self._max_duration is None:
+            object.__setattr__(self, '_max_duration',
+                               self._addresses_df['duration'].max())
+        return self._max_duration
+
+    def address_ids(self, address_book):
+        """
+        Intern the student and practice addresses of all routes.
+        :param address_book: AddressBook
+        :return: int32 arrays of the student and practice address ids of
+        every row
+        """
+        ids = []
+        for column in ['stud_add', 'prac_add']:
+            addresses = self._addresses_df[column]
+            if isinstance(addresses.dtype, pd.CategoricalDtype):
+                ids.append(address_book.intern_categorical(addresses))
+            else:
+                ids.append(address_book.intern(addresses.to_numpy(
+                    dtype=object)))
+        return tuple(ids)
+
+    @staticmethod
+    def _build_duration_index(addresses_df):
+        """
+        Build a hash index from (student address, practice address, is_car)
+        to the travel duration. If a route is listed more than once the first
+        row wins, as it did with the boolean mask lookup.
+        :param addresses_df:
+        :return: dict
+        """
+        if 'duration' not in addresses_df.columns:
+            return {}
+
+        keys = zip(addresses_df['stud_add'].tolist(),
+                   addresses_df['prac_add'].tolist(),
+                   addresses_df['is_car'].astype(int).tolist())
+        index = {}
+        for key, duration in zip(keys, addresses_df['duration'].tolist()):
+            index.setdefault(key, duration)
+        return index
+
+    def get_duration(self, stud_add, prac_add, is_car):
+        """
+        Look up the travel duration of a route in constant time.
+        :param stud_add: address of the student
+        :param prac_add: address of the practice
+        :param is_car: 1 for the car route, 0 for the bike route
+        :return: duration in seconds
+        :raises MissingRouteError: if the route is not in the table
+        """
+        if self._duration_index is None:
+            object.__setattr__(self, '_duration_index',
+                               self._build_duration_index(self._addresses_df))
+        try:
+            return self._duration_index[(stud_add, prac_add, int(is_car))]
+        except KeyError:
+            raise MissingRouteError(
+                "No route from '{}' to '{}' (is_car={}) in the route "
+                "table".format(stud_add, prac_add, int(is_car))) from None
+
+    def __len__(self):
+        return len(self._addresses_df)
@@ -0,0 +1,121 @@
+"""Sweep of the pair weight coefficients over a grid of weight vectors"""
+import argparse
+import itertools
+import numpy as np
+import pandas as pd
+from data_store import DataStore
+from pruning import load_candidates
+from route_table import RouteTable
+from weight_engine import WeightMatrix, WEIGHT_COEFFICIENTS
+
+SWEEP_COLUMNS = ["duration", "specialty", "children", "changed_students",
+                 "practices_used", "mean_duration_minutes", "mean_matches"]
+
+
+def pair_features(weight_matrix):
+    """
+    Stack the terms of the pair weight before they are weighted.
+    :param weight_matrix: WeightMatrix
+    :return: float array of shape (S, P, 3) with the duration saved against
+    the longest route, the matching specialities and the children of every
+    pair, NaN for pairs which were not scored
+    """
+    n_stud, n_prac = weight_matrix.weights.shape
+    return np.stack([weight_matrix.max_duration - weight_matrix.durations,
+                     weight_matrix.match_counts.astype(float),
+                     np.broadcast_to(weight_matrix.children[:, None],
+                                     (n_stud, n_prac)).astype(float)],
+                    axis=2)
+
+
+def best_practices(features, coefficients, chunk_elements=2 ** 24):
+    """
+    Find the best practice of every student under every weight vector.
+
+    The weights of all vectors are one matrix product of the features with
+    the coefficients, evaluated a chunk of students at a time to bound the
+    memory. Ties resolve to the first practice like select_top_pairs.
+    :param features: float array of shape (S, P, 3)
+    :param coefficients: float array of shape (V, 3)
+    :param chunk_elements: maximum students x practices x vectors evaluated
+    at once
+    :return: int array of shape (S, V) with practice positions, -1 for
+    students without any scored pair
+    """
+    n_stud, n_prac, _ = features.shape
+    step = max(1, chunk_elements // max(1, n_prac * len(coefficients)))
+    best = np.empty((n_stud, len(coefficients)), dtype=int)
+    for start in range(0, n_stud, step):
+        weights = features[start:start + step] @ coefficients.T / 100
+        scored = ~np.isnan(weights)
+        best[start:start + step] = np.where(
+            scored.any(axis=1),
+            np.where(scored, weights, -np.inf).argmax(axis=1), -1)
+    return best
+
+
+def sweep_weights(weight_matrix, coefficients, baseline=WEIGHT_COEFFICIENTS):
+    """
+    Evaluate a grid of weight vectors on the components of one weight
+    matrix and report how the best practices of the students shift.
+    :param weight_matrix: WeightMatrix
+    :param coefficients: iterable of (duration, specialty, children)
+    coefficient tuples
+    :param baseline: coefficients the changed students are counted against
+    :return: df with one row per weight vector, and int array of shape
+    (S, V) with the best practice position of every student per vector
+    """
+    features = pair_features(weight_matrix)
+    coefficients = np.asarray(list(coefficients), dtype=float).reshape(-1, 3)
+    best = best_practices(features, np.vstack([baseline, coefficients]))
+    baseline_best, best = best[:, 0], best[:, 1:]
+
+    rows = []
+    students = np.arange(len(best))
+    for vector in range(len(coefficients)):
+        chosen = best[:, vector]
+        assigned = chosen >= 0
+        rows.append(list(coefficients[vector]) + [
+            int((chosen != baseline_best).sum()),
+            len(np.unique(chosen[assigned])),
+            np.nanmean(weight_matrix.durations[students[assigned],
+                                               chosen[assigned]]) / 60,
+            weight_matrix.match_counts[students[assigned],
+                                       chosen[assigned]].mean()])
+    return pd.DataFrame(rows, columns=SWEEP_COLUMNS), best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compare the best pairs of a grid of weight vectors")
+    parser.add_argument("--duration", nargs="+", type=float,
+                        default=[WEIGHT_COEFFICIENTS[0]],
+                        help="coefficients of the duration term")
+    parser.add_argument("--specialty", nargs="+", type=float,
+                        default=[WEIGHT_COEFFICIENTS[1]],
+                        help="coefficients of the matching specialities")
+    parser.add_argument("--children", nargs="+", type=float,
+                        default=[WEIGHT_COEFFICIENTS[2]],
+                        help="coefficients of the children term")
+    parser.add_argument("--output", default="data/weight_sweep.csv",
+                        help="file path of the sweep report")
+    args = parser.parse_args(argv)
+
+    ds = DataStore()
+    ds.read_practices_from_csv_file("data/practices.csv")
+    ds.read_students_from_csv_file("data/students.csv")
+    # pairs pruned by the last run are not scored
+    load_candidates(ds)
+    weight_matrix = WeightMatrix(ds, RouteTable.from_csv('data/addresses.csv'))
+
+    grid = list(itertools.product(args.duration, args.specialty,
+                                  args.children))
+    print("Sweeping {} weight vectors..".format(len(grid)))
+    report, _ = sweep_weights(weight_matrix, grid)
+    report.to_csv(args.output, sep="\t", index=False)
+    print("Sweep report saved at " + args.output)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Script containing the regional sharding of the roster by postal code"""
+import numpy as np
+import pandas as pd
+
+# five digit postal code in an address string
+POSTAL_CODE_PATTERN = r'\b(\d{5})\b'
+
+
+def postal_regions(addresses, prefix_length=2):
+    """
+    Get the region of addresses from the leading digits of their postal
+    code.
+    :param addresses: iterable of address strings
+    :param prefix_length: number of leading postal code digits of a region
+    :return: object array of region keys, "" for addresses without postal
+    code
+    """
+    codes = pd.Series(list(addresses), dtype=object).str.extract(
+        POSTAL_CODE_PATTERN, expand=False)
+    return codes.str[:prefix_length].fillna("").to_numpy(dtype=object)
+
+
+def plan_shards(data_store, prefix_length=2, border=0):
+    """
+    Partition the students by the region of their main address and give
+    every shard the practices of its region and of the regions within the
+    border.
+
+    Regions are compared by their postal code prefix as a number, e.g. with
+    a border of 5 the shard of region 60 also gets the practices of 55 to
+    65. Students without postal code form one shard with all practices and
+    practices without postal code are part of every shard.
+    :param data_store:
+    :param prefix_length: number of leading postal code digits of a region
+    :param border: largest difference of the prefixes of a shard and the
+    practices it includes from other regions
+    :return: list of (region, student positions, practice positions), every
+    student in exactly one shard and the positions in datastore order
+    """
+    stud_regions = postal_regions(data_store.df_students['address'],
+                                  prefix_length)
+    prac_regions = postal_regions(data_store.df_practices['address'],
+                                  prefix_length)
+    unknown = prac_regions == ""
+    prac_numbers = np.array([int(region) if region else -1
+                             for region in prac_regions])
+
+    shards = []
+    for region in sorted(set(stud_regions)):
+        if region:
+            near = np.abs(prac_numbers - int(region)) <= border
+            practices = np.flatnonzero(near | unknown)
+        else:
+            practices = np.arange(len(prac_regions))
+        shards.append((region, np.flatnonzero(stud_regions == region),
+                       practices))
+    return shards
+
+
+def select_shard(data_store, shard):
+    """
+    Make a datastore holding only the students and practices of a shard.
+    :param data_store:
+    :param shard: (region, student positions, practice positions)
+    :return: DataStore
+    """
+    _, students, practices = shard
+    return data_store.select_students(students).select_practices(practices)
+
+
+def build_sharded_address_frame(data_store, shards):
+    """
+    Make the bike and car combinations of the addresses within every shard,
+    so only the routes of pairs of a shard are fetched.
+    :param data_store:
+    :param shards: list of (region, student positions, practice positions)
+    :return: df with stud_add, prac_add and is_car
+    """
+    frames = [select_shard(data_store, shard).build_address_frame()
+              for shard in shards]
+    if not frames:
+        return data_store.select_students([]).build_address_frame()
+    return pd.concat(frames, ignore_index=True).drop_duplicates(
+        ignore_index=True)
+
+
+def describe_shards(data_store, shards):
+    """
+    Print the size of every shard and the pairs left out of the full cross
+    product.
+    :param data_store:
+    :param shards: list of (region, student positions, practice positions)
+    :return: number of pairs of all shards
+    """
+    n_pairs = 0
+    for region, students, practices in shards:
+        print("Shard {}: {} students, {} practices".format(
+            region or "without postal code", len(students), len(practices)))
+        n_pairs += len(students) * len(practices)
+    n_all = len(data_store.df_students) * len(data_store.df_practices)
+    print("{} shards score {} of {} pairs".format(
+        len(shards), n_pairs, n_all))
+    return n_pairs
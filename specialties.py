@@ -0,0 +1,125 @@
+"""Script containing the specialty vocabulary and its encodings"""
+import os
+import re
+import numpy as np
+import pandas as pd
+
+
+def normalize_specialty(name):
+    """
+    Normalize a specialty name the way specialities are compared.
+    :param name:
+    :return: lowercase name without surrounding whitespace
+    """
+    return name.lower().strip()
+
+
+def split_specialties(specialties):
+    """
+    Split a comma separated specialties string into normalized names.
+    :param specialties: string or NaN
+    :return: list
+    """
+    if pd.isna(specialties):
+        return []
+    return [normalize_specialty(x) for x in specialties.split(',')]
+
+
+def load_specialty_vocabulary(path='data/specialties.ts'):
+    """
+    Read the canonical specialty names from the typescript vocabulary file.
+    :param path: file path of specialties.ts
+    :return: list of names, empty if the file does not exist
+    """
+    if not os.path.isfile(path):
+        return []
+    with open(path, encoding='utf-8') as ts_file:
+        return re.findall(r'"([^"]*)"', ts_file.read())
+
+
+class SpecialtyIndex:
+    """Positions of the known specialty names, used to encode specialties
+    as rows of a boolean matrix or as packed integer bitmasks."""
+
+    def __init__(self, vocabulary):
+        """
+        Initialize the index with the canonical vocabulary.
+        :param vocabulary: list of specialty names
+        """
+        self.names = []
+        self.positions = {}
+        self.unknown = []
+        for name in vocabulary:
+            self._add(normalize_specialty(name))
+
+    def _add(self, name):
+        if name not in self.positions:
+            self.positions[name] = len(self.names)
+            self.names.append(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def encode(self, specialties):
+        """
+        Encode comma separated specialties strings as a boolean matrix.
+
+        Names missing from the vocabulary are appended to the index, so they
+        still match between students and practices, and are recorded in
+        self.unknown.
+        :param specialties: iterable of strings or NaN
+        :return: bool array of shape (N, len(self)) after encoding
+        """
+        rows = [split_specialties(x) for x in specialties]
+        for name in (name for row in rows for name in row):
+            if name not in self.positions:
+                self.unknown.append(name)
+                self._add(name)
+
+        matrix = np.zeros((len(rows), len(self.names)), dtype=bool)
+        for i, row in enumerate(rows):
+            matrix[i, [self.positions[name] for name in row]] = True
+        return matrix
+
+    def pad(self, matrix):
+        """
+        Widen a matrix encoded before names were appended to the index.
+        :param matrix: bool array of shape (N, V)
+        :return: bool array of shape (N, len(self))
+        """
+        return np.pad(matrix, ((0, 0), (0, len(self.names) -
+                                        matrix.shape[1])))
+
+    @staticmethod
+    def pack(matrix):
+        """
+        Pack the rows of a boolean matrix into 64 bit integer bitmasks.
+        :param matrix: bool array of shape (N, V)
+        :return: uint64 array of shape (N, ceil(V / 64))
+        """
+        n_words = max(1, -(-matrix.shape[1] // 64))
+        padded = np.zeros((matrix.shape[0], n_words * 64), dtype=bool)
+        padded[:, :matrix.shape[1]] = matrix
+        bits = padded.reshape(len(matrix), n_words, 64).astype(np.uint64)
+        return (bits << np.arange(64, dtype=np.uint64)).sum(
+            axis=2, dtype=np.uint64)
+
+    def decode(self, masks):
+        """
+        Decode packed bitmasks into comma separated specialty names.
+
+        Each distinct mask is decoded once, so decoding the pairs of an
+        output file costs one pass over the masks.
+        :param masks: uint64 array of shape (N, W)
+        :return: list of N strings
+        """
+        unique, inverse = np.unique(masks, axis=0, return_inverse=True)
+        words = np.arange(unique.shape[1] * 64) // 64
+        bits = np.arange(unique.shape[1] * 64) % 64
+        decoded = []
+        for mask in unique:
+            present = (mask[words] >> bits.astype(np.uint64)) & np.uint64(1)
+            decoded.append(", ".join(self.names[i] for i in
+                                     np.flatnonzero(present)
+                                     if i < len(self.names)))
+        return [decoded[i] for i in inverse.ravel()]
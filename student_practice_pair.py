@@ -1,21 +1,42 @@
 """Script containing class for a combination of student and practice pairs."""
 import pandas as pd
+from data_store import ADDRESS_SLOTS
+from route_table import RouteTable
+from weight_engine import WEIGHT_COEFFICIENTS, TRAVEL_MODES
+
+# address slot of the duration keys, which end with the is_car flag
+DURATION_SLOTS = {'main_duration': 0, 'alter_duration1': 1,
+                  'alter_duration2': 2}
 
 
 class StudentPracticePair:
     """Class incorporating pairs of student and practice pandas instances."""
 
-    def __init__(self, student, practice, address_path='data/addresses.csv'):
+    __slots__ = ('student', 'practice', 'route_table', 'addresses_df',
+                 'max_duration', 'durations', '_fastest_route')
+
+    def __init__(self, student, practice, address_path='data/addresses.csv',
+                 route_table=None, max_duration=None):
         """
         Intialize the student and practice instance.
         :param student: student series instance
         :param practice: practice series instance
-        :param address_path: file path for address file
+        :param address_path: file path for address file, only read when no
+        route table is given
+        :param route_table: shared RouteTable loaded once per pipeline run
+        :param max_duration: longest duration of the route table, taken from
+        the route table if None
         """
         self.student = student
         self.practice = practice
-        self.addresses_df = pd.read_csv(address_path, sep="\t")
+        if route_table is None:
+            route_table = RouteTable.from_csv(address_path)
+        self.route_table = route_table
+        self.addresses_df = route_table.df
+        self.max_duration = route_table.max_duration \
+            if max_duration is None else max_duration
         self.durations = {}
+        self._fastest_route = None
         self.fetch_durations_for_all_addresses()
 
     def _fetch_travel_duration(self, stud_add, has_car):
@@ -27,17 +48,42 @@ class StudentPracticePair:
         :param stud_add: Address of the student
         :param has_car: fetch duration for car or bike
         :return:
+        :raises MissingRouteError: if the route has not been fetched
         """
         prac_address = self.get_practice_address()
-        duration = self.addresses_df[
-            (self.addresses_df['stud_add'] == stud_add)
-            & (self.addresses_df['prac_add'] == prac_address)
-            & (self.addresses_df['is_car'] == has_car)]['duration'].tolist()[0]
-
-        return duration
+        return self.route_table.get_duration(stud_add, prac_address, has_car)
 
     def _find_max_travel_duration(self):
-        return self.addresses_df['duration'].max()
+        return self.max_duration
+
+    def _get_fastest_route(self):
+        """
+        Find the route with the shortest duration once and remember it. Ties
+        go to the bike and then to the main address, in the order the
+        durations were stored.
+        :return: (address slot, is_car, duration) tuple, the main address by
+        bike with a NaN duration if no route could be fetched
+        """
+        if self._fastest_route is None and not self.durations:
+            # the pair is not scored, like in the WeightMatrix
+            self._fastest_route = (0, 0, float('nan'))
+        elif self._fastest_route is None:
+            min_key = min(self.durations, key=self.durations.get)
+            self._fastest_route = (DURATION_SLOTS[min_key[:-1]],
+                                   int(min_key[-1]),
+                                   self.durations[min_key])
+        return self._fastest_route
+
+    def _store_duration(self, key, duration):
+        """
+        Store a duration, skipping routes the API could not fetch.
+        :param key:
+        :param duration:
+        :return:
+        """
+        if not pd.isna(duration):
+            self.durations[key] = duration
+            self._fastest_route = None
 
     def _compute_durations_on_diff_addrs(self, stud_address, stud_alternate_1,
                                          stud_alternate_2, has_car):
@@ -51,7 +97,7 @@ class StudentPracticePair:
         """
         main_duration = self._fetch_travel_duration(stud_address,
                                                     has_car)
-        self.durations['main_duration' + str(has_car)] = main_duration
+        self._store_duration('main_duration' + str(has_car), main_duration)
 
         if not pd.isna(stud_alternate_1):
             alter_duration1 = self._fetch_travel_duration(stud_alternate_1,
@@ -59,12 +105,14 @@ class StudentPracticePair:
             # add has_car in key so that keys do not override
             # All bicycle durations will have 0 at the end of the key
             # and all car durations will have 1 at the end of the key
-            self.durations['alter_duration1' + str(has_car)] = alter_duration1
+            self._store_duration('alter_duration1' + str(has_car),
+                                 alter_duration1)
 
         if not pd.isna(stud_alternate_2):
             alter_duration2 = self._fetch_travel_duration(stud_alternate_2,
                                                           has_car)
-            self.durations['alter_duration2' + str(has_car)] = alter_duration2
+            self._store_duration('alter_duration2' + str(has_car),
+                                 alter_duration2)
 
     def fetch_durations_for_all_addresses(self):
         """
@@ -129,8 +177,10 @@ class StudentPracticePair:
         match_specialities = len(self.find_intersecting_specialities())
         children = self.has_children()
 
-        weight = ((0.2 * duration_weight) + (99 * match_specialities) +
-                  (0.8 * children)) / 100
+        duration_coef, specialty_coef, children_coef = WEIGHT_COEFFICIENTS
+        weight = ((duration_coef * duration_weight) +
+                  (specialty_coef * match_specialities) +
+                  (children_coef * children)) / 100
         return weight
 
     def has_children(self):
@@ -159,16 +209,7 @@ class StudentPracticePair:
         Fetch address of the student with the shortest duration to practice.
         :return:
         """
-        min_key = min(self.durations, key=self.durations.get)
-
-        if min_key.startswith("main"):
-            return self.student['address']
-
-        elif min_key.startswith("alter_duration1"):
-            return self.student['alternativeAddress1']
-
-        else:
-            return self.student['alternativeAddress2']
+        return self.student[ADDRESS_SLOTS[self._get_fastest_route()[0]]]
 
     def get_practice_address(self):
         """
@@ -183,18 +224,11 @@ class StudentPracticePair:
         of the student against the practice.
         :return:
         """
-        return min(self.durations.values())
+        return self._get_fastest_route()[2]
 
     def get_fastest_transport_mode(self):
         """
         Check which transport is fastest, bike or car.
         :return:
         """
-        # find the key of the minimum value
-        min_key = min(self.durations, key=self.durations.get)
-
-        # all bicycle travel durations have a zero appended in their key
-        if min_key.endswith('0'):
-            return "bicycle"
-        else:
-            return "Car"
+        return TRAVEL_MODES[self._get_fastest_route()[1]]
@@ -1,7 +1,39 @@
+import contextlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
 import unittest
-from data_store import DataStore
+import numpy as np
+import pandas as pd
+from data_store import DataStore, ADDRESS_SLOTS
 from student_practice_pair import StudentPracticePair
-from google_api import GoogleAPI
+from google_api import GoogleAPI, RateLimiter, build_request_tiles
+from googlemaps.exceptions import ApiError, Timeout
+import google_api
+from route_table import RouteTable, MissingRouteError
+from route_cache import RouteCache
+from address_book import AddressBook
+from specialties import SpecialtyIndex, load_specialty_vocabulary
+from weight_engine import WeightMatrix, DurationLookup, build_duration_tensor
+import weight_combination
+import weight_engine
+import assignment
+import benchmark
+import instrumentation
+import matrix_store
+import incremental
+import distance_estimator
+import pruning
+import sensitivity
+import query_service
+import pipeline
+import sharding
+import config
+import cli
+import main
 
 
 class DataStoreTests(unittest.TestCase):
@@ -62,6 +94,57 @@ class DataStoreTests(unittest.TestCase):
 
         self.assertEqual(len(car_list), 0)
 
+    def test_build_address_frame(self):
+        self.ds.read_students_from_csv_file("data/test_data/students.csv")
+        self.ds.read_practices_from_csv_file("data/test_data/practices.csv")
+
+        addr_df = self.ds.build_address_frame()
+        expected = pd.read_csv("data/test_data/addresses.csv", sep="\t")
+        self.assertTrue(addr_df.equals(
+            expected[['stud_add', 'prac_add', 'is_car']]))
+
+    def test_build_address_frame_drops_duplicates(self):
+        self.ds.read_students_from_csv_file("data/test_data/students.csv")
+        self.ds.read_practices_from_csv_file("data/test_data/practices.csv")
+        # second student lives at the first one's address and has a car
+        self.ds.df_students.loc['S002', 'address'] = \
+            self.ds.df_students.loc['S001', 'address']
+        self.ds.df_students.loc['S002', 'hasCar'] = 1
+
+        addr_df = self.ds.build_address_frame()
+        self.assertFalse(addr_df.duplicated().any())
+        self.assertEqual(len(addr_df), 10 + 6)
+
+
+class AddressBookTests(unittest.TestCase):
+
+    def test_intern_and_decode(self):
+        book = AddressBook()
+        ids = book.intern(np.array([["Im Wörth 8, 60433 Frankfurt",
+                                     np.nan],
+                                    ["im  wörth 8,  60433 frankfurt",
+                                     "Niedenau 51, 60325 Frankfurt"]],
+                                   dtype=object))
+        np.testing.assert_array_equal(ids, [[0, -1], [0, 1]])
+        self.assertEqual(ids.dtype, np.int32)
+        self.assertEqual(book.decode(ids)[1, 0], "Im Wörth 8, 60433 Frankfurt")
+        self.assertTrue(pd.isna(book.decode(ids)[0, 1]))
+        self.assertEqual(book.lookup(["Storchgasse 2"]).tolist(), [-1])
+        self.assertEqual(len(book), 2)
+
+    def test_route_table_address_ids(self):
+        ds = DataStore()
+        ds.read_students_from_csv_file("data/test_data/students.csv")
+        route_table = RouteTable.from_csv("data/test_data/addresses.csv")
+        self.assertIsInstance(route_table.df['stud_add'].dtype,
+                              pd.CategoricalDtype)
+        stud_ids, _ = route_table.address_ids(ds.address_book)
+        self.assertEqual(stud_ids.dtype, np.int32)
+        self.assertEqual(ds.address_book.decode(stud_ids).tolist(),
+                         route_table.df['stud_add'].tolist())
+        self.assertTrue(set(stud_ids) <=
+                        set(ds.get_student_address_ids().ravel()))
+
 
 class StudentPracticePairTests(unittest.TestCase):
 
@@ -115,6 +198,1133 @@ class StudentPracticePairTests(unittest.TestCase):
     def test_requires_relocation(self):
         self.assertEqual(self.pair.requires_relocation(), "Alternative 2")
 
+    def test_fastest_route_memoized(self):
+        self.assertFalse(hasattr(self.pair, '__dict__'))
+        self.assertEqual(self.pair._get_fastest_route(), (2, 0, 116))
+        self.assertEqual(self.pair._find_max_travel_duration(),
+                         self.pair.route_table.max_duration)
+        pair = StudentPracticePair(self.ds.df_students.loc['S001'],
+                                   self.ds.df_practices.loc['P001'],
+                                   route_table=self.pair.route_table,
+                                   max_duration=5000)
+        self.assertEqual(pair.get_pair_weight(),
+                         ((0.2 * (5000 - 116)) + (99 * 1) + 0) / 100)
+
+
+class SpecialtyTests(unittest.TestCase):
+
+    def test_load_specialty_vocabulary(self):
+        vocabulary = load_specialty_vocabulary()
+        self.assertEqual(len(vocabulary), 76)
+        self.assertEqual(vocabulary[0], "Sportmedizin")
+
+    def test_encode_reports_unknown(self):
+        index = SpecialtyIndex(["Sportmedizin", "Notfallmedizin"])
+        matrix = index.encode(["Notfallmedizin, Zahnmedizin ", np.nan])
+        self.assertEqual(index.unknown, ["zahnmedizin"])
+        self.assertEqual(matrix.tolist(), [[False, True, True],
+                                           [False, False, False]])
+
+    def test_pack_and_decode(self):
+        index = SpecialtyIndex(load_specialty_vocabulary())
+        matrix = index.encode(["Transplantationsmedizin, Sportmedizin",
+                               "Arbeitsmedizin"])
+        masks = index.pack(matrix)
+        self.assertEqual(masks.shape, (2, 2))
+        self.assertEqual(index.decode(masks),
+                         ["sportmedizin, transplantationsmedizin",
+                          "arbeitsmedizin"])
+
+    def test_match_counts(self):
+        ds = DataStore()
+        ds.read_students_from_csv_file("data/students.csv")
+        ds.read_practices_from_csv_file("data/practices.csv")
+        counts = ds.get_match_counts()
+        pair = StudentPracticePair(ds.df_students.loc['S004'],
+                                   ds.df_practices.loc['P003'])
+        self.assertEqual(counts[3, 2],
+                         len(pair.find_intersecting_specialities()))
+        self.assertEqual(counts[3, 2], 2)
+        self.assertEqual(counts.shape, (50, 50))
+
+
+class RouteTableTests(unittest.TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(RouteTableTests, self).__init__(*args, **kwargs)
+        self.ds = DataStore()
+        self.ds.read_students_from_csv_file("data/test_data/students.csv")
+        self.ds.read_practices_from_csv_file("data/test_data/practices.csv")
+        self.route_table = RouteTable.from_csv("data/test_data/addresses.csv")
+
+    def test_from_csv(self):
+        self.assertEqual(len(self.route_table), 12)
+
+    def test_get_duration(self):
+        self.assertEqual(self.route_table.get_duration(
+            'Storchgasse 2, 65929 Frankfurt am Main',
+            'Kurmainzer Straße 160, 65936 Frankfurt am Main', 0), 476)
+
+    def test_get_duration_missing_route(self):
+        with self.assertRaises(MissingRouteError):
+            self.route_table.get_duration(
+                'Storchgasse 2, 65929 Frankfurt am Main',
+                'Kurmainzer Straße 160, 65936 Frankfurt am Main', 1)
+        # still an IndexError as with the former mask lookup
+        with self.assertRaises(IndexError):
+            self.route_table.get_duration('nowhere', 'nowhere', 0)
+
+    def test_immutable(self):
+        with self.assertRaises(AttributeError):
+            self.route_table.extra = 1
+
+    def test_shared_by_pairs(self):
+        pair1 = StudentPracticePair(self.ds.df_students.loc['S001'],
+                                    self.ds.df_practices.loc['P001'],
+                                    route_table=self.route_table)
+        pair2 = StudentPracticePair(self.ds.df_students.loc['S002'],
+                                    self.ds.df_practices.loc['P002'],
+                                    route_table=self.route_table)
+        self.assertIs(pair1.route_table, pair2.route_table)
+        self.assertEqual(pair1.get_fastest_transport_duration(), 116)
+        self.assertEqual(pair2.get_fastest_transport_duration(), 476)
+
+
+class WeightEngineTests(unittest.TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(WeightEngineTests, self).__init__(*args, **kwargs)
+        self.ds = DataStore()
+        self.ds.read_students_from_csv_file("data/test_data/students.csv")
+        self.ds.read_practices_from_csv_file("data/test_data/practices.csv")
+        self.route_table = RouteTable.from_csv("data/test_data/addresses.csv")
+
+    def test_build_duration_tensor(self):
+        tensor = build_duration_tensor(self.ds.df_students,
+                                       self.ds.df_practices,
+                                       self.route_table)
+        self.assertEqual(tensor.shape, (2, 3, 2, 2))
+        self.assertEqual(tensor[0, 2, 0, 0], 116)
+        # nobody in the test data has a car
+        self.assertTrue(np.isnan(tensor[:, :, 1, :]).all())
+
+    def test_weight_matrix(self):
+        matrix = WeightMatrix(self.ds, self.route_table)
+        pair = StudentPracticePair(self.ds.df_students.loc['S001'],
+                                   self.ds.df_practices.loc['P001'],
+                                   route_table=self.route_table)
+        self.assertEqual(matrix.weights[0, 0], pair.get_pair_weight())
+        self.assertEqual(matrix.durations[0, 0], 116)
+        self.assertEqual(matrix.slots[0, 0], 2)
+        self.assertEqual(matrix.modes[0, 0], 0)
+
+    def test_vectorized_matches_pairwise(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            vectorized_path = os.path.join(tmp, "vectorized.csv")
+            pairwise_path = os.path.join(tmp, "pairwise.csv")
+            weight_combination.create_all_weight_combinations(
+                self.ds, self.route_table, output_path=vectorized_path)
+            weight_combination.create_all_weight_combinations(
+                self.ds, self.route_table, output_path=pairwise_path,
+                vectorized=False)
+            with open(vectorized_path) as f1, open(pairwise_path) as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+    def test_pairwise_without_routes(self):
+        # every route of S001 to P001 failed
+        student = self.ds.df_students.loc['S001']
+        routes = self.route_table.df.copy()
+        failed = routes['stud_add'].isin(student[ADDRESS_SLOTS]) & \
+            (routes['prac_add'] == self.ds.df_practices.loc['P001',
+                                                            'address'])
+        routes.loc[failed, 'duration'] = np.nan
+        route_table = RouteTable(routes)
+
+        pair = StudentPracticePair(student, self.ds.df_practices.loc['P001'],
+                                   route_table=route_table)
+        self.assertTrue(np.isnan(pair.get_pair_weight()))
+        self.assertEqual(pair.get_fastest_transport_mode(), "bicycle")
+        with tempfile.TemporaryDirectory() as tmp:
+            vectorized_path = os.path.join(tmp, "vectorized.csv")
+            pairwise_path = os.path.join(tmp, "pairwise.csv")
+            weight_combination.create_all_weight_combinations(
+                self.ds, route_table, output_path=vectorized_path)
+            weight_combination.create_all_weight_combinations(
+                self.ds, route_table, output_path=pairwise_path,
+                vectorized=False)
+            with open(vectorized_path) as f1, open(pairwise_path) as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+    def test_streaming_matches_full(self):
+        ds = DataStore()
+        ds.read_students_from_csv_file("data/students.csv")
+        ds.read_practices_from_csv_file("data/practices.csv")
+        route_table = RouteTable.from_csv("data/addresses.csv")
+        with tempfile.TemporaryDirectory() as tmp:
+            full_path = os.path.join(tmp, "full.csv")
+            stream_path = os.path.join(tmp, "stream.csv")
+            weight_df = weight_combination.create_all_weight_combinations(
+                ds, route_table, output_path=full_path)
+            top_df = weight_combination.stream_all_weight_combinations(
+                ds, route_table, output_path=stream_path, chunk_size=7,
+                top_k=2)
+            with open(full_path) as f1, open(stream_path) as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+        self.assertEqual(len(top_df), 2 * 50)
+        expected = weight_combination.select_top_pairs(ds, weight_df,
+                                                       top_k=2)
+        selected = weight_combination.select_top_pairs(ds, top_df, top_k=2)
+        self.assertTrue(selected.equals(expected))
+
+    def test_parallel_matches_serial(self):
+        ds = DataStore()
+        ds.read_students_from_csv_file("data/students.csv")
+        ds.read_practices_from_csv_file("data/practices.csv")
+        route_table = RouteTable.from_csv("data/addresses.csv")
+        with tempfile.TemporaryDirectory() as tmp:
+            serial_path = os.path.join(tmp, "serial.csv")
+            parallel_path = os.path.join(tmp, "parallel.csv")
+            weight_combination.create_all_weight_combinations(
+                ds, route_table, output_path=serial_path)
+            weight_combination.create_all_weight_combinations(
+                ds, route_table, output_path=parallel_path, workers=2)
+            with open(serial_path) as f1, open(parallel_path) as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+
+class BestPairsTests(unittest.TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(BestPairsTests, self).__init__(*args, **kwargs)
+        self.ds = DataStore()
+        self.ds.read_students_from_csv_file("data/test_data/students.csv")
+        self.ds.read_practices_from_csv_file("data/test_data/practices.csv")
+        self.weight_df = pd.DataFrame(
+            [['S001', 'P001', 0.5], ['S001', 'P002', 0.7],
+             ['S002', 'P001', 0.9], ['S002', 'P002', 0.9]],
+            columns=['s_id', 'p_id', 'Weight'])
+
+    def test_select_top_pairs(self):
+        top_df = weight_combination.select_top_pairs(self.ds, self.weight_df)
+        self.assertEqual(top_df['p_id'].tolist(), ['P002', 'P001'])
+        self.assertEqual(top_df['Rank'].tolist(), [1, 1])
+
+    def test_select_top_pairs_top_k(self):
+        top_df = weight_combination.select_top_pairs(self.ds, self.weight_df,
+                                                     top_k=2)
+        self.assertEqual(top_df['s_id'].tolist(),
+                         ['S001', 'S001', 'S002', 'S002'])
+        self.assertEqual(top_df['p_id'].tolist(),
+                         ['P002', 'P001', 'P001', 'P002'])
+        self.assertEqual(top_df['Rank'].tolist(), [1, 2, 1, 2])
+
+    def test_select_top_pairs_without_weight(self):
+        # all routes of S002 and one route of S001 failed
+        weight_df = self.weight_df.assign(Weight=[np.nan, 0.7, np.nan,
+                                                  np.nan])
+        for top_k in (1, 2):
+            top_df = weight_combination.select_top_pairs(self.ds, weight_df,
+                                                         top_k=top_k)
+            self.assertEqual(top_df['s_id'].tolist(), ['S001'])
+            self.assertEqual(top_df['p_id'].tolist(), ['P002'])
+
+    def test_extract_best_weights_students(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            weight_df = weight_combination.create_all_weight_combinations(
+                self.ds, address_path="data/test_data/addresses.csv",
+                output_path=os.path.join(tmp, "all.csv"))
+            path = os.path.join(tmp, "best.csv")
+            weight_combination.extract_best_weights_students(
+                self.ds, weight_df, output_path=path)
+            best_df = pd.read_csv(path, sep="\t")
+
+        self.assertEqual(best_df.columns.tolist(),
+                         weight_combination.BEST_PAIR_COLUMNS)
+        self.assertEqual(best_df['Pair'].tolist(),
+                         ['S001<->P001', 'S002<->P002'])
+
+
+class SensitivityTests(unittest.TestCase):
+
+    def test_sweep_weights(self):
+        ds = DataStore()
+        ds.read_students_from_csv_file("data/students.csv")
+        ds.read_practices_from_csv_file("data/practices.csv")
+        weight_matrix = WeightMatrix(ds, RouteTable.from_csv(
+            "data/addresses.csv"))
+        report, best = sensitivity.sweep_weights(
+            weight_matrix, [(0.2, 99, 0.8), (0.2, 0, 0.8), (1, 99, 0)])
+
+        self.assertEqual(best.shape, (50, 3))
+        np.testing.assert_array_equal(best[:, 0],
+                                      weight_matrix.weights.argmax(axis=1))
+        self.assertEqual(report["changed_students"].tolist()[0], 0)
+        # without the specialty term only the duration decides
+        np.testing.assert_array_equal(
+            best[:, 1], weight_matrix.durations.argmin(axis=1))
+        self.assertLess(report["mean_matches"][1], report["mean_matches"][0])
+
+    def test_sweep_pruned_pairs(self):
+        ds = DataStore()
+        ds.read_students_from_csv_file("data/students.csv")
+        ds.read_practices_from_csv_file("data/practices.csv")
+        route_table = RouteTable.from_csv("data/addresses.csv")
+        full_matrix = WeightMatrix(ds, route_table)
+        pruning.prune_pairs(ds, RouteTableEstimator(route_table),
+                            k_nearest=3)
+        weight_matrix = WeightMatrix(ds, RouteTable(
+            route_table.df.merge(ds.build_address_frame())))
+        self.assertTrue(np.isnan(weight_matrix.weights[~ds.candidates]).all())
+
+        _, best = sensitivity.sweep_weights(
+            weight_matrix, [(0.2, 99, 0.8), (0.2, 0, 0.8)])
+        students = np.arange(50)
+        self.assertTrue(ds.candidates[students, best[:, 0]].all())
+        self.assertTrue(ds.candidates[students, best[:, 1]].all())
+        np.testing.assert_array_equal(best[:, 0],
+                                      full_matrix.weights.argmax(axis=1))
+
+
+class QueryServiceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.ds = DataStore()
+        self.ds.read_students_from_csv_file("data/students.csv")
+        self.ds.read_practices_from_csv_file("data/practices.csv")
+        self.route_table = RouteTable.from_csv("data/addresses.csv")
+        self.index = query_service.PairIndex(self.ds, self.route_table)
+
+    def test_queries(self):
+        weights = self.index.matrix.weights
+        top = self.index.top_practices("S001", 3)
+        self.assertEqual(top["s_id"].tolist(), ["S001"] * 3)
+        self.assertEqual(top["p_id"][0],
+                         self.ds.df_practices.index[weights[0].argmax()])
+        self.assertTrue(top["Weight"].is_monotonic_decreasing)
+
+        near = self.index.students_within("P001", 10)
+        self.assertTrue((near["Duration (Minutes)"] <= 10).all())
+        self.assertEqual(len(near), int(
+            (self.index.matrix.durations[:, 0] <= 600).sum()))
+
+    def test_update_student_matches_full_run(self):
+        self.index.top_practices("S001")
+        self.index.update_student(
+            "S001", hasChildren=1,
+            favoriteSpecialties="Sportmedizin, Tropenmedizin")
+        full = WeightMatrix(self.ds, self.route_table)
+        np.testing.assert_array_equal(self.index.matrix.weights,
+                                      full.weights)
+        self.assertEqual(self.index.top_practices("S001")["p_id"][0],
+                         self.ds.df_practices.index[full.weights[0].argmax()])
+
+    def test_update_student_missing_route(self):
+        with self.assertRaises(MissingRouteError):
+            self.index.update_student("S001", address="Nowhere 1, 12345 X")
+        self.assertEqual(self.ds.df_students.loc["S001", "address"],
+                         "Am Waldacker 21c, 60388 Frankfurt am Main")
+
+    def test_shell_malformed_commands(self):
+        shell = query_service.QueryShell(self.index)
+        for line, usage in [("top", "top STUDENT [N]"),
+                            ("top S001 x", "top STUDENT [N]"),
+                            ("top S001 5 6", "top STUDENT [N]"),
+                            ("near P001", "near PRACTICE MINUTES"),
+                            ("pair S001", "pair STUDENT PRACTICE"),
+                            ("set S001 hasCar", "set STUDENT COLUMN VALUE")]:
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                shell.onecmd(line)
+            self.assertIn("Usage: " + usage, output.getvalue())
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            shell.onecmd("top S001 2")
+        self.assertIn("(2 rows in", output.getvalue())
+
+    def test_pruned_run(self):
+        pruned_ds = DataStore()
+        pruned_ds.read_students_from_csv_file("data/students.csv")
+        pruned_ds.read_practices_from_csv_file("data/practices.csv")
+        pruning.prune_pairs(pruned_ds, RouteTableEstimator(self.route_table),
+                            k_nearest=3)
+        fetched = self.route_table.df.merge(
+            pruned_ds.build_address_frame())
+        with tempfile.TemporaryDirectory() as tmp:
+            candidates_path = os.path.join(tmp, "candidates.npy")
+            np.save(candidates_path, pruned_ds.candidates)
+            route_table = RouteTable(fetched)
+            with self.assertRaises(MissingRouteError):
+                query_service.PairIndex(self.ds, route_table)
+
+            pruning.load_candidates(self.ds, candidates_path)
+            index = query_service.PairIndex(self.ds, route_table)
+        top = index.top_practices("S001", 50)
+        self.assertEqual(len(top), pruned_ds.candidates[0].sum())
+        self.assertEqual(top["p_id"][0],
+                         self.index.top_practices("S001", 1)["p_id"][0])
+
+
+class AssignmentTests(unittest.TestCase):
+
+    def test_assign_optimal_respects_capacity(self):
+        weights = np.array([[0.9, 0.8], [0.95, 0.1]])
+        assigned = assignment.assign_optimal(weights, np.array([1, 1]))
+        self.assertEqual(assigned.tolist(), [1, 0])
+
+    def test_assign_optimal_forbidden_pairs(self):
+        weights = np.array([[np.nan, 0.5], [np.nan, 0.7]])
+        assigned = assignment.assign_optimal(weights, np.array([1, 1]))
+        self.assertEqual(assigned.tolist(), [-1, 1])
+
+    def test_assign_optimal_assigns_most_students(self):
+        # the second student gives up the best pair so that both are
+        # assigned
+        weights = np.array([[10, np.nan], [20, 0.]])
+        assigned = assignment.assign_optimal(weights, np.array([1, 1]))
+        self.assertEqual(assigned.tolist(), [0, 1])
+
+    def test_get_practice_capacities(self):
+        practices = pd.DataFrame({'address': ['a', 'b', 'c'],
+                                  'capacity': [2, np.nan, 1]})
+        capacities = assignment.get_practice_capacities(practices, 7)
+        self.assertEqual(capacities.tolist(), [2, 3, 1])
+
+    def test_create_optimal_assignment(self):
+        ds = DataStore()
+        ds.read_students_from_csv_file("data/test_data/students.csv")
+        ds.read_practices_from_csv_file("data/test_data/practices.csv")
+        ds.df_practices['capacity'] = 1
+        with tempfile.TemporaryDirectory() as tmp:
+            weight_df = weight_combination.create_all_weight_combinations(
+                ds, address_path="data/test_data/addresses.csv",
+                output_path=os.path.join(tmp, "all.csv"))
+            path = os.path.join(tmp, "optimal.csv")
+            report = assignment.create_optimal_assignment(ds, weight_df,
+                                                          output_path=path)
+            pairs = pd.read_csv(path, sep="\t")
+
+        self.assertEqual(report['unassigned'], 0)
+        self.assertLessEqual(report['optimal'], report['greedy'])
+        self.assertEqual(sorted(p[-4:] for p in pairs['Pair']),
+                         ['P001', 'P002'])
+
+
+class BenchmarkTests(unittest.TestCase):
+
+    def test_generate_roster(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = benchmark.generate_roster(20, 5, tmp)
+            ds = DataStore()
+            ds.read_students_from_csv_file(paths["students"])
+            ds.read_practices_from_csv_file(paths["practices"])
+            route_table = RouteTable.from_csv(paths["addresses"])
+
+        self.assertEqual(len(ds.df_students), 20)
+        self.assertEqual(len(ds.df_practices), 5)
+        self.assertEqual(ds.specialty_index.unknown, [])
+        self.assertEqual(WeightMatrix(ds, route_table).weights.shape, (20, 5))
+
+    def test_benchmark_scale(self):
+        result = benchmark.benchmark_scale(10, 4)
+        self.assertEqual(result["pairs"], 40)
+        self.assertIn("peak_memory_mb",
+                      result["stages"]["create_all_weight_combinations"])
+
+
+class PipelineTests(unittest.TestCase):
+
+    def _pipeline(self, tmp, calls, scale=2):
+        source = os.path.join(tmp, "source.txt")
+        doubled = os.path.join(tmp, "doubled.txt")
+        tripled = os.path.join(tmp, "tripled.txt")
+
+        def write(path, factor, name):
+            def func(context):
+                calls.append(name)
+                with open(source) as f:
+                    value = int(f.read())
+                with open(path, "w") as f:
+                    f.write(str(value * factor))
+            return func
+
+        stages = [
+            pipeline.Stage("double", write(doubled, scale, "double"),
+                           [source], [doubled], config={"scale": scale}),
+            pipeline.Stage("triple", write(tripled, 3, "triple"), [source],
+                           [tripled]),
+            pipeline.Stage("report", lambda context: calls.append("report"),
+                           depends=["double", "triple"]),
+        ]
+        return pipeline.Pipeline(stages, os.path.join(tmp, "state.json"))
+
+    def test_skips_up_to_date_stages(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, "source.txt"), "w") as f:
+                f.write("7")
+            calls = []
+            results = self._pipeline(tmp, calls).run()
+            self.assertEqual(set(results.values()), {pipeline.RAN})
+            self.assertEqual(calls[-1], "report")
+
+            calls.clear()
+            self._pipeline(tmp, calls).run()
+            self.assertEqual(calls, [])
+
+            # a config change runs the stage and everything downstream
+            self._pipeline(tmp, calls, scale=4).run()
+            self.assertEqual(calls, ["double", "report"])
+
+            # a stage re-running with the same fingerprint runs its
+            # dependents too
+            calls.clear()
+            os.remove(os.path.join(tmp, "tripled.txt"))
+            self._pipeline(tmp, calls, scale=4).run()
+            self.assertEqual(calls, ["triple", "report"])
+
+            calls.clear()
+            self._pipeline(tmp, calls, scale=4).run(only=["double"],
+                                                    force=True)
+            self._pipeline(tmp, calls, scale=4).run()
+            self.assertEqual(calls, ["double", "report"])
+
+            calls.clear()
+            with open(os.path.join(tmp, "source.txt"), "w") as f:
+                f.write("8")
+            self._pipeline(tmp, calls, scale=4).run(until="double")
+            self.assertEqual(calls, ["double"])
+            with open(os.path.join(tmp, "doubled.txt")) as f:
+                self.assertEqual(f.read(), "32")
+
+            calls.clear()
+            self._pipeline(tmp, calls, scale=4).run(only=["report"],
+                                                    force=True)
+            self.assertEqual(calls, ["report"])
+
+    def test_incomplete_stage_runs_again(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "addresses.csv")
+            expected = write_unfetched_addresses(path)
+            n_tiles = len(build_request_tiles(expected))
+            client = StubDistanceMatrixClient(
+                expected, latency=0,
+                failures=[ApiError("OVER_QUERY_LIMIT")] * n_tiles)
+            api = GoogleAPI(client=client, max_retries=0)
+            stage = pipeline.Stage(
+                "fetch", lambda context: api.fetch_distances_from_api(path),
+                outputs=[path], complete=lambda context:
+                google_api.count_routes_to_fetch(path) == 0)
+            runner = pipeline.Pipeline([stage],
+                                       os.path.join(tmp, "state.json"))
+
+            self.assertEqual(runner.run(), {"fetch": pipeline.RAN})
+            self.assertEqual(google_api.count_routes_to_fetch(path),
+                             len(expected))
+            # the over quota routes are retried instead of up to date
+            self.assertEqual(runner.run(), {"fetch": pipeline.RAN})
+            self.assertEqual(google_api.count_routes_to_fetch(path), 0)
+            self.assertEqual(runner.run(), {"fetch": pipeline.SKIPPED})
+
+    def test_pair_matrix_output(self):
+        def outputs(**options):
+            stages = main.build_pipeline(main.PipelineRun(**options)).stages
+            return stages["create_weight_combinations"].outputs
+
+        self.assertIn("data/pair_matrix", outputs(binary=True))
+        # only the serial scoring of all pairs saves the pair matrix
+        for option in [{"chunk_size": 20}, {"workers": 2},
+                       {"incremental": True}, {"shard_prefix": 2}]:
+            self.assertNotIn("data/pair_matrix",
+                             outputs(binary=True, **option))
+
+    def test_ranked_pairs_output(self):
+        args = cli.build_parser({"top_k": 3}).parse_args(["score"])
+        self.assertEqual(args.top_k, 3)
+        run = main.PipelineRun(top_k=args.top_k)
+        stage = main.build_pipeline(run).stages["extract_best_weights"]
+        self.assertIn(main.RANKED_PAIRS_PATH, stage.outputs)
+
+        ds = DataStore()
+        ds.read_students_from_csv_file("data/students.csv")
+        ds.read_practices_from_csv_file("data/practices.csv")
+        run._data_store = ds
+        run.weight_df = WeightMatrix(
+            ds, RouteTable.from_csv("data/addresses.csv")).to_dataframe()
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(os.path.join(tmp, "data"))
+            os.chdir(tmp)
+            try:
+                main.extract_best_weights_stage(run)
+                best = pd.read_csv("data/best_pairs.csv", sep="\t")
+                ranked = pd.read_csv(main.RANKED_PAIRS_PATH, sep="\t")
+            finally:
+                os.chdir(cwd)
+        self.assertEqual(len(ranked), 3 * len(best))
+        self.assertEqual(ranked["Rank"].tolist()[:3], [1, 2, 3])
+        pd.testing.assert_frame_equal(
+            ranked[ranked["Rank"] == 1].drop(columns="Rank")
+            .reset_index(drop=True), best)
+
+    def test_incomplete_stage_runs_dependents(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            calls = []
+            finished = [False]
+
+            def complete(context):
+                calls.append("complete")
+                return finished[0]
+
+            stages = [
+                pipeline.Stage("fetch", lambda context: calls.append("fetch"),
+                               complete=complete),
+                pipeline.Stage("score", lambda context: calls.append("score"),
+                               depends=["fetch"]),
+            ]
+            runner = pipeline.Pipeline(stages,
+                                       os.path.join(tmp, "state.json"))
+            runner.run()
+            finished[0] = True
+            runner.run()
+            runner.run()
+            # the completeness is only checked after the stage ran
+            self.assertEqual(calls, ["fetch", "complete", "score"] * 2)
+
+    def test_stage_not_in_run(self):
+        with self.assertRaises(SystemExit):
+            main.main(["--until", "optimal_assignment"])
+        with self.assertRaises(SystemExit):
+            main.main(["--only", "prune", "extract_best_weights"])
+
+    def test_invalid_stages(self):
+        stage = pipeline.Stage("a", print, depends=["b"])
+        with self.assertRaises(ValueError):
+            pipeline.Pipeline([stage])
+        with self.assertRaises(ValueError):
+            pipeline.Pipeline([stage, pipeline.Stage("b", print,
+                                                     depends=["a"])])
+        with self.assertRaises(ValueError):
+            pipeline.Pipeline([pipeline.Stage("b", print)]).select("c")
+
+
+class ConfigTests(unittest.TestCase):
+
+    def test_environment_overrides_config_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "config.json")
+            with open(path, "w") as f:
+                json.dump({"api_key": "file", "offline": False}, f)
+            settings = config.load_config(path, {
+                "MSPS_OFFLINE": "true", "MSPS_PRUNE_MINUTES": "20",
+                "MSPS_API_KEY": "env", "HOME": "/root"})
+        self.assertEqual(settings, {"api_key": "env", "offline": True,
+                                    "prune_minutes": 20})
+        self.assertEqual(config.load_config(path, {}), {})
+
+    def test_cli_defaults_from_config(self):
+        parser = cli.build_parser({"offline": True, "prune_minutes": 20,
+                                   "api_key": "key"})
+        args = parser.parse_args(["score", "--prune-minutes", "30"])
+        self.assertTrue(args.offline)
+        self.assertEqual(args.prune_minutes, 30)
+        self.assertIs(args.func, cli.run_stages)
+        args = parser.parse_args(["query", "top", "S001", "5"])
+        self.assertEqual(args.command, ["top", "S001", "5"])
+
+    def test_api_rate_options(self):
+        args = cli.build_parser({}).parse_args(["fetch"])
+        self.assertEqual((args.api_workers, args.requests_per_second),
+                         (4, 10))
+        parser = cli.build_parser({"api_workers": 8,
+                                   "requests_per_second": 50})
+        args = parser.parse_args(["fetch", "--requests-per-second", "25"])
+        self.assertEqual((args.api_workers, args.requests_per_second),
+                         (8, 25))
+
+
+class ShardingTests(unittest.TestCase):
+
+    def test_plan_shards(self):
+        regions = sharding.postal_regions(
+            ["Hauptstraße 1, 60388 Frankfurt", "Weg 2, 65929 Frankfurt",
+             "Unbekannt"], 2)
+        self.assertEqual(regions.tolist(), ["60", "65", ""])
+
+        ds = DataStore()
+        ds.read_students_from_csv_file("data/students.csv")
+        ds.read_practices_from_csv_file("data/practices.csv")
+        shards = sharding.plan_shards(ds, 2)
+        self.assertEqual([shard[0] for shard in shards], ["60", "65"])
+        students = np.concatenate([shard[1] for shard in shards])
+        self.assertEqual(sorted(students), list(range(50)))
+        # the border of 5 joins the regions 60 and 65
+        for _, _, practices in sharding.plan_shards(ds, 2, border=5):
+            self.assertEqual(len(practices), len(ds.df_practices))
+
+    def test_sharded_run_matches_full_run(self):
+        ds = DataStore()
+        ds.read_students_from_csv_file("data/students.csv")
+        ds.read_practices_from_csv_file("data/practices.csv")
+        route_table = RouteTable.from_csv("data/addresses.csv")
+        shards = sharding.plan_shards(ds, 2)
+        with tempfile.TemporaryDirectory() as tmp:
+            sharded = weight_combination.create_sharded_weight_combinations(
+                ds, shards, route_table,
+                output_path=os.path.join(tmp, "pairs.csv"))
+            best = weight_combination.extract_best_weights_students(
+                ds, sharded, output_path=os.path.join(tmp, "best.csv"),
+                shards=shards)
+
+        full = WeightMatrix(ds, route_table).to_dataframe()
+        pd.testing.assert_frame_equal(
+            full.merge(sharded[["s_id", "p_id"]]), sharded)
+        expected = weight_combination.to_pair_format(
+            weight_combination.select_top_pairs(ds, sharded))
+        pd.testing.assert_frame_equal(best, expected)
+        self.assertLess(len(sharding.build_sharded_address_frame(ds, shards)),
+                        len(ds.build_address_frame()))
+
+    def test_shard_lookups_cover_only_their_addresses(self):
+        ds = DataStore()
+        ds.read_students_from_csv_file("data/students.csv")
+        ds.read_practices_from_csv_file("data/practices.csv")
+        route_table = RouteTable.from_csv("data/addresses.csv")
+        lookup = DurationLookup(ds.df_students, ds.df_practices, route_table,
+                                ds.address_book)
+        blocks = [shard[1:] for shard in sharding.plan_shards(ds, 2)]
+        for students, practices in blocks:
+            block = ds.select_students(students).select_practices(practices)
+            block_lookup = lookup.select(block.df_students,
+                                         block.df_practices)
+            self.assertLess(block_lookup.durations.size,
+                            lookup.durations.size)
+            pd.testing.assert_frame_equal(
+                WeightMatrix(block, lookup=block_lookup).to_dataframe(),
+                WeightMatrix(block, route_table).to_dataframe())
+
+        expected = weight_engine.score_blocks(ds, blocks, route_table)
+        for frames in [weight_engine.score_blocks(ds, blocks, lookup=lookup),
+                       weight_engine.score_blocks(ds, blocks, route_table,
+                                                  workers=2)]:
+            for frame, expected_frame in zip(frames, expected):
+                pd.testing.assert_frame_equal(frame, expected_frame)
+
+
+class InstrumentationTests(unittest.TestCase):
+
+    def tearDown(self):
+        instrumentation.configure()
+
+    def test_disabled_by_default(self):
+        instruments = instrumentation.configure_from_environment({})
+        with instruments.stage("load"):
+            instruments.incr("api_calls")
+        self.assertEqual(instruments.report()["stages"], {})
+        self.assertEqual(instruments.report()["counters"], {})
+
+    def test_stage_profile_and_memory(self):
+        instruments = instrumentation.configure_from_environment(
+            {instrumentation.ENV_VAR: "stages,profile,memory"})
+        with instruments.stage("build"):
+            sorted(range(1000))
+        record = instruments.report()["stages"]["build"]
+        self.assertIn("wall_time_s", record)
+        self.assertIn("peak_memory_mb", record)
+        self.assertTrue(record["profile"])
+
+    def test_nested_stages(self):
+        instruments = instrumentation.configure(trace_memory=True,
+                                                profile=True)
+        with instruments.stage("score"):
+            outer = list(range(200000))
+            with instruments.stage("load"):
+                inner = list(range(1000))
+            del outer, inner
+            sorted(range(1000))
+        stages = instruments.report()["stages"]
+        self.assertGreater(stages["score"]["peak_memory_mb"], 1)
+        self.assertLessEqual(stages["load"]["peak_memory_mb"],
+                             stages["score"]["peak_memory_mb"])
+        self.assertNotIn("profile", stages["load"])
+        self.assertTrue(any("sorted" in row["function"]
+                            for row in stages["score"]["profile"]))
+
+    def test_pipeline_counters(self):
+        instruments = instrumentation.configure(enabled=True)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "addresses.csv")
+            expected = write_unfetched_addresses(path)
+            GoogleAPI(client=FakeDistanceMatrixClient(expected))\
+                .fetch_distances_from_api(path)
+
+            ds = DataStore()
+            ds.read_students_from_csv_file("data/test_data/students.csv")
+            ds.read_practices_from_csv_file("data/test_data/practices.csv")
+            weight_combination.create_all_weight_combinations(
+                ds, address_path=path,
+                output_path=os.path.join(tmp, "all.csv"))
+
+            report_path = os.path.join(tmp, "report.json")
+            instruments.write_report(report_path)
+            with open(report_path) as report_file:
+                counters = json.load(report_file)["counters"]
+
+        self.assertEqual(counters["api_calls"], 1)
+        self.assertEqual(counters["routes_requested"], 12)
+        self.assertEqual(counters["pairs_scored"], 4)
+        self.assertEqual(counters["rows_written"], 12 + 4)
+
+
+class MatrixStoreTests(unittest.TestCase):
+
+    def test_route_matrix_round_trip(self):
+        route_table = RouteTable.from_csv("data/test_data/addresses.csv")
+        with tempfile.TemporaryDirectory() as tmp:
+            matrix_store.RouteMatrix.from_route_table(route_table).save(tmp)
+            route_matrix = matrix_store.RouteMatrix.load(tmp)
+            self.assertIsInstance(route_matrix.durations, np.memmap)
+            self.assertEqual(route_matrix.durations.dtype, np.float32)
+            table = route_matrix.to_route_table()
+            self.assertEqual(len(table), 12)
+            self.assertEqual(table.get_duration(
+                'Im Wörth 8, 60433 Frankfurt am Main',
+                'Rhaban-Fröhlich-Straße 11, 60433 Frankfurt am Main', 0),
+                116)
+
+    def test_weights_from_route_matrix(self):
+        ds = DataStore()
+        ds.read_students_from_csv_file("data/students.csv")
+        ds.read_practices_from_csv_file("data/practices.csv")
+        with tempfile.TemporaryDirectory() as tmp:
+            matrix_dir = os.path.join(tmp, "route_matrix")
+            # the first call converts the file, the second opens the matrix
+            matrix_store.load_duration_lookup("data/addresses.csv",
+                                              matrix_dir)
+            lookup = matrix_store.load_duration_lookup("data/addresses.csv",
+                                                       matrix_dir)
+            self.assertIsInstance(lookup.durations, np.memmap)
+
+            csv_path = os.path.join(tmp, "csv.csv")
+            binary_path = os.path.join(tmp, "binary.csv")
+            pair_dir = os.path.join(tmp, "pair_matrix")
+            weight_combination.create_all_weight_combinations(
+                ds, address_path="data/addresses.csv", output_path=csv_path)
+            weight_combination.create_all_weight_combinations(
+                ds, lookup=lookup, output_path=binary_path,
+                pair_matrix_dir=pair_dir)
+            with open(csv_path) as f1, open(binary_path) as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+            pairs = matrix_store.load_pair_matrix(pair_dir)
+            self.assertEqual(pairs["weights"].shape, (50, 50))
+            self.assertEqual(pairs["student_ids"][0], "S001")
+
+
+class IncrementalTests(unittest.TestCase):
+
+    def test_update_matches_full_run(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = benchmark.generate_roster(30, 8, tmp)
+            ds = DataStore()
+            ds.read_students_from_csv_file(paths["students"])
+            ds.read_practices_from_csv_file(paths["practices"])
+            pairs_path = os.path.join(tmp, "pairs.csv")
+            manifest_path = os.path.join(tmp, "manifest.json")
+            weight_combination.update_all_weight_combinations(
+                ds, address_path=paths["addresses"], output_path=pairs_path,
+                manifest_path=manifest_path)
+
+            # change a student and a practice, add a student sharing the
+            # addresses of another one and remove a practice
+            students = pd.read_csv(paths["students"], sep="\t")
+            students.loc[3, "hasChildren"] = 1 - students.loc[3, "hasChildren"]
+            students = pd.concat([students, students.iloc[[5]].assign(
+                id="S99999")], ignore_index=True)
+            students.to_csv(paths["students"], sep="\t", index=False)
+            practices = pd.read_csv(paths["practices"], sep="\t")
+            practices.loc[2, "specialties"] = "Notfallmedizin"
+            practices.drop(index=6).to_csv(paths["practices"], sep="\t",
+                                           index=False)
+            ds = DataStore()
+            ds.read_students_from_csv_file(paths["students"])
+            ds.read_practices_from_csv_file(paths["practices"])
+
+            changed = incremental.RunManifest.load(manifest_path)\
+                .changed_positions(incremental.RunManifest.from_data_store(ds))
+            self.assertEqual(changed[0].tolist(), [3, 30])
+            self.assertEqual(changed[1].tolist(), [2])
+            self.assertEqual(ds.update_address_csv_file(
+                incremental.changed_address_frame(ds, *changed),
+                paths["addresses"]), 0)
+
+            self.assertIsNone(
+                weight_combination.update_all_weight_combinations(
+                    ds, address_path=paths["addresses"],
+                    output_path=pairs_path, manifest_path=manifest_path))
+            updated = weight_combination.read_all_weight_combinations(
+                pairs_path)
+            full_path = os.path.join(tmp, "full.csv")
+            full = weight_combination.create_all_weight_combinations(
+                ds, address_path=paths["addresses"], output_path=full_path)
+            self.assertEqual(len(updated), 31 * 7)
+            with open(pairs_path) as f1, open(full_path) as f2:
+                self.assertEqual(f1.read(), f2.read())
+            pd.testing.assert_frame_equal(
+                weight_combination.select_top_pairs(ds, updated),
+                weight_combination.select_top_pairs(ds, full),
+                check_dtype=False)
+
+    def test_update_rescores_refetched_routes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = benchmark.generate_roster(30, 8, tmp)
+            ds = DataStore()
+            ds.read_students_from_csv_file(paths["students"])
+            ds.read_practices_from_csv_file(paths["practices"])
+            pairs_path = os.path.join(tmp, "pairs.csv")
+            manifest_path = os.path.join(tmp, "manifest.json")
+            weight_combination.update_all_weight_combinations(
+                ds, address_path=paths["addresses"], output_path=pairs_path,
+                manifest_path=manifest_path)
+
+            # refetched routes replace some durations, the longest stays
+            routes = pd.read_csv(paths["addresses"], sep="\t")
+            shorter = routes.index[:40]
+            routes.loc[shorter, "duration"] = \
+                routes.loc[shorter, "duration"] // 2
+            self.assertEqual(routes["duration"].max(),
+                             RouteTable.from_csv(paths["addresses"])
+                             .max_duration)
+            routes.to_csv(paths["addresses"], sep="\t", index=False)
+
+            weight_combination.update_all_weight_combinations(
+                ds, address_path=paths["addresses"], output_path=pairs_path,
+                manifest_path=manifest_path)
+            full_path = os.path.join(tmp, "full.csv")
+            weight_combination.create_all_weight_combinations(
+                ds, address_path=paths["addresses"], output_path=full_path)
+            with open(pairs_path) as f1, open(full_path) as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+            manifest = incremental.RunManifest.load(manifest_path)
+            lookup = DurationLookup(
+                ds.df_students, ds.df_practices,
+                RouteTable.from_csv(paths["addresses"]), ds.address_book)
+            current = incremental.RunManifest.from_data_store(
+                ds, manifest.max_duration, lookup)
+            self.assertFalse(
+                manifest.changed_routes(current, ds, lookup).any())
+
+    def test_update_cost_scales_with_changed_rows(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = benchmark.generate_roster(60, 20, tmp)
+            ds = DataStore()
+            ds.read_students_from_csv_file(paths["students"])
+            ds.read_practices_from_csv_file(paths["practices"])
+            pairs_path = os.path.join(tmp, "pairs.csv")
+            manifest_path = os.path.join(tmp, "manifest.json")
+            weight_combination.update_all_weight_combinations(
+                ds, address_path=paths["addresses"], output_path=pairs_path,
+                manifest_path=manifest_path)
+
+            def update(changed):
+                students = pd.read_csv(paths["students"], sep="\t")
+                students.loc[changed, "hasChildren"] = \
+                    1 - students.loc[changed, "hasChildren"]
+                students.to_csv(paths["students"], sep="\t", index=False)
+                ds = DataStore()
+                ds.read_students_from_csv_file(paths["students"])
+                ds.read_practices_from_csv_file(paths["practices"])
+                run = instrumentation.configure(enabled=True)
+                try:
+                    weight_combination.update_all_weight_combinations(
+                        ds, address_path=paths["addresses"],
+                        output_path=pairs_path, manifest_path=manifest_path)
+                finally:
+                    instrumentation.configure()
+                full_path = os.path.join(tmp, "full.csv")
+                weight_combination.create_all_weight_combinations(
+                    ds, address_path=paths["addresses"],
+                    output_path=full_path)
+                with open(pairs_path) as f1, open(full_path) as f2:
+                    self.assertEqual(f1.read(), f2.read())
+                return run.counters
+
+            # only the rows of the changed students are scored and written
+            self.assertEqual(update([7]),
+                             {"pairs_scored": 20, "rows_written": 20})
+            self.assertEqual(update([0, 30, 59]),
+                             {"pairs_scored": 60, "rows_written": 60})
+
+    def test_update_address_csv_file(self):
+        ds = DataStore()
+        ds.read_students_from_csv_file("data/test_data/students.csv")
+        ds.read_practices_from_csv_file("data/test_data/practices.csv")
+        with tempfile.TemporaryDirectory() as tmp:
+            address_path = os.path.join(tmp, "addresses.csv")
+            ds.create_address_csv_file(address_path)
+            ds.df_students.iloc[0, 0] = "Neue Straße 1, 60306 Frankfurt"
+            appended = ds.update_address_csv_file(
+                incremental.changed_address_frame(ds, [0], []),
+                address_path)
+            self.assertEqual(appended, len(ds.df_practices) * (
+                1 + ds.df_students.iloc[0]["hasCar"]))
+            self.assertEqual(ds.update_address_csv_file(
+                ds.build_address_frame(), address_path), 0)
+
+
+class RouteTableEstimator:
+    """Estimator answering with the exact durations of a route table."""
+
+    def __init__(self, route_table):
+        self.route_table = route_table
+
+    def _duration(self, origin, dest, is_car):
+        try:
+            return self.route_table.get_duration(origin, dest, is_car)
+        except MissingRouteError:
+            return np.nan
+
+    def estimate_matrix(self, origins, destinations, mode):
+        is_car = int(mode == "driving")
+        durations = np.array([[self._duration(o, d, is_car)
+                               for d in destinations] for o in origins],
+                             dtype=float)
+        return durations, durations
+
+
+class PruningTests(unittest.TestCase):
+
+    def test_select_candidates(self):
+        durations = np.array([[600., 1800., 3600., np.nan],
+                              [3000., 2400., 1200., 600.]])
+        matches = np.array([[0, 0, 1, 0], [0, 0, 0, 0]])
+        self.assertTrue(pruning.select_candidates(durations, matches).all())
+        # the match of the third practice cannot make up 50 minutes
+        np.testing.assert_array_equal(
+            pruning.select_candidates(durations, matches, max_minutes=20),
+            [[True, False, False, True], [False, False, True, True]])
+        np.testing.assert_array_equal(
+            pruning.select_candidates(durations, matches, k_nearest=2),
+            [[True, True, False, True], [False, False, True, True]])
+        # but it can make up 5 minutes
+        durations[0, 2] = 900.
+        np.testing.assert_array_equal(
+            pruning.select_candidates(durations, matches, k_nearest=1),
+            [[True, False, True, True], [False, False, False, True]])
+
+    def test_pruned_pairs_keep_best_pairs(self):
+        ds = DataStore()
+        ds.read_students_from_csv_file("data/students.csv")
+        ds.read_practices_from_csv_file("data/practices.csv")
+        route_table = RouteTable.from_csv("data/addresses.csv")
+        full_df = WeightMatrix(ds, route_table).to_dataframe()
+        n_routes = len(ds.build_address_frame())
+
+        pruned = pruning.prune_pairs(ds, RouteTableEstimator(route_table),
+                                     k_nearest=3)
+        self.assertEqual(pruned, 2500 - ds.candidates.sum())
+        self.assertGreater(pruned, 1000)
+        self.assertLess(len(ds.build_address_frame()), n_routes)
+
+        pruned_df = WeightMatrix(ds, route_table).to_dataframe()
+        self.assertEqual(len(pruned_df), 2500 - pruned)
+        pd.testing.assert_frame_equal(
+            weight_combination.select_top_pairs(ds, pruned_df),
+            weight_combination.select_top_pairs(ds, full_df))
+
+    def test_cut_off_keeps_best_pairs(self):
+        ds = DataStore()
+        ds.read_students_from_csv_file("data/students.csv")
+        ds.read_practices_from_csv_file("data/practices.csv")
+        route_table = RouteTable.from_csv("data/addresses.csv")
+        full_df = WeightMatrix(ds, route_table).to_dataframe()
+
+        pruned = pruning.prune_pairs(ds, RouteTableEstimator(route_table),
+                                     max_minutes=5)
+        self.assertGreater(pruned, 1000)
+        pruned_df = WeightMatrix(ds, route_table).to_dataframe()
+        pd.testing.assert_frame_equal(
+            weight_combination.select_top_pairs(ds, pruned_df),
+            weight_combination.select_top_pairs(ds, full_df))
+
+
+class FakeGeocodeClient:
+    """Offline stand-in for googlemaps.Client geocoding every address to
+    a distinct point."""
+
+    def __init__(self):
+        self.calls = []
+
+    def geocode(self, address):
+        self.calls.append(address)
+        return [{"geometry": {"location": {"lat": 50 + len(self.calls) / 1e3,
+                                           "lng": 8.68}}}]
+
+
+class FakeDistanceMatrixClient:
+    """Offline stand-in for googlemaps.Client answering from a route df."""
+
+    def __init__(self, routes_df):
+        self.routes = {}
+        for _, row in routes_df.iterrows():
+            mode = google_api.get_travel_mode(row['is_car'])
+            self.routes[(row['stud_add'], row['prac_add'], mode)] = (
+                row['distance'], row['duration'])
+        self.calls = []
+
+    def distance_matrix(self, origins, destinations, mode=None):
+        assert len(origins) <= google_api.MAX_ADDRESSES_PER_SIDE
+        assert len(destinations) <= google_api.MAX_ADDRESSES_PER_SIDE
+        assert len(origins) * len(destinations) <= \
+            google_api.MAX_ELEMENTS_PER_REQUEST
+        self.calls.append((mode, list(origins), list(destinations)))
+
+        rows = []
+        for origin in origins:
+            elements = []
+            for dest in destinations:
+                distance, duration = self.routes.get(
+                    (origin, dest, mode), (1000, 200))
+                elements.append({"status": "OK",
+                                 "distance": {"value": int(distance)},
+                                 "duration": {"value": int(duration)}})
+            rows.append({"elements": elements})
+        return {"status": "OK", "rows": rows}
+
+
+class StubDistanceMatrixClient(FakeDistanceMatrixClient):
+    """Fake client adding latency, over quota errors and unroutable pairs."""
+
+    def __init__(self, routes_df, latency=0.01, failures=(),
+                 unroutable=()):
+        super(StubDistanceMatrixClient, self).__init__(routes_df)
+        self.latency = latency
+        self.failures = list(failures)
+        self.unroutable = set(unroutable)
+        self.lock = threading.Lock()
+
+    def distance_matrix(self, origins, destinations, mode=None):
+        time.sleep(self.latency)
+        with self.lock:
+            if self.failures:
+                raise self.failures.pop(0)
+        matrix = super(StubDistanceMatrixClient, self).distance_matrix(
+            origins, destinations, mode=mode)
+        for origin, row in zip(origins, matrix['rows']):
+            if origin in self.unroutable:
+                for element in row['elements']:
+                    element.clear()
+                    element['status'] = 'NOT_FOUND'
+        return matrix
+
+
+def write_unfetched_addresses(path, source="data/test_data/addresses.csv"):
+    df = pd.read_csv(source, sep="\t")
+    df[['stud_add', 'prac_add', 'is_car']].to_csv(path, sep="\t",
+                                                  index=False)
+    return df
+
 
 class GoogleApiTests(unittest.TestCase):
 
@@ -123,6 +1333,209 @@ class GoogleApiTests(unittest.TestCase):
         value = google._data_fetched_already("data/test_data/addresses.csv")
         self.assertTrue(value)
 
+    def test_build_request_tiles(self):
+        df = pd.DataFrame(
+            [["S{}".format(i), "P{}".format(j), is_car]
+             for is_car in (0, 1) for i in range(30) for j in range(40)],
+            columns=['stud_add', 'prac_add', 'is_car'])
+        tiles = build_request_tiles(df)
+
+        covered = set()
+        for mode, origins, dests in tiles:
+            self.assertLessEqual(len(origins) * len(dests), 100)
+            self.assertLessEqual(max(len(origins), len(dests)), 25)
+            covered.update((o, d, mode) for o in origins for d in dests)
+        self.assertEqual(len(covered), len(df))
+        self.assertLess(len(tiles), len(df) / 50)
+
+    def test_request_tiles_of_pruned_routes(self):
+        df = pd.DataFrame(
+            [["S{}".format(i), "P{}".format(j), 0]
+             for i in range(30) for j in range(40) if (i + j) % 7 < 3],
+            columns=['stud_add', 'prac_add', 'is_car'])
+        tiles = build_request_tiles(df)
+
+        elements = sum(len(origins) * len(dests)
+                       for _, origins, dests in tiles)
+        covered = {(o, d) for _, origins, dests in tiles
+                   for o in origins for d in dests}
+        self.assertEqual(elements, len(df))
+        self.assertEqual(covered, set(zip(df['stud_add'], df['prac_add'])))
+
+    def test_fetch_distances_batched(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "addresses.csv")
+            expected = write_unfetched_addresses(path)
+            client = FakeDistanceMatrixClient(expected)
+
+            GoogleAPI(client=client).fetch_distances_from_api(path)
+
+            fetched = pd.read_csv(path, sep="\t")
+            self.assertEqual(len(client.calls), 1)
+            self.assertEqual(fetched['duration'].tolist(),
+                             expected['duration'].tolist())
+            self.assertEqual(fetched['distance'].tolist(),
+                             expected['distance'].tolist())
+
+    def test_fetch_distances_concurrent_with_errors(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "addresses.csv")
+            expected = write_unfetched_addresses(path)
+            unroutable = 'Storchgasse 2, 65929 Frankfurt am Main'
+            client = StubDistanceMatrixClient(
+                expected, failures=[ApiError('OVER_QUERY_LIMIT'), Timeout()],
+                unroutable=[unroutable])
+
+            google = GoogleAPI(client=client, max_workers=4,
+                               requests_per_second=1000, backoff_base=0)
+            google.fetch_distances_from_api(path)
+
+            fetched = pd.read_csv(path, sep="\t")
+            not_found = fetched['stud_add'] == unroutable
+            self.assertTrue((fetched.loc[not_found, 'status'] ==
+                             'NOT_FOUND').all())
+            self.assertTrue(fetched.loc[not_found, 'duration'].isna().all())
+            self.assertEqual(fetched.loc[~not_found, 'duration'].tolist(),
+                             expected.loc[~not_found, 'duration'].tolist())
+
+    def test_fetch_distances_retries_exhausted(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "addresses.csv")
+            expected = write_unfetched_addresses(path)
+            client = StubDistanceMatrixClient(
+                expected, latency=0,
+                failures=[ApiError('OVER_QUERY_LIMIT')] * 3)
+
+            GoogleAPI(client=client, max_retries=2, backoff_base=0)\
+                .fetch_distances_from_api(path)
+
+            fetched = pd.read_csv(path, sep="\t")
+            self.assertTrue((fetched['status'] == 'OVER_QUERY_LIMIT').all())
+
+    def test_data_fetched_already_needs_distance(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "addresses.csv")
+            df = pd.read_csv("data/test_data/addresses.csv", sep="\t")
+            df.drop(columns=['distance']).to_csv(path, sep="\t",
+                                                 index=False)
+            self.assertFalse(GoogleAPI()._data_fetched_already(path))
+
+    def test_fetch_distances_with_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "addresses.csv")
+            expected = write_unfetched_addresses(path)
+            cache = RouteCache(os.path.join(tmp, "cache.sqlite"))
+            first = expected[expected['stud_add'].str.startswith('Am ')]
+            first[['stud_add', 'prac_add', 'is_car']].to_csv(
+                path, sep="\t", index=False)
+            GoogleAPI(client=FakeDistanceMatrixClient(expected))\
+                .fetch_distances_from_api(path, cache=cache)
+            self.assertEqual(len(cache), 2)
+
+            # a new roster only requests the routes missing in the cache
+            write_unfetched_addresses(path)
+            client = FakeDistanceMatrixClient(expected)
+            GoogleAPI(client=client).fetch_distances_from_api(path,
+                                                              cache=cache)
+            requested = {origin for _, origins, _ in client.calls
+                         for origin in origins}
+            self.assertNotIn('Am Waldacker 21c, 60388 Frankfurt am Main',
+                             requested)
+            self.assertEqual(len(cache), 12)
+
+            fetched = pd.read_csv(path, sep="\t")
+            self.assertEqual(fetched['duration'].tolist(),
+                             expected['duration'].tolist())
+            cache.close()
+
+    def test_haversine(self):
+        # one degree of latitude is about 111.2 km
+        self.assertAlmostEqual(
+            distance_estimator.haversine(50.0, 8.7, 51.0, 8.7), 111195, -1)
+
+    def test_fetch_distances_offline(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "addresses.csv")
+            expected = write_unfetched_addresses(path)
+            addresses = pd.unique(pd.concat([expected['stud_add'],
+                                             expected['prac_add']]))
+            geocodes = pd.DataFrame({
+                'address': [a.upper() for a in addresses[1:]],
+                'lat': 50.1 + 0.01 * np.arange(len(addresses) - 1),
+                'lon': 8.68})
+            estimator = distance_estimator.HaversineEstimator(geocodes)
+            distances, durations = estimator.estimate_matrix(
+                addresses[1:3], addresses[1:4], "bicycling")
+            self.assertEqual(distances.shape, (2, 3))
+            self.assertEqual(distances[0, 0], 0)
+
+            GoogleAPI(provider=estimator).fetch_distances_from_api(path)
+            estimated = pd.read_csv(path, sep="\t")
+            ungeocoded = (estimated['stud_add'] == addresses[0]) | \
+                (estimated['prac_add'] == addresses[0])
+            self.assertTrue((estimated.loc[ungeocoded, 'status'] ==
+                             "NOT_GEOCODED").all())
+            self.assertTrue((estimated.loc[~ungeocoded, 'status'] ==
+                             "ESTIMATED").all())
+
+            # estimates are replaced once the API is used
+            GoogleAPI(client=FakeDistanceMatrixClient(expected))\
+                .fetch_distances_from_api(path)
+            fetched = pd.read_csv(path, sep="\t")
+            self.assertTrue((fetched['status'] == "OK").all())
+            self.assertEqual(fetched['duration'].tolist(),
+                             expected['duration'].tolist())
+
+    def test_geocode_command(self):
+        client = FakeGeocodeClient()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "geocodes.csv")
+            with self.assertRaises(FileNotFoundError):
+                distance_estimator.HaversineEstimator.from_csv(path)
+
+            args = cli.build_parser({}).parse_args(
+                ["geocode", "--output", path])
+            added = cli.run_geocode(args, client)
+            self.assertEqual(added, len(client.calls))
+            self.assertEqual(len(set(client.calls)), len(client.calls))
+            # addresses already in the table are not requested again
+            self.assertEqual(cli.run_geocode(args, client), 0)
+            self.assertEqual(len(client.calls), added)
+
+            ds = DataStore()
+            ds.read_students_from_csv_file("data/students.csv")
+            ds.read_practices_from_csv_file("data/practices.csv")
+            estimator = distance_estimator.HaversineEstimator.from_csv(path)
+            lat, lon = estimator.locate(ds.build_address_frame()['stud_add'])
+            self.assertFalse(np.isnan(lat).any())
+
+    def test_route_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = RouteCache(os.path.join(tmp, "cache.sqlite"))
+            cache.put_many({('A  Street 1', 'B', 'driving'): (10, 20, 'OK'),
+                            ('C', 'B', 'driving'): (np.nan, np.nan,
+                                                    'OVER_QUERY_LIMIT')})
+            found = cache.get_many([('a street 1', 'B', 'driving'),
+                                    ('C', 'B', 'driving')])
+            self.assertEqual(found, {('a street 1', 'B', 'driving'):
+                                     (10, 20, 'OK')})
+
+            cache.ttl = -1
+            self.assertEqual(cache.get_many([('A Street 1', 'B',
+                                              'driving')]), {})
+            self.assertEqual(cache.purge_expired(), 1)
+            cache.close()
+
+    def test_rate_limiter(self):
+        now = [0.0]
+        waits = []
+        limiter = RateLimiter(requests_per_second=10, clock=lambda: now[0],
+                              sleep=waits.append)
+        for _ in range(3):
+            limiter.acquire()
+        self.assertEqual(len(waits), 2)
+        self.assertAlmostEqual(waits[1], 0.2)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,24 +1,260 @@
 """Script containing functions for creating weight combinations"""
 from student_practice_pair import StudentPracticePair
+from route_table import RouteTable
+from weight_engine import WeightMatrix, DurationLookup, PAIR_COLUMNS, \
+    compute_pairs_parallel, iter_pair_chunks, score_blocks
+from instrumentation import get_instrumentation
+from incremental import RunManifest, pair_offsets, rescore_changed_pairs
+import matrix_store
+import numpy as np
 import pandas as pd
 
+BEST_PAIR_COLUMNS = ["Pair"] + PAIR_COLUMNS[2:]
 
-def create_all_weight_combinations(data_store):
+
+def to_pair_format(pairs_df):
+    """
+    Restructure rows of all_possible_pairs.csv into the layout of
+    best_pairs.csv, joining the student and practice ids into one Pair
+    column.
+    :param pairs_df: df with the columns of all_possible_pairs.csv
+    :return: df
+    """
+    pairs_df = pairs_df.assign(
+        Pair=pairs_df['s_id'].astype(str) + "<->" +
+        pairs_df['p_id'].astype(str))
+    return pairs_df[BEST_PAIR_COLUMNS]
+
+
+def create_all_weight_combinations(data_store, route_table=None,
+                                   address_path='data/addresses.csv',
+                                   output_path='data/all_possible_pairs.csv',
+                                   vectorized=True, workers=None,
+                                   lookup=None, pair_matrix_dir=None):
     """
     Create all weight combinations for student practice pairs
     :param data_store:
+    :param route_table: shared RouteTable, loaded from address_path if None
+    :param address_path: file path for address file
+    :param output_path: file path for the pairs csv file
+    :param vectorized: if True, compute all pairs at once with the
+    WeightMatrix engine, else build one StudentPracticePair per pair
+    :param workers: if more than one, score shards of students with the
+    vectorized engine in that many processes
+    :param lookup: DurationLookup of the vectorized engine, e.g. opened from
+    the binary route matrix, used instead of the route table if given
+    :param pair_matrix_dir: if given, also save the pair matrix of a serial
+    vectorized run as binary arrays in this directory
     :return:
     """
-    weight_data = []
+    if route_table is None and (lookup is None or not vectorized):
+        route_table = RouteTable.from_csv(address_path)
+
     print("Creating all weight combinations..")
 
-    for i, stud_df_row in data_store.df_students.iterrows():
+    if vectorized and workers and workers > 1:
+        weight_df = compute_pairs_parallel(data_store, route_table, workers,
+                                           lookup=lookup)
+    elif vectorized:
+        weight_matrix = WeightMatrix(data_store, route_table, lookup)
+        weight_df = weight_matrix.to_dataframe()
+        if pair_matrix_dir:
+            matrix_store.save_pair_matrix(weight_matrix, pair_matrix_dir)
+    else:
+        weight_df = _create_pairwise_weight_combinations(data_store,
+                                                         route_table)
+
+    get_instrumentation().incr("pairs_scored", len(weight_df))
+
+    # save the dataframe in csv
+    weight_df.to_csv(output_path, sep="\t", index=False)
+    get_instrumentation().incr("rows_written", len(weight_df))
+    print("Combinations created, can be founf at " + output_path)
+
+    return weight_df
+
+
+def stream_all_weight_combinations(data_store, route_table=None,
+                                   address_path='data/addresses.csv',
+                                   output_path='data/all_possible_pairs.csv',
+                                   chunk_size=1000, top_k=1, lookup=None):
+    """
+    Create all weight combinations for student practice pairs, appending
+    them to the csv file one chunk of students at a time.
+
+    Only the top_k pairs of every student are kept in memory, so peak memory
+    depends on the chunk size instead of the number of pairs. The file is
+    identical to the one written by create_all_weight_combinations.
+    :param data_store:
+    :param route_table: shared RouteTable, loaded from address_path if None
+    :param address_path: file path for address file
+    :param output_path: file path for the pairs csv file
+    :param chunk_size: students scored and written per chunk
+    :param top_k: pairs kept per student for extract_best_weights_students
+    :param lookup: DurationLookup used instead of the route table if given
+    :return: df with the top_k rows of every student
+    """
+    if route_table is None and lookup is None:
+        route_table = RouteTable.from_csv(address_path)
+
+    print("Creating all weight combinations in chunks of {} "
+          "students..".format(chunk_size))
+
+    top_frames = []
+    header = True
+    for chunk, chunk_df in iter_pair_chunks(data_store, route_table,
+                                            chunk_size, lookup):
+        get_instrumentation().incr("pairs_scored", len(chunk_df))
+        chunk_df.to_csv(output_path, sep="\t", index=False, header=header,
+                        mode="w" if header else "a")
+        get_instrumentation().incr("rows_written", len(chunk_df))
+        header = False
+
+        top_frames.append(select_top_pairs(chunk, chunk_df, top_k).drop(
+            columns=["Rank"]))
+
+    if header:
+        # no students, write the header only
+        pd.DataFrame(columns=PAIR_COLUMNS).to_csv(output_path, sep="\t",
+                                                  index=False)
+    print("Combinations created, can be founf at " + output_path)
+
+    if not top_frames:
+        return pd.DataFrame(columns=PAIR_COLUMNS)
+    return pd.concat(top_frames, ignore_index=True)
+
+
+def create_sharded_weight_combinations(
+        data_store, shards, route_table=None,
+        address_path='data/addresses.csv',
+        output_path='data/all_possible_pairs.csv', workers=None,
+        lookup=None):
+    """
+    Score the pairs within every regional shard, the shards in parallel,
+    and merge them into one pairs csv file ordered like a full run.
+    :param data_store:
+    :param shards: list of (region, student positions, practice positions)
+    with every student in exactly one shard
+    :param route_table: shared RouteTable, loaded from address_path if None
+    :param address_path: file path for address file
+    :param output_path: file path for the pairs csv file
+    :param workers: number of processes scoring the shards, serial if None
+    :param lookup: DurationLookup used instead of the route table if given
+    :return: df of the pairs of all shards
+    """
+    if route_table is None and lookup is None:
+        route_table = RouteTable.from_csv(address_path)
+
+    print("Creating weight combinations of {} shards..".format(len(shards)))
+    frames = score_blocks(data_store, [shard[1:] for shard in shards],
+                          route_table, workers, lookup)
+    if not frames:
+        frames = [pd.DataFrame(columns=PAIR_COLUMNS)]
+    weight_df = pd.concat(frames, ignore_index=True)
+    # the practices of a student are in datastore order within its shard
+    order = np.argsort(data_store.df_students.index.get_indexer(
+        weight_df['s_id']), kind='stable')
+    weight_df = weight_df.iloc[order].reset_index(drop=True)
+    get_instrumentation().incr("pairs_scored", len(weight_df))
+
+    weight_df.to_csv(output_path, sep="\t", index=False)
+    get_instrumentation().incr("rows_written", len(weight_df))
+    print("Combinations created, can be found at " + output_path)
+    return weight_df
+
+
+def update_all_weight_combinations(data_store, route_table=None,
+                                   address_path='data/addresses.csv',
+                                   output_path='data/all_possible_pairs.csv',
+                                   manifest_path='data/manifest.json',
+                                   lookup=None):
+    """
+    Update the weight combinations of a previous run, re-scoring only the
+    pairs of students and practices changed since its manifest was saved
+    and the pairs whose route durations changed, and replacing only the
+    rows of the students with such pairs.
+
+    Falls back to scoring all pairs when there is no previous run, the
+    pairs file is not the one of the manifest or the longest route
+    duration, which every weight depends on, has changed.
+    :param data_store:
+    :param route_table: shared RouteTable, loaded from address_path if None
+    :param address_path: file path for address file
+    :param output_path: file path for the pairs csv file
+    :param manifest_path: file path of the manifest of the previous run
+    :param lookup: DurationLookup used instead of the route table if given
+    :return: df with all pairs if they were all scored, None if the file
+    was updated
+    """
+    if lookup is None:
+        if route_table is None:
+            route_table = RouteTable.from_csv(address_path)
+        lookup = DurationLookup(data_store.df_students,
+                                data_store.df_practices, route_table,
+                                data_store.address_book)
+
+    current = RunManifest.from_data_store(
+        data_store, float(lookup.max_duration), lookup)
+    previous = RunManifest.load(manifest_path)
+
+    weight_df = None
+    if previous is None or previous.max_duration != current.max_duration \
+            or not previous.describes(output_path):
+        print("No previous run to update, scoring all pairs")
+    else:
+        print("Updating weight combinations..")
+        current.offsets = rescore_changed_pairs(
+            data_store, previous, current, lookup, output_path)
+        if current.offsets is None:
+            print("Rows span several lines, scoring all pairs")
+        else:
+            print("Combinations updated, can be found at " + output_path)
+
+    if current.offsets is None:
+        weight_df = create_all_weight_combinations(
+            data_store, output_path=output_path, lookup=lookup)
+        current.offsets = pair_offsets(output_path,
+                                       current.scored.sum(axis=1))
+    current.save(manifest_path)
+    return weight_df
+
+
+def read_all_weight_combinations(
+        output_path="data/all_possible_pairs.csv"):
+    """
+    Read the pairs of a previous run back with their exact weights.
+    :param output_path: file path of all_possible_pairs.csv
+    :return: df
+    """
+    return pd.read_csv(output_path, sep="\t",
+                       float_precision="round_trip").fillna(
+        {PAIR_COLUMNS[9]: ""})
+
+
+def _create_pairwise_weight_combinations(data_store, route_table):
+    """
+    Create all weight combinations by scoring one StudentPracticePair at a
+    time.
+    :param data_store:
+    :param route_table:
+    :return: df
+    """
+    weight_data = []
+    candidates = data_store.candidates
+
+    for s_pos, (i, stud_df_row) in enumerate(
+            data_store.df_students.iterrows()):
         # first loop iterating through all students
-        for j, prac_df_row in data_store.df_practices.iterrows():
+        for p_pos, (j, prac_df_row) in enumerate(
+                data_store.df_practices.iterrows()):
             # second loop iterating through all practices
+            if candidates is not None and not candidates[s_pos, p_pos]:
+                # pair pruned before fetching its routes
+                continue
 
             # initialize a student practice pair
-            stud_prac_pair = StudentPracticePair(stud_df_row, prac_df_row)
+            stud_prac_pair = StudentPracticePair(stud_df_row, prac_df_row,
+                                                 route_table=route_table)
             s_id = i
             p_id = j
 
@@ -40,62 +276,119 @@ def create_all_weight_combinations(data_store):
 
     # create a dataframe out of all possible combinations for better
     # querying
-    weight_df = pd.DataFrame(weight_data,
-                             columns=["s_id", "p_id", "Weight",
-                                      "Address of the student",
-                                      "Address of the practice",
-                                      "Required to move (No, Alternative 1, "
-                                      "Alternative 2)",
-                                      "Children (Yes, No)",
-                                      "Travel Mode (Bicycle, Car)",
-                                      "Duration (Minutes)",
-                                      "Matching Specialities"])
+    return pd.DataFrame(weight_data, columns=PAIR_COLUMNS)
 
-    # save the dataframe in csv
-    weight_df.to_csv("data/all_possible_pairs.csv", sep="\t",
-                     index=False)
-    print("Combinations created, can be founf at data/all_possible_pairs.csv")
 
-    return weight_df
+def pivot_weights(data_store, weight_df):
+    """
+    Pivot all pair combinations into a students x practices weight matrix.
+    :param data_store:
+    :param weight_df: df of all_possible_pairs.csv
+    :return: float array of shape (S, P) with NaN for pairs not scored, and
+    int array of shape (S, P) with the row position of each pair in
+    weight_df, -1 for pairs not scored
+    """
+    stud_codes = data_store.df_students.index.get_indexer(weight_df['s_id'])
+    prac_codes = data_store.df_practices.index.get_indexer(weight_df['p_id'])
+    shape = (len(data_store.df_students), len(data_store.df_practices))
 
+    weights = np.full(shape, np.nan)
+    weights[stud_codes, prac_codes] = weight_df['Weight'].to_numpy(
+        dtype=float)
+    positions = np.full(shape, -1)
+    positions[stud_codes, prac_codes] = np.arange(len(weight_df))
+    return weights, positions
 
-def extract_best_weights_students(data_store, weight_df):
+
+def select_top_pairs(data_store, weight_df, top_k=1, shards=None):
+    """
+    Select the rows of the top_k highest weight practices of every student
+    with one pass over the weight matrix.
+    :param data_store:
+    :param weight_df: df of all_possible_pairs.csv
+    :param top_k: number of practices kept per student
+    :param shards: list of (region, student positions, practice positions)
+    of a sharded run, the weights are then pivoted per shard instead of
+    over all students and practices
+    :return: df with the selected rows of weight_df and their Rank, ordered
+    by student and rank, without the pairs which have no weight
+    """
+    if shards is not None:
+        return _select_sharded_top_pairs(data_store, weight_df, top_k,
+                                         shards)
+
+    weights, positions = pivot_weights(data_store, weight_df)
+    # pairs whose routes all failed have no weight and are never selected
+    finite = np.isfinite(weights)
+    weights = np.where(finite, weights, -np.inf)
+    top_k = min(top_k, weights.shape[1])
+
+    if top_k == 1:
+        best = weights.argmax(axis=1)[:, None]
+    else:
+        best = np.argpartition(-weights, top_k - 1, axis=1)[:, :top_k]
+        # order the candidates by weight, ties by practice order
+        best.sort(axis=1)
+        order = np.argsort(-np.take_along_axis(weights, best, axis=1),
+                           axis=1, kind='stable')
+        best = np.take_along_axis(best, order, axis=1)
+
+    rows = np.take_along_axis(positions, best, axis=1)
+    ranks = np.broadcast_to(np.arange(1, top_k + 1), rows.shape)
+    scored = np.take_along_axis(finite, best, axis=1)
+    top_df = weight_df.iloc[rows[scored]].reset_index(drop=True)
+    top_df.insert(2, "Rank", ranks[scored])
+    return top_df
+
+
+def _select_sharded_top_pairs(data_store, weight_df, top_k, shards):
+    """
+    Select the top pairs of every shard and merge them in student order.
+    :param data_store:
+    :param weight_df: df of all_possible_pairs.csv
+    :param top_k: number of practices kept per student
+    :param shards: list of (region, student positions, practice positions)
+    :return: df like select_top_pairs
+    """
+    stud_positions = data_store.df_students.index.get_indexer(
+        weight_df['s_id'])
+    stud_shards = np.full(len(data_store.df_students), -1)
+    for number, (_, students, _) in enumerate(shards):
+        stud_shards[students] = number
+    row_shards = stud_shards[stud_positions]
+
+    frames = [select_top_pairs(
+        data_store.select_students(students).select_practices(practices),
+        weight_df[row_shards == number], top_k)
+        for number, (_, students, practices) in enumerate(shards)]
+    top_df = pd.concat(frames, ignore_index=True)
+    order = np.argsort(data_store.df_students.index.get_indexer(
+        top_df['s_id']), kind='stable')
+    return top_df.iloc[order].reset_index(drop=True)
+
+
+def extract_best_weights_students(data_store, weight_df, top_k=1,
+                                  output_path="data/best_pairs.csv",
+                                  shards=None):
     """
     Select best student practice pair weight
     :param data_store:
     :param weight_df:
-    :return:
+    :param top_k: number of ranked practices saved per student, the Rank
+    column is added to the file when more than one
+    :param output_path: file path for the best pairs
+    :param shards: regional shards of a sharded run, see select_top_pairs
+    :return: df of the saved pairs
     """
     print("Extracting best combinations..")
-    max_pairs = []
-
-    for i, stud_df_row in data_store.df_students.iterrows():
-        # iterate through rows of students
-
-        # find the row with max pair weight from all combinations
-        max_weight_pair_row = \
-            weight_df[weight_df.s_id == i].sort_values(by=['Weight'],
-                                                       ascending=False).iloc[0]
-
-        # restructure the data
-        p_id = max_weight_pair_row['p_id']
-        pair_str = str(i) + "<->" + p_id
-        max_weight_pair_row = max_weight_pair_row.drop(labels=['s_id', 'p_id'])
-        max_weight_pair_row = max_weight_pair_row.set_value("Pair", pair_str)
-
-        max_weight_pair_row = max_weight_pair_row.reindex(
-            ["Pair", "Weight", "Address of the student",
-             "Address of the practice", "Required to move (No, "
-                                        "Alternative 1, Alternative 2)",
-             "Children (Yes, No)", "Travel Mode (Bicycle, Car)",
-             "Duration (Minutes)", "Matching Specialities"])
-
-        max_pairs.append(max_weight_pair_row)
-
-    # create the dataframe
-    best_weights_df = pd.DataFrame(max_pairs)
-    best_weights_df.to_csv("data/best_pairs.csv",
-                           columns=max_weight_pair_row.index,
-                           index=False, sep="\t")
+    top_df = select_top_pairs(data_store, weight_df, top_k, shards)
+
+    best_weights_df = to_pair_format(top_df)
+    if top_k > 1:
+        best_weights_df.insert(1, "Rank", top_df["Rank"])
+
+    best_weights_df.to_csv(output_path, index=False, sep="\t")
+    get_instrumentation().incr("rows_written", len(best_weights_df))
     print("Combinations extracted. Final result can be found "
-          "at data/best_pairs.csv")
+          "at " + output_path)
+    return best_weights_df
@@ -0,0 +1,521 @@
+"""Script containing the vectorized engine for student practice weights"""
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from data_store import ADDRESS_SLOTS
+from route_table import MissingRouteError
+from address_book import AddressBook
+from config import WEIGHT_COEFFICIENTS
+
+# travel modes along the mode axis, 0 is bike and 1 is car
+TRAVEL_MODES = ["bicycle", "Car"]
+
+# labels of the relocation column, indexed by address slot
+RELOCATION_LABELS = ["No", "Alternative 1", "Alternative 2"]
+
+PAIR_COLUMNS = ["s_id", "p_id", "Weight",
+                "Address of the student",
+                "Address of the practice",
+                "Required to move (No, Alternative 1, "
+                "Alternative 2)",
+                "Children (Yes, No)",
+                "Travel Mode (Bicycle, Car)",
+                "Duration (Minutes)",
+                "Matching Specialities"]
+
+
+class DurationLookup:
+    """Dense array of the durations of all routes in the route table,
+    indexed by student address, mode and practice address codes.
+
+    Addresses are interned in an address book, so matching the routes to
+    the students and practices compares integer ids instead of strings.
+    """
+
+    def __init__(self, df_students, df_practices, route_table,
+                 address_book=None, route_ids=None):
+        """
+        Build the lookup for the addresses of the given students and
+        practices.
+        :param df_students: students df
+        :param df_practices: practices df
+        :param route_table: RouteTable with fetched durations
+        :param address_book: AddressBook shared with the datastore, a new
+        one if None
+        :param route_ids: student and practice address ids of the routes in
+        the address book, e.g. shared by the lookups of several shards,
+        interned from the route table if None
+        """
+        self.address_book = address_book or AddressBook()
+        self.max_duration = route_table.max_duration
+
+        # map every address to a dense code of the lookup table
+        stud_ids = self.address_book.intern(
+            df_students[ADDRESS_SLOTS].to_numpy(dtype=object))
+        self.stud_ids = pd.unique(stud_ids[stud_ids >= 0])
+        self.prac_ids = pd.unique(self.address_book.intern(
+            df_practices['address'].to_numpy(dtype=object)))
+
+        route_stud, route_prac = route_ids or \
+            route_table.address_ids(self.address_book)
+        self._make_code_tables()
+        route_stud = AddressBook.translate(self._stud_codes, route_stud)
+        route_prac = AddressBook.translate(self._prac_codes, route_prac)
+        route_mode = route_table.df['is_car'].to_numpy(dtype=int)
+        known = np.flatnonzero((route_stud >= 0) & (route_prac >= 0))
+        # the first row of a route wins, like in the route table
+        known = known[::-1]
+        codes = route_stud[known], route_mode[known], route_prac[known]
+
+        shape = (len(self.stud_ids), 2, len(self.prac_ids))
+        self.durations = np.full(shape, np.nan)
+        self.durations[codes] = route_table.df['duration'].to_numpy(
+            dtype=float)[known]
+        self.present = np.zeros(shape, dtype=bool)
+        self.present[codes] = True
+
+    def _make_code_tables(self):
+        self._stud_codes = self.address_book.code_table(self.stud_ids)
+        self._prac_codes = self.address_book.code_table(self.prac_ids)
+
+    @classmethod
+    def from_arrays(cls, stud_addresses, prac_addresses, durations, present,
+                    max_duration, address_book=None):
+        """
+        Make a lookup from already dense arrays, e.g. memory mapped ones.
+        :param stud_addresses: student addresses along the first axis
+        :param prac_addresses: practice addresses along the last axis
+        :param durations: float array of shape (A, 2, B)
+        :param present: bool array of shape (A, 2, B), False where the route
+        is not in the table
+        :param max_duration: longest duration of the route table
+        :param address_book: AddressBook the addresses are interned in, a
+        new one if None
+        :return: DurationLookup
+        """
+        lookup = cls.__new__(cls)
+        lookup.address_book = address_book or AddressBook()
+        lookup.stud_ids = lookup.address_book.intern(
+            np.asarray(stud_addresses, dtype=object))
+        lookup.prac_ids = lookup.address_book.intern(
+            np.asarray(prac_addresses, dtype=object))
+        lookup._make_code_tables()
+        lookup.durations = durations
+        lookup.present = present
+        lookup.max_duration = max_duration
+        return lookup
+
+    def select(self, df_students, df_practices):
+        """
+        Make a lookup of only the addresses of the given students and
+        practices, e.g. of one shard, with the same longest duration.
+        :param df_students: students df
+        :param df_practices: practices df
+        :return: DurationLookup
+        """
+        stud_codes, prac_codes = self.address_codes(df_students,
+                                                    df_practices)
+        stud_codes = pd.unique(stud_codes[stud_codes >= 0].ravel())
+        prac_codes = pd.unique(prac_codes[prac_codes >= 0])
+        cells = np.ix_(stud_codes, np.arange(2), prac_codes)
+        return DurationLookup.from_arrays(
+            self.address_book.decode(self.stud_ids[stud_codes]),
+            self.address_book.decode(self.prac_ids[prac_codes]),
+            np.asarray(self.durations[cells]),
+            np.asarray(self.present[cells]), self.max_duration,
+            self.address_book)
+
+    def address_codes(self, df_students, df_practices):
+        """
+        Map the addresses of students and practices to the codes of the
+        lookup table.
+        :param df_students: students df
+        :param df_practices: practices df
+        :return: int arrays of shape (S, 3) and (P,), -1 for addresses
+        missing from the lookup
+        """
+        stud_ids = self.address_book.lookup(
+            df_students[ADDRESS_SLOTS].to_numpy(dtype=object))
+        prac_ids = self.address_book.lookup(
+            df_practices['address'].to_numpy(dtype=object))
+        return (AddressBook.translate(self._stud_codes, stud_ids),
+                AddressBook.translate(self._prac_codes, prac_ids))
+
+    def tensor(self, df_students, df_practices, candidates=None):
+        """
+        Build the dense duration array of students against practices.
+
+        The array is indexed by [student, address slot, mode, practice].
+        Entries are NaN where the student has no alternative address in that
+        slot, no car for the car mode or the pair is not a candidate.
+        :param df_students: students df, a subset of the lookup students
+        :param df_practices: practices df, a subset of the lookup practices
+        :param candidates: bool array of shape (S, P), False for pruned pairs
+        whose routes are not required, all pairs if None
+        :return: float array of shape (S, 3, 2, P)
+        :raises MissingRouteError: if a required route is not in the table
+        """
+        stud_addrs = df_students[ADDRESS_SLOTS].to_numpy(dtype=object)
+        prac_addrs = df_practices['address'].to_numpy(dtype=object)
+
+        has_slot = ~pd.isna(stud_addrs)
+        stud_codes, prac_codes = self.address_codes(df_students,
+                                                    df_practices)
+        found = (stud_codes >= 0)[:, :, None, None] & \
+            (prac_codes >= 0)[None, None, None, :]
+
+        codes = (np.maximum(stud_codes, 0)[:, :, None, None],
+                 np.arange(2)[None, None, :, None],
+                 np.maximum(prac_codes, 0)[None, None, None, :])
+        tensor = self.durations[codes].astype(float)
+
+        # mask slots without an address and car routes for students without
+        # car
+        has_car = df_students['hasCar'].to_numpy(dtype=int).astype(bool)
+        required = (has_slot[:, :, None, None]
+                    & np.stack([np.ones_like(has_car), has_car],
+                               axis=1)[:, None, :, None]
+                    & np.ones(len(prac_addrs),
+                              dtype=bool)[None, None, None, :])
+        if candidates is not None:
+            required &= candidates[:, None, None, :]
+        missing = required & ~(found & self.present[codes])
+        if missing.any():
+            s, slot, mode, p = np.argwhere(missing)[0]
+            raise MissingRouteError(
+                "No route from '{}' to '{}' (is_car={}) in the route "
+                "table".format(stud_addrs[s, slot], prac_addrs[p], mode))
+
+        tensor[~required] = np.nan
+        return tensor
+
+
+def build_duration_tensor(df_students, df_practices, route_table):
+    """
+    Build the dense duration array of all students against all practices.
+    :param df_students: students df
+    :param df_practices: practices df
+    :param route_table: RouteTable with fetched durations
+    :return: float array of shape (S, 3, 2, P), see DurationLookup.tensor
+    """
+    return DurationLookup(df_students, df_practices, route_table).tensor(
+        df_students, df_practices)
+
+
+def _relocation_labels(stud_addrs):
+    """
+    Label each address slot of each student the way
+    StudentPracticePair.requires_relocation does, by comparing the address
+    in the slot with the main and alternative addresses.
+    :param stud_addrs: int array of shape (S, 3) of address ids
+    :return: object array of shape (S, 3)
+    """
+    labels = np.empty(stud_addrs.shape, dtype=object)
+    for slot in range(len(ADDRESS_SLOTS)):
+        labels[:, slot] = RELOCATION_LABELS[slot]
+        for earlier in reversed(range(slot)):
+            same = stud_addrs[:, slot] == stud_addrs[:, earlier]
+            labels[same, slot] = RELOCATION_LABELS[earlier]
+    return labels
+
+
+class WeightMatrix:
+    """Weights and derived values of all student practice pairs at once."""
+
+    def __init__(self, data_store, route_table=None, lookup=None):
+        """
+        Compute the weight matrix of all students against all practices.
+        :param data_store: DataStore with students and practices, only the
+        candidate pairs are scored if it holds a pruned candidate mask
+        :param route_table: RouteTable with fetched durations
+        :param lookup: DurationLookup already built from the route table,
+        used instead of the route table if given
+        """
+        df_students = data_store.df_students
+        df_practices = data_store.df_practices
+
+        self.student_ids = df_students.index.to_numpy(dtype=object)
+        self.practice_ids = df_practices.index.to_numpy(dtype=object)
+        # addresses stay interned and are only decoded for output rows
+        self.address_book = data_store.address_book
+        self.student_address_ids = data_store.get_student_address_ids()
+        self.practice_address_ids = data_store.get_practice_address_ids()
+        self.children = df_students['hasChildren'].to_numpy(dtype=int,
+                                                            copy=True)
+        if lookup is None:
+            lookup = DurationLookup(df_students, df_practices, route_table,
+                                    self.address_book)
+        self.max_duration = lookup.max_duration
+
+        # pairs pruned before fetching the routes are not scored
+        self.candidates = data_store.candidates
+        self._reduce_durations(lookup.tensor(df_students, df_practices,
+                                             self.candidates))
+
+        # specialties stay encoded and are only decoded for output rows
+        self.specialty_index = data_store.specialty_index
+        self.student_specialties = self.specialty_index.pack(
+            self.specialty_index.pad(data_store.student_specialties))
+        self.practice_specialties = self.specialty_index.pack(
+            self.specialty_index.pad(data_store.practice_specialties))
+        self.match_counts = data_store.get_match_counts()
+
+        duration_coef, specialty_coef, children_coef = WEIGHT_COEFFICIENTS
+        self.weights = ((duration_coef * (self.max_duration -
+                                          self.durations))
+                        + (specialty_coef * self.match_counts)
+                        + (children_coef * self.children[:, None])) / 100
+
+    def _reduce_durations(self, tensor):
+        """
+        Find the fastest route of every pair with a single argmin.
+
+        The candidates are ordered bike before car and main address before the
+        alternatives, so ties resolve like StudentPracticePair does.
+        :param tensor: float array of shape (S, 3, 2, P)
+        :return:
+        """
+        n_stud, n_slots, n_modes, n_prac = tensor.shape
+        candidates = tensor.transpose(0, 3, 2, 1).reshape(
+            n_stud, n_prac, n_modes * n_slots)
+        unroutable = np.isnan(candidates).all(axis=2)
+        best = np.where(np.isnan(candidates), np.inf,
+                        candidates).argmin(axis=2)
+
+        self.durations = np.take_along_axis(
+            candidates, best[:, :, None], axis=2)[:, :, 0]
+        self.durations[unroutable] = np.nan
+        self.modes = best // n_slots
+        self.slots = best % n_slots
+
+    def to_dataframe(self):
+        """
+        Flatten the matrix into one row per pair with the columns of
+        all_possible_pairs.csv, leaving out pruned pairs.
+        :return: df
+        """
+        if self.candidates is None:
+            n_stud, n_prac = self.weights.shape
+            stud_rows = np.repeat(np.arange(n_stud), n_prac)
+            prac_rows = np.tile(np.arange(n_prac), n_stud)
+        else:
+            stud_rows, prac_rows = np.nonzero(self.candidates)
+        return self.pair_rows(stud_rows, prac_rows)
+
+    def pair_rows(self, stud_rows, prac_rows):
+        """
+        Build the rows of all_possible_pairs.csv of the given pairs.
+        :param stud_rows: int array of student positions
+        :param prac_rows: int array of practice positions
+        :return: df
+        """
+        stud_rows = np.asarray(stud_rows, dtype=int)
+        prac_rows = np.asarray(prac_rows, dtype=int)
+        pairs = stud_rows, prac_rows
+        slots = self.slots[pairs]
+
+        relocation = _relocation_labels(self.student_address_ids)
+        children = np.where(self.children > 0, "Yes", "No")
+
+        return pd.DataFrame({
+            PAIR_COLUMNS[0]: self.student_ids[stud_rows],
+            PAIR_COLUMNS[1]: self.practice_ids[prac_rows],
+            PAIR_COLUMNS[2]: self.weights[pairs],
+            PAIR_COLUMNS[3]: self.address_book.decode(
+                self.student_address_ids[stud_rows, slots]),
+            PAIR_COLUMNS[4]: self.address_book.decode(
+                self.practice_address_ids[prac_rows]),
+            PAIR_COLUMNS[5]: relocation[stud_rows, slots],
+            PAIR_COLUMNS[6]: children[stud_rows],
+            PAIR_COLUMNS[7]: np.array(TRAVEL_MODES)[self.modes[pairs]],
+            PAIR_COLUMNS[8]: self.durations[pairs] / 60,
+            PAIR_COLUMNS[9]: self._decode_specialities(stud_rows,
+                                                       prac_rows),
+        }, columns=PAIR_COLUMNS)
+
+    def replace_students(self, positions, other):
+        """
+        Replace the rows of some students with the rows of a matrix scored
+        for those students alone, e.g. after their data was edited.
+        :param positions: int array of the student positions
+        :param other: WeightMatrix of the students at positions, scored
+        against the same practices
+        :return:
+        """
+        if other.student_specialties.shape[1] != \
+                self.student_specialties.shape[1]:
+            # the specialty index grew past a word, widen the packed masks
+            width = other.student_specialties.shape[1]
+            self.student_specialties = _widen(self.student_specialties, width)
+            self.practice_specialties = other.practice_specialties
+        for name in ['weights', 'durations', 'modes', 'slots',
+                     'match_counts', 'children', 'student_address_ids',
+                     'student_specialties']:
+            getattr(self, name)[positions] = getattr(other, name)
+
+    def _decode_specialities(self, stud_rows, prac_rows):
+        """
+        Decode the matching specialities of the given pairs, skipping pairs
+        without any match.
+        :param stud_rows: int array of student positions
+        :param prac_rows: int array of practice positions
+        :return: list of comma separated names
+        """
+        decoded = np.full(len(stud_rows), "", dtype=object)
+        matched = self.match_counts[stud_rows, prac_rows] > 0
+        if matched.any():
+            decoded[matched] = self.specialty_index.decode(
+                self.student_specialties[stud_rows[matched]]
+                & self.practice_specialties[prac_rows[matched]])
+        return decoded
+
+
+def _widen(masks, width):
+    widened = np.zeros((len(masks), width), dtype=masks.dtype)
+    widened[:, :masks.shape[1]] = masks
+    return widened
+
+
+def iter_pair_chunks(data_store, route_table=None, chunk_size=1000,
+                     lookup=None):
+    """
+    Score the pairs of chunk_size students at a time.
+
+    Only the pairs of one chunk are held in memory at once, next to the
+    dense lookup of the route table which is built once.
+    :param data_store: DataStore with students and practices
+    :param route_table: RouteTable with fetched durations
+    :param chunk_size: students per chunk
+    :param lookup: DurationLookup used instead of the route table if given
+    :return: generator of (DataStore of the chunk, df of its pairs)
+    """
+    if lookup is None:
+        lookup = DurationLookup(data_store.df_students,
+                                data_store.df_practices, route_table,
+                                data_store.address_book)
+    for start in range(0, len(data_store.df_students), chunk_size):
+        chunk = data_store.select_students(slice(start, start + chunk_size))
+        yield chunk, WeightMatrix(chunk, lookup=lookup).to_dataframe()
+
+
+# read-only inputs of a weight worker process, set once by the initializer
+_worker_inputs = {}
+
+
+def _init_weight_worker(data_store, lookup):
+    """
+    Receive the read-only tables once per worker process.
+    :param data_store: DataStore with all students and practices
+    :param lookup: DurationLookup of the route table
+    :return:
+    """
+    _worker_inputs['data_store'] = data_store
+    _worker_inputs['lookup'] = lookup
+
+
+def _score_student_shard(shard):
+    """
+    Score a range of students against all practices in a worker process.
+    :param shard: (start, stop) student positions
+    :return: df of the pairs of the shard
+    """
+    data_store = _worker_inputs['data_store'].select_students(slice(*shard))
+    return WeightMatrix(data_store,
+                        lookup=_worker_inputs['lookup']).to_dataframe()
+
+
+def _score_block(block):
+    """
+    Score a block of students against a block of practices in a worker
+    process.
+    :param block: (student positions, practice positions, DurationLookup of
+    the block)
+    :return: df of the pairs of the block
+    """
+    students, practices, lookup = block
+    data_store = _worker_inputs['data_store'].select_students(
+        students).select_practices(practices)
+    return WeightMatrix(data_store, lookup=lookup).to_dataframe()
+
+
+def score_blocks(data_store, blocks, route_table=None, workers=None,
+                 lookup=None):
+    """
+    Score blocks of students against blocks of practices, e.g. the regional
+    shards of the roster, one block per task of a pool of worker processes.
+
+    Every block gets a lookup of only its own addresses, so the memory of
+    the lookups grows with the size of the blocks instead of the roster.
+    :param data_store: DataStore with students and practices
+    :param blocks: list of (student positions, practice positions)
+    :param route_table: RouteTable with fetched durations
+    :param workers: number of worker processes, serial if None or 1
+    :param lookup: DurationLookup the block lookups are selected from
+    instead of the route table if given
+    :return: list of dfs with the pairs of every block
+    """
+    route_ids = None
+    if lookup is None:
+        route_ids = route_table.address_ids(data_store.address_book)
+
+    def select(students, practices):
+        block = data_store.select_students(students).select_practices(
+            practices)
+        if lookup is None:
+            return block, DurationLookup(
+                block.df_students, block.df_practices, route_table,
+                data_store.address_book, route_ids)
+        return block, lookup.select(block.df_students, block.df_practices)
+
+    if not workers or workers == 1 or len(blocks) < 2:
+        frames = []
+        for students, practices in blocks:
+            block, block_lookup = select(students, practices)
+            frames.append(WeightMatrix(block,
+                                       lookup=block_lookup).to_dataframe())
+        return frames
+
+    tasks = ((students, practices, select(students, practices)[1])
+             for students, practices in blocks)
+    with ProcessPoolExecutor(max_workers=min(workers, len(blocks)),
+                             initializer=_init_weight_worker,
+                             initargs=(data_store, None)) as pool:
+        return list(pool.map(_score_block, tasks))
+
+
+def compute_pairs_parallel(data_store, route_table, workers, shard_size=None,
+                           lookup=None):
+    """
+    Score all pairs in a pool of worker processes, one shard of students per
+    task.
+
+    Workers receive the practices and the dense lookup of the route table
+    once through the pool initializer and only the student range per task.
+    Shards are merged in student order, so the result is identical to a
+    serial run.
+    :param data_store: DataStore with students and practices
+    :param route_table: RouteTable with fetched durations
+    :param workers: number of worker processes
+    :param shard_size: students per task, spread evenly over four tasks
+    per worker if None
+    :param lookup: DurationLookup used instead of the route table if given
+    :return: df with the columns of all_possible_pairs.csv
+    """
+    n_students = len(data_store.df_students)
+    if shard_size is None:
+        shard_size = max(1, -(-n_students // (workers * 4)))
+    shards = [(start, min(start + shard_size, n_students))
+              for start in range(0, n_students, shard_size)]
+
+    if lookup is None:
+        lookup = DurationLookup(data_store.df_students,
+                                data_store.df_practices, route_table,
+                                data_store.address_book)
+    if not shards:
+        return WeightMatrix(data_store, lookup=lookup).to_dataframe()
+
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_weight_worker,
+                             initargs=(data_store, lookup)) as pool:
+        frames = list(pool.map(_score_student_shard, shards))
+    return pd.concat(frames, ignore_index=True)